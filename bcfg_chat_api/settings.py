@@ -59,6 +59,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # First, so request metrics cover the rest of the stack
+    'chat.metrics.metrics_middleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -66,6 +68,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'chat.replica.sticky_primary_middleware',
 ]
 
 ROOT_URLCONF = 'bcfg_chat_api.urls'
@@ -88,13 +91,102 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'bcfg_chat_api.wsgi.application'
 
+# OpenAI client shared by every request in a worker
+OPENAI_API_KEY = os.environ.get('OPENAI_API_KEY', '')
+OPENAI_MODEL = os.environ.get('OPENAI_MODEL', 'gpt-4o-mini')
+OPENAI_TIMEOUT = float(os.environ.get('OPENAI_TIMEOUT', '60'))
+OPENAI_CONNECT_TIMEOUT = float(os.environ.get('OPENAI_CONNECT_TIMEOUT', '5'))
+OPENAI_MAX_RETRIES = int(os.environ.get('OPENAI_MAX_RETRIES', '2'))
+OPENAI_MAX_CONNECTIONS = int(os.environ.get('OPENAI_MAX_CONNECTIONS', '100'))
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get('OPENAI_MAX_KEEPALIVE_CONNECTIONS', '20'))
+OPENAI_KEEPALIVE_EXPIRY = float(os.environ.get('OPENAI_KEEPALIVE_EXPIRY', '30'))
+
+# OpenAI budget shared by all workers through the database; 0 disables a limit.
+# The defaults sit just under OpenAI's tier-1 gpt-4o-mini limits (500 RPM,
+# 200k TPM), so 429s stay rare; with a 2000-token estimate per run the token
+# bucket admits about 100 runs a minute. Raise them to your account's tier, and
+# set OPENAI_REQUESTS_PER_MINUTE=0 OPENAI_TOKENS_PER_MINUTE=0
+# OPENAI_USER_REQUESTS_PER_MINUTE=0 when benchmarking against a fake API.
+OPENAI_REQUESTS_PER_MINUTE = int(os.environ.get('OPENAI_REQUESTS_PER_MINUTE', '500'))
+OPENAI_TOKENS_PER_MINUTE = int(os.environ.get('OPENAI_TOKENS_PER_MINUTE', '200000'))
+OPENAI_USER_REQUESTS_PER_MINUTE = int(os.environ.get('OPENAI_USER_REQUESTS_PER_MINUTE', '20'))
+OPENAI_RUN_TOKEN_ESTIMATE = int(os.environ.get('OPENAI_RUN_TOKEN_ESTIMATE', '2000'))
+OPENAI_RATE_LIMIT_MAX_WAIT = float(os.environ.get('OPENAI_RATE_LIMIT_MAX_WAIT', '30'))
+OPENAI_RATE_LIMIT_RETRIES = int(os.environ.get('OPENAI_RATE_LIMIT_RETRIES', '3'))
+
+# Use the async chat views (AsyncOpenAI + async ORM); set when serving bcfg_chat_api.asgi
+CHAT_ASYNC_VIEWS = os.environ.get('CHAT_ASYNC_VIEWS', 'False') == 'True'
+
+# Seconds a worker trusts its cached Prompt/Activity config before checking for edits
+CHAT_CONFIG_CHECK_INTERVAL = float(os.environ.get('CHAT_CONFIG_CHECK_INTERVAL', '5'))
+
+# How replies are generated: 'assistants' (OpenAI threads and runs) or
+# 'completions' (Chat Completions over context built from our transcripts,
+# with at most CHAT_CONTEXT_TOKENS of past messages)
+CHAT_BACKEND = os.environ.get('CHAT_BACKEND', 'assistants')
+CHAT_CONTEXT_TOKENS = int(os.environ.get('CHAT_CONTEXT_TOKENS', '3000'))
+
+# Tokens a user's replies may use in any 24 hours before new turns are refused; 0 disables
+CHAT_USER_DAILY_TOKENS = int(os.environ.get('CHAT_USER_DAILY_TOKENS', '0'))
+
+# Context each run re-reads: a new OpenAI thread per chat session, optionally
+# seeded with a summary of the previous session (one extra completion of at most
+# CHAT_SESSION_SUMMARY_TOKENS per restart), and the number of most recent thread
+# messages a run may read (0 leaves truncation to OpenAI)
+CHAT_THREAD_PER_SESSION = os.environ.get('CHAT_THREAD_PER_SESSION', 'True') == 'True'
+CHAT_SESSION_SUMMARY = os.environ.get('CHAT_SESSION_SUMMARY', 'False') == 'True'
+CHAT_SESSION_SUMMARY_TOKENS = int(os.environ.get('CHAT_SESSION_SUMMARY_TOKENS', '300'))
+OPENAI_TRUNCATION_LAST_MESSAGES = int(os.environ.get('OPENAI_TRUNCATION_LAST_MESSAGES', '0'))
+
+# Seconds a chat turn holds the user's lease; a crashed turn blocks their next send at most this long
+CHAT_TURN_LEASE_SECONDS = int(os.environ.get('CHAT_TURN_LEASE_SECONDS', '180'))
+
+# Idempotency-Key handling: how long a stored response is replayed, and how long a
+# retry waits for the original request to finish before getting a 409
+IDEMPOTENCY_KEY_TTL = int(os.environ.get('IDEMPOTENCY_KEY_TTL', '86400'))
+IDEMPOTENCY_WAIT = float(os.environ.get('IDEMPOTENCY_WAIT', '60'))
+# Seconds a request holds its key before a retry may take it over, in case the
+# process serving it died; long enough for a retry's wait plus a whole turn
+IDEMPOTENCY_LEASE_SECONDS = int(os.environ.get(
+    'IDEMPOTENCY_LEASE_SECONDS', str(int(IDEMPOTENCY_WAIT) + CHAT_TURN_LEASE_SECONDS)))
+
+# Incoming webhook queue, drained by `manage.py run_incoming_jobs`
+INCOMING_JOB_CONCURRENCY = int(os.environ.get('INCOMING_JOB_CONCURRENCY', '4'))
+INCOMING_JOB_MAX_ATTEMPTS = int(os.environ.get('INCOMING_JOB_MAX_ATTEMPTS', '5'))
+INCOMING_JOB_RETRY_DELAY = float(os.environ.get('INCOMING_JOB_RETRY_DELAY', '5'))
+INCOMING_JOB_LEASE_SECONDS = int(os.environ.get('INCOMING_JOB_LEASE_SECONDS', '300'))
+# Days finished jobs are kept (failed ones stay until removed by hand), and
+# seconds between a worker process' housekeeping passes
+INCOMING_JOB_RETENTION_DAYS = float(os.environ.get('INCOMING_JOB_RETENTION_DAYS', '7'))
+INCOMING_JOB_HOUSEKEEPING_INTERVAL = float(os.environ.get('INCOMING_JOB_HOUSEKEEPING_INTERVAL', '60'))
+
+# Reply delivery to the participant platform
+PARTICIPANT_API_URL = os.environ.get('PARTICIPANT_API_URL', 'http://external-api.com/ai/api')
+DELIVERY_CONNECT_TIMEOUT = float(os.environ.get('DELIVERY_CONNECT_TIMEOUT', '3'))
+DELIVERY_READ_TIMEOUT = float(os.environ.get('DELIVERY_READ_TIMEOUT', '10'))
+DELIVERY_MAX_ATTEMPTS = int(os.environ.get('DELIVERY_MAX_ATTEMPTS', '4'))
+DELIVERY_BACKOFF = float(os.environ.get('DELIVERY_BACKOFF', '0.5'))
+DELIVERY_BACKOFF_MAX = float(os.environ.get('DELIVERY_BACKOFF_MAX', '8'))
+DELIVERY_POOL_SIZE = int(os.environ.get('DELIVERY_POOL_SIZE', '20'))
+DELIVERY_BREAKER_THRESHOLD = int(os.environ.get('DELIVERY_BREAKER_THRESHOLD', '5'))
+DELIVERY_BREAKER_RESET_TIMEOUT = float(os.environ.get('DELIVERY_BREAKER_RESET_TIMEOUT', '30'))
+
+# Request profiling (chat/metrics.py): a Server-Timing header on each response,
+# and a log record for requests slower than SLOW_REQUEST_SECONDS (0 disables)
+# listing up to SLOW_REQUEST_MAX_QUERIES queries and every OpenAI call
+SERVER_TIMING = os.environ.get('SERVER_TIMING', 'True') == 'True'
+SLOW_REQUEST_SECONDS = float(os.environ.get('SLOW_REQUEST_SECONDS', '10'))
+SLOW_REQUEST_MAX_QUERIES = int(os.environ.get('SLOW_REQUEST_MAX_QUERIES', '100'))
+
 
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
+# chat.backends.mysql is Django's MySQL backend with a per-process connection
+# pool and driver calls offloaded to threads, so gevent workers stay responsive
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.mysql',
+        'ENGINE': os.environ.get('DB_ENGINE', 'chat.backends.mysql'),
         'NAME': os.environ.get('MYSQL_DATABASE', 'my_db'),
         'USER': os.environ.get('MYSQL_USER', 'my_user'),
         'PASSWORD': os.environ.get('MYSQL_PASSWORD', 'my_password'),
@@ -103,6 +195,40 @@ DATABASES = {
     }
 }
 
+# Serialized conversation pages kept per user (chat/conversation_cache.py), in
+# the default cache: seconds an entry lives and pages kept per user
+CONVERSATION_CACHE_TTL = int(os.environ.get('CONVERSATION_CACHE_TTL', '300'))
+CONVERSATION_CACHE_PAGES = int(os.environ.get('CONVERSATION_CACHE_PAGES', '8'))
+
+# Buffer a chat turn's transcripts and insert them in the transaction that
+# saves the turn's progress, rather than committing each one on its own
+TRANSCRIPT_WRITE_BEHIND = os.environ.get('TRANSCRIPT_WRITE_BEHIND', 'False') == 'True'
+
+# Optional read replica for the read-only endpoints, see chat/replica.py
+if os.environ.get('MYSQL_REPLICA_HOST'):
+    DATABASES['replica'] = {
+        **DATABASES['default'],
+        'HOST': os.environ['MYSQL_REPLICA_HOST'],
+        'PORT': os.environ.get('MYSQL_REPLICA_PORT', DATABASES['default']['PORT']),
+        'TEST': {'MIRROR': 'default'},
+    }
+DATABASE_ROUTERS = ['chat.replica.ReplicaRouter']
+# Seconds a client's reads stay on the primary after it writes
+REPLICA_STICKY_SECONDS = float(os.environ.get('REPLICA_STICKY_SECONDS', '5'))
+
+# The load balancer ends TLS and passes the scheme on in X-Forwarded-Proto, so
+# request.is_secure() is only right when Django trusts that header; the sticky
+# cookie above needs it to be SameSite=None; Secure inside the cross-site iframe.
+# Set to False when the app is reachable without a proxy that overwrites it.
+if os.environ.get('TRUST_X_FORWARDED_PROTO', 'True') == 'True':
+    SECURE_PROXY_SSL_HEADER = ('HTTP_X_FORWARDED_PROTO', 'https')
+
+# Connection pool of chat.backends.mysql, per worker process: open connections,
+# seconds to wait for a free one, and seconds idle before one is pinged on reuse
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '10'))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', '10'))
+DB_POOL_RECYCLE = float(os.environ.get('DB_POOL_RECYCLE', '300'))
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
@@ -0,0 +1,226 @@
+"""
+Compares how many concurrent chat requests the WSGI/gevent and ASGI setups can hold.
+
+The chat endpoints spend almost all their time waiting on OpenAI, so this
+benchmark replaces OpenAI with a local stand-in that answers every run after a
+fixed delay, then fires concurrent chat messages at the app. By default it uses
+/api/chat/send/stream/, which is what the chat page posts to, and reports time
+to the first streamed token as well as total time; `--endpoint send` measures
+the blocking /api/chat/send/ instead.
+
+1. Start the fake OpenAI API (first token after --ttft seconds, run done after --latency):
+       python bench_concurrency.py fake-openai --port 8100 --latency 2 --ttft 0.3
+
+2. Start the app pointed at it, once per setup being compared:
+       export OPENAI_BASE_URL=http://localhost:8100/v1 OPENAI_API_KEY=bench
+       export OPENAI_REQUESTS_PER_MINUTE=0 OPENAI_TOKENS_PER_MINUTE=0 OPENAI_USER_REQUESTS_PER_MINUTE=0
+       gunicorn bcfg_chat_api.wsgi:application --bind 0.0.0.0:8000 --worker-class gevent --workers 1
+   or
+       CHAT_ASYNC_VIEWS=True uvicorn bcfg_chat_api.asgi:application --port 8000 --workers 1
+
+3. Drive load and compare the reports:
+       python bench_concurrency.py load --url http://localhost:8000 --concurrency 200 --requests 1000
+       python bench_concurrency.py load --url http://localhost:8000 --endpoint send
+
+With a fixed upstream latency, throughput close to concurrency / latency means
+the worker is holding every request in flight at once. The OpenAI rate limits
+are turned off in step 2 because their defaults (about 100 runs a minute with
+the default token estimate) would cap the benchmark long before the worker does.
+"""
+import argparse
+import json
+import statistics
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+
+REPLY_WORDS = ["Benchmark", " streamed", " reply", " text"]
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    latency = 2.0
+    ttft = 0.3
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length) or b'{}')
+        parts = self.path.rstrip('/').split('/')
+        if parts[-1] == 'assistants':
+            self.send_json({'id': f'asst_{uuid.uuid4().hex}', 'object': 'assistant'})
+        elif parts[-1] == 'threads':
+            self.send_json({'id': f'thread_{uuid.uuid4().hex}', 'object': 'thread'})
+        elif parts[-1] == 'messages':
+            self.send_json({'id': f'msg_{uuid.uuid4().hex}', 'object': 'thread.message',
+                            'role': 'user', 'content': []})
+        elif parts[-1] == 'runs' and body.get('stream'):
+            self.stream_run(parts[-2])
+        elif parts[-1] == 'runs':
+            # Hold the run for the configured model latency
+            time.sleep(self.latency)
+            self.send_json(self.run(parts[-2]))
+        else:
+            self.send_error(404)
+
+    def stream_run(self, thread_id):
+        run = self.run(thread_id)
+        message = {'id': f'msg_{uuid.uuid4().hex}', 'object': 'thread.message', 'role': 'assistant',
+                   'thread_id': thread_id, 'content': []}
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.send_event('thread.run.created', dict(run, status='in_progress'))
+        self.send_event('thread.message.created', message)
+        time.sleep(self.ttft)
+        for index, word in enumerate(REPLY_WORDS):
+            if index:
+                time.sleep(max(self.latency - self.ttft, 0) / len(REPLY_WORDS))
+            self.send_event('thread.message.delta', {
+                'id': message['id'], 'object': 'thread.message.delta',
+                'delta': {'content': [{'index': 0, 'type': 'text', 'text': {'value': word}}]}})
+        self.send_event('thread.run.completed', run)
+        self.wfile.write(b'event: done\ndata: [DONE]\n\n')
+        self.wfile.flush()
+        self.close_connection = True
+
+    def send_event(self, event, data):
+        self.wfile.write(f"event: {event}\ndata: {json.dumps(data)}\n\n".encode())
+        self.wfile.flush()
+
+    def do_GET(self):
+        path, _, query = self.path.partition('?')
+        parts = path.rstrip('/').split('/')
+        if parts[-1] == 'messages' and 'after=' in query:
+            # The SDK keeps paging until it gets an empty page
+            self.send_json({'object': 'list', 'has_more': False, 'data': []})
+        elif parts[-1] == 'messages':
+            self.send_json({'object': 'list', 'has_more': False, 'data': [{
+                'id': f'msg_{uuid.uuid4().hex}', 'object': 'thread.message', 'role': 'assistant',
+                'content': [{'type': 'text', 'text': {'value': ''.join(REPLY_WORDS), 'annotations': []}}],
+            }]})
+        elif parts[-2] == 'runs':
+            self.send_json(self.run(parts[-3]))
+        else:
+            self.send_error(404)
+
+    def run(self, thread_id):
+        return {'id': f'run_{uuid.uuid4().hex}', 'object': 'thread.run', 'thread_id': thread_id,
+                'status': 'completed', 'usage': {'prompt_tokens': 100, 'completion_tokens': 20,
+                                                 'total_tokens': 120}}
+
+
+class FakeOpenAIServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # Default backlog of 5 makes the client retry under benchmark concurrency
+    request_queue_size = 1024
+
+
+def fake_openai(args):
+    FakeOpenAIHandler.latency = args.latency
+    FakeOpenAIHandler.ttft = args.ttft
+    server = FakeOpenAIServer(('0.0.0.0', args.port), FakeOpenAIHandler)
+    print(f"Fake OpenAI API on http://localhost:{args.port}/v1 with {args.latency}s run latency")
+    server.serve_forever()
+
+
+def load(args):
+    session_users = [f"bench{uuid.uuid4().hex[:12]}" for _ in range(args.concurrency)]
+    print(f"Logging in {len(session_users)} users...")
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(lambda user_id: requests.post(
+            f"{args.url}/api/chat/login/",
+            json={'nickname': user_id, 'user_id': user_id}, timeout=args.timeout), session_users))
+
+    latencies = []
+    first_tokens = []
+    errors = 0
+    lock = threading.Lock()
+
+    def send(i):
+        nonlocal errors
+        user_id = session_users[i % len(session_users)]
+        first_token = None
+        started = time.perf_counter()
+        try:
+            if args.endpoint == 'stream':
+                with requests.post(
+                        f"{args.url}/api/chat/send/stream/", json={'message': f"Benchmark message {i}"},
+                        headers={'X-User-Id': user_id}, timeout=args.timeout, stream=True) as response:
+                    ok = response.status_code == 200
+                    for line in response.iter_lines():
+                        if first_token is None and line.startswith(b'event: delta'):
+                            first_token = time.perf_counter() - started
+                        elif line.startswith(b'event: error'):
+                            ok = False
+            else:
+                response = requests.post(
+                    f"{args.url}/api/chat/send/", json={'message': f"Benchmark message {i}"},
+                    headers={'X-User-Id': user_id}, timeout=args.timeout)
+                ok = response.status_code == 200
+        except requests.RequestException:
+            ok = False
+        elapsed = time.perf_counter() - started
+        with lock:
+            if ok:
+                latencies.append(elapsed)
+                if first_token is not None:
+                    first_tokens.append(first_token)
+            else:
+                errors += 1
+
+    print(f"Sending {args.requests} messages to {args.endpoint} with concurrency {args.concurrency}...")
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(send, range(args.requests)))
+    wall = time.perf_counter() - started
+
+    print(f"Completed: {len(latencies)}  Errors: {errors}  Wall time: {wall:.1f}s")
+    print(f"Throughput: {len(latencies) / wall:.1f} req/s")
+    report("Time to first token", first_tokens)
+    report("Total time", latencies)
+
+
+def report(label, samples):
+    if samples:
+        samples = sorted(samples)
+        print(f"{label} p50: {statistics.median(samples):.2f}s  "
+              f"p95: {samples[max(int(len(samples) * 0.95) - 1, 0)]:.2f}s  max: {samples[-1]:.2f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    fake = subparsers.add_parser('fake-openai', help='Serve a fixed-latency OpenAI stand-in')
+    fake.add_argument('--port', type=int, default=8100)
+    fake.add_argument('--latency', type=float, default=2.0)
+    fake.add_argument('--ttft', type=float, default=0.3)
+    fake.set_defaults(func=fake_openai)
+
+    drive = subparsers.add_parser('load', help='Send concurrent chat messages to the app')
+    drive.add_argument('--url', default='http://localhost:8000')
+    drive.add_argument('--endpoint', choices=['stream', 'send'], default='stream')
+    drive.add_argument('--concurrency', type=int, default=100)
+    drive.add_argument('--requests', type=int, default=500)
+    drive.add_argument('--timeout', type=float, default=120)
+    drive.set_defaults(func=load)
+
+    args = parser.parse_args()
+    args.func(args)
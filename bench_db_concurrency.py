@@ -0,0 +1,76 @@
+"""
+Shows whether a gevent worker keeps serving other greenlets while database queries run.
+
+Each greenlet runs `SELECT SLEEP(--query-time)` through Django's connection,
+closing it afterwards the way a request does, while a heartbeat greenlet asks
+to wake every 10 ms and records how late it actually wakes. Run it once per
+backend against the same MySQL server (MYSQL_* variables as for the app):
+
+    python bench_db_concurrency.py --engine django.db.backends.mysql
+    python bench_db_concurrency.py --engine chat.backends.mysql --pool-size 10
+
+With the stock backend every query blocks the whole process: the run takes
+about greenlets x queries x query-time, and the heartbeat stalls for a whole
+query. With chat.backends.mysql, queries run --pool-size at a time on native
+threads. The run takes about pool-size times less, and the heartbeat stays
+within a few milliseconds.
+"""
+from gevent import monkey
+monkey.patch_all()
+
+import argparse
+import os
+import statistics
+import time
+
+import django
+import gevent
+
+HEARTBEAT = 0.01
+
+
+def main(args):
+    os.environ['DB_ENGINE'] = args.engine
+    os.environ['DB_POOL_SIZE'] = str(args.pool_size)
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'bcfg_chat_api.settings')
+    django.setup()
+    from django.db import connection
+
+    def run_queries():
+        for _ in range(args.queries):
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT SLEEP(%s)", [args.query_time])
+            connection.close()
+
+    lags = []
+    running = True
+
+    def heartbeat():
+        while running:
+            before = time.monotonic()
+            gevent.sleep(HEARTBEAT)
+            lags.append(time.monotonic() - before - HEARTBEAT)
+
+    print(f"{args.greenlets} greenlets x {args.queries} queries of {args.query_time}s on {args.engine}...")
+    ticker = gevent.spawn(heartbeat)
+    start = time.monotonic()
+    gevent.joinall([gevent.spawn(run_queries) for _ in range(args.greenlets)], raise_error=True)
+    wall = time.monotonic() - start
+    running = False
+    ticker.join()
+
+    serial = args.greenlets * args.queries * args.query_time
+    print(f"Wall time: {wall:.2f}s  (serialized: {serial:.2f}s, speedup {serial / wall:.1f}x)")
+    lags.sort()
+    print(f"Heartbeat lag p50: {statistics.median(lags) * 1000:.1f}ms  "
+          f"p95: {lags[max(int(len(lags) * 0.95) - 1, 0)] * 1000:.1f}ms  max: {lags[-1] * 1000:.1f}ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--engine', default='chat.backends.mysql')
+    parser.add_argument('--pool-size', type=int, default=10)
+    parser.add_argument('--greenlets', type=int, default=50)
+    parser.add_argument('--queries', type=int, default=4)
+    parser.add_argument('--query-time', type=float, default=0.1)
+    main(parser.parse_args())
@@ -4,3 +4,9 @@ from django.apps import AppConfig
 class ChatConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'chat'
+
+    def ready(self):
+        # Connects the Prompt/Activity change signals
+        from . import prompt_cache  # noqa: F401
+        # Counts each request's queries on every new database connection
+        from . import metrics  # noqa: F401
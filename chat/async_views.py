@@ -0,0 +1,445 @@
+import asyncio
+import json
+import logging
+import time
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import IntegrityError
+from django.http import JsonResponse, StreamingHttpResponse
+from django.views.decorators.csrf import csrf_exempt
+from openai import RateLimitError
+from .openai_client import get_async_openai_client
+from .idempotency import idempotent
+from .jobs import aenqueue_incoming_message
+from .metrics import profile_user, timing
+from .ratelimit import RateLimitTimeout, retry_after_seconds
+from .models import User, Assistant, SharedAssistant
+from .views import (Database, GPTAssistantManager, ChatCompletionsManager, ChatService, ChatReply, IncompleteResponseError,
+                    TurnRefused, BUSY_RESPONSE, TURN_IN_PROGRESS, USER_NOT_FOUND, shared_assistant_ids,
+                    carry_over_message, chat_response_payload, format_sse, message_text, session_reset,
+                    turn_lease_free)
+
+# Async counterparts of the chat endpoints for running under an ASGI server
+# (e.g. `uvicorn bcfg_chat_api.asgi:application`). LLM calls go through
+# AsyncOpenAI on the event loop, so one worker can hold many in-flight runs.
+# The conversation state machine is shared with the sync views: its database
+# steps run through sync_to_async, the same way Django's async ORM does.
+
+
+class AsyncGPTAssistantManager(GPTAssistantManager):
+    async def initialize_assistant(self, assistant, instructions):
+        gpt_assistant_id = await self.get_shared_assistant_id(instructions)
+        if assistant.gpt_assistant_id != gpt_assistant_id or not assistant.gpt_thread_id:
+            assistant.gpt_assistant_id = gpt_assistant_id
+            if not assistant.gpt_thread_id:
+                assistant.gpt_thread_id = await self.create_thread(assistant)
+            await assistant.asave(update_fields=['gpt_assistant_id', 'gpt_thread_id'])
+        return assistant
+
+    async def create_thread(self, assistant):
+        summary = await self.summarize_previous_session(assistant)
+        if summary:
+            thread = await self.openai_client.beta.threads.create(messages=[carry_over_message(summary)])
+        else:
+            thread = await self.openai_client.beta.threads.create()
+        return thread.id
+
+    async def summarize_previous_session(self, assistant):
+        request = await sync_to_async(self.summary_request)(assistant)
+        if not request:
+            return None
+        estimate = self.summary_estimate(request)
+        try:
+            await self.limiter.aacquire(assistant.user_id, estimate)
+            completion = await self.openai_client.chat.completions.create(**request)
+        except Exception as e:
+            logging.error(f"Could not summarize the last session of user {assistant.user_id}: {e}")
+            return None
+        await sync_to_async(self.record_usage)(assistant, estimate, completion.usage, 'session summary')
+        return completion.choices[0].message.content
+
+    async def get_shared_assistant_id(self, instructions):
+        key = self.shared_assistant_key(instructions)
+        if key not in shared_assistant_ids:
+            instructions_hash, model = key
+            shared = await SharedAssistant.objects.filter(
+                instructions_hash=instructions_hash, model=model).afirst()
+            if not shared:
+                shared = await self.create_shared_assistant(instructions)
+            shared_assistant_ids[key] = shared.gpt_assistant_id
+        return shared_assistant_ids[key]
+
+    async def create_shared_assistant(self, instructions):
+        instructions_hash, model = self.shared_assistant_key(instructions)
+        gpt_assistant = await self.openai_client.beta.assistants.create(
+            name="Assistant",
+            instructions=instructions,
+            model=model,
+        )
+        try:
+            return await SharedAssistant.objects.acreate(
+                instructions_hash=instructions_hash, model=model,
+                gpt_assistant_id=gpt_assistant.id)
+        except IntegrityError:
+            # Another worker created this version first; use theirs
+            await self.openai_client.beta.assistants.delete(gpt_assistant.id)
+            return await SharedAssistant.objects.aget(instructions_hash=instructions_hash, model=model)
+
+    async def generate_gpt_response(self, assistant, message=None):
+        estimate = self.limiter.estimate_tokens(message)
+        queued_at = time.monotonic()
+        for attempt in range(settings.OPENAI_RATE_LIMIT_RETRIES + 1):
+            try:
+                await self.limiter.aacquire(assistant.user_id, estimate)
+                started_at = time.monotonic()
+                return self.timed(await self.run_gpt_response(assistant, message, estimate), queued_at, started_at)
+            except RateLimitError as e:
+                if attempt == settings.OPENAI_RATE_LIMIT_RETRIES:
+                    return ChatReply(self.rate_limit_response(e))
+                await sync_to_async(self.limiter.pause)(retry_after_seconds(e, attempt))
+            except RateLimitTimeout as e:
+                logging.error(f"OpenAI call for user {assistant.user_id} not scheduled: {e}")
+                return ChatReply(BUSY_RESPONSE)
+
+    async def run_gpt_response(self, assistant, message, estimate):
+        run = await self.openai_client.beta.threads.runs.create_and_poll(**self.run_params(assistant, message))
+        await sync_to_async(self.record_usage)(assistant, estimate, run.usage)
+        if run.status == 'completed':
+            page = await self.openai_client.beta.threads.messages.list(
+                thread_id=assistant.gpt_thread_id, run_id=run.id, order='desc', limit=1)
+            assistant_messages = [
+                msg for msg in page.data if msg.role == "assistant"]
+            if assistant_messages:
+                return ChatReply(message_text(assistant_messages[0]), run.id, run.usage)
+            else:
+                logging.error("No assistant messages found in the thread.")
+                return ChatReply("There was an error processing your message.", run.id)
+        else:
+            logging.error(f"Run failed with status: {run.status}")
+            return ChatReply("There was an error processing your message.", run.id)
+
+    async def stream_gpt_response(self, assistant, message=None):
+        estimate = self.limiter.estimate_tokens(message)
+        chunks = []
+        queued_at = time.monotonic()
+        for attempt in range(settings.OPENAI_RATE_LIMIT_RETRIES + 1):
+            try:
+                await self.limiter.aacquire(assistant.user_id, estimate)
+                started_at = time.monotonic()
+                async with self.openai_client.beta.threads.runs.stream(**self.run_params(assistant, message)) as stream:
+                    async for text in stream.text_deltas:
+                        chunks.append(text)
+                        yield text
+                    run = await stream.get_final_run()
+                break
+            except RateLimitError as e:
+                if chunks or attempt == settings.OPENAI_RATE_LIMIT_RETRIES:
+                    response = self.rate_limit_response(e)
+                    if chunks:
+                        raise IncompleteResponseError(response)
+                    yield ChatReply(response)
+                    return
+                await sync_to_async(self.limiter.pause)(retry_after_seconds(e, attempt))
+            except RateLimitTimeout as e:
+                logging.error(f"OpenAI call for user {assistant.user_id} not scheduled: {e}")
+                yield ChatReply(BUSY_RESPONSE)
+                return
+        await sync_to_async(self.record_usage)(assistant, estimate, run.usage)
+        if run.status != 'completed':
+            logging.error(f"Run failed with status: {run.status}")
+            response = "There was an error processing your message."
+            if chunks:
+                raise IncompleteResponseError(response)
+            yield self.timed(ChatReply(response, run.id), queued_at, started_at)
+        else:
+            yield self.timed(ChatReply(''.join(chunks), run.id, run.usage), queued_at, started_at)
+
+
+class AsyncChatCompletionsManager(AsyncGPTAssistantManager, ChatCompletionsManager):
+    # ChatCompletionsManager on AsyncOpenAI; the context is built the same way
+    async def initialize_assistant(self, assistant, instructions):
+        assistant.chat_instructions = instructions
+        return assistant
+
+    async def run_gpt_response(self, assistant, message, estimate):
+        messages = await sync_to_async(self.completion_messages)(assistant, message)
+        completion = await self.openai_client.chat.completions.create(model=self.model, messages=messages)
+        await sync_to_async(self.record_usage)(assistant, estimate, completion.usage, 'completion')
+        return ChatReply(completion.choices[0].message.content or '', completion.id, completion.usage)
+
+    async def stream_gpt_response(self, assistant, message=None):
+        estimate = self.limiter.estimate_tokens(message)
+        messages = await sync_to_async(self.completion_messages)(assistant, message)
+        chunks = []
+        queued_at = time.monotonic()
+        for attempt in range(settings.OPENAI_RATE_LIMIT_RETRIES + 1):
+            try:
+                await self.limiter.aacquire(assistant.user_id, estimate)
+                started_at = time.monotonic()
+                completion_id = usage = None
+                async with await self.openai_client.chat.completions.create(
+                        model=self.model, messages=messages, stream=True,
+                        stream_options={'include_usage': True}) as stream:
+                    async for chunk in stream:
+                        completion_id, usage = chunk.id, chunk.usage or usage
+                        text = chunk.choices[0].delta.content if chunk.choices else None
+                        if text:
+                            chunks.append(text)
+                            yield text
+                break
+            except RateLimitError as e:
+                if chunks or attempt == settings.OPENAI_RATE_LIMIT_RETRIES:
+                    response = self.rate_limit_response(e)
+                    if chunks:
+                        raise IncompleteResponseError(response)
+                    yield ChatReply(response)
+                    return
+                await sync_to_async(self.limiter.pause)(retry_after_seconds(e, attempt))
+            except RateLimitTimeout as e:
+                logging.error(f"OpenAI call for user {assistant.user_id} not scheduled: {e}")
+                yield ChatReply(BUSY_RESPONSE)
+                return
+        await sync_to_async(self.record_usage)(assistant, estimate, usage, 'completion')
+        yield self.timed(ChatReply(''.join(chunks), completion_id, usage), queued_at, started_at)
+
+
+def advance(turn, value):
+    # StopIteration cannot cross sync_to_async, so report completion explicitly
+    try:
+        return False, turn.send(value)
+    except StopIteration as stop:
+        return True, stop.value
+
+
+class AsyncChatService(ChatService):
+    async def process_message_for_chat(self, user_id, message=None):
+        state = await self.prepare_chat(user_id)
+        if not state:
+            return USER_NOT_FOUND
+        return await self.complete_turn(self.chat_turn(state, message))
+
+    async def prepare_chat(self, user_id):
+        profile_user(user_id)
+        state = await sync_to_async(self.db.begin_turn)(user_id)
+        if not state:
+            return None
+        try:
+            await sync_to_async(self.db.check_token_budget)(state.user)
+            instructions = await sync_to_async(self.chat_instructions)(state.user)
+            await self.gpt_manager.initialize_assistant(state.assistant, instructions)
+        except Exception:
+            await sync_to_async(self.db.release_turn)(state.assistant)
+            raise
+        return state
+
+    async def complete_turn(self, turn, reply=None):
+        try:
+            done, result = await sync_to_async(advance)(turn, reply)
+            while not done:
+                assistant, prompt_message = result
+                reply = await self.gpt_manager.generate_gpt_response(
+                    assistant, prompt_message)
+                done, result = await sync_to_async(advance)(turn, reply)
+            return result
+        finally:
+            # Closing the turn releases its lease, which touches the database
+            await sync_to_async(turn.close)()
+
+    async def stream_message_for_chat(self, user_id, message=None):
+        # Async counterpart of ChatService.stream_message_for_chat, yielding the same events
+        try:
+            state = await self.prepare_chat(user_id)
+        except TurnRefused as e:
+            yield 'error', None, e.message
+            return
+        if not state:
+            yield 'done', None, USER_NOT_FOUND
+            return
+        turn = self.chat_turn(state, message)
+        try:
+            index = 0
+            done, result = await sync_to_async(advance)(turn, None)
+            while not done:
+                assistant, prompt_message = result
+                chunks = []
+                reply = None
+                items = self.gpt_manager.stream_gpt_response(assistant, prompt_message)
+                try:
+                    try:
+                        async for item in items:
+                            if isinstance(item, ChatReply):
+                                reply = item
+                                if not chunks and reply.text:
+                                    # Nothing streamed (e.g. an error message); send it whole
+                                    yield 'delta', index, reply.text
+                            else:
+                                chunks.append(item)
+                                yield 'delta', index, item
+                    except IncompleteResponseError as e:
+                        reply = ChatReply(e.response)
+                        yield 'error', index, reply.text
+                except (GeneratorExit, asyncio.CancelledError):
+                    # The client went away mid-turn: let the run finish and record the turn anyway
+                    await asyncio.shield(self.finish_abandoned_turn(turn, reply, chunks, items))
+                    raise
+                index += 1
+                done, result = await sync_to_async(advance)(turn, reply)
+            yield 'done', None, result
+        finally:
+            # Releases the turn lease if a GPT stream failed
+            await asyncio.shield(sync_to_async(turn.close)())
+
+    async def finish_abandoned_turn(self, turn, reply, chunks, items):
+        if reply is None:
+            try:
+                async for item in items:
+                    if isinstance(item, ChatReply):
+                        reply = item
+                        break
+                    chunks.append(item)
+            except IncompleteResponseError as e:
+                reply = ChatReply(e.response)
+            if reply is None:
+                reply = ChatReply(''.join(chunks))
+        await self.complete_turn(turn, reply)
+
+
+async def sse_events(turn_events):
+    # Async counterpart of views.sse_events
+    try:
+        async for event, index, payload in turn_events:
+            if event == 'delta':
+                yield format_sse('delta', {'index': index, 'text': payload})
+            elif event == 'error':
+                yield format_sse('error', {'index': index, 'error': payload})
+            else:
+                yield format_sse('done', chat_response_payload(payload))
+    except Exception as e:
+        logging.error(f"Error streaming chat response: {e}")
+        yield format_sse('error', {'error': 'There was an error processing your message.'})
+    finally:
+        await turn_events.aclose()
+
+
+def get_async_gpt_manager():
+    if settings.CHAT_BACKEND == 'completions':
+        return AsyncChatCompletionsManager(get_async_openai_client())
+    return AsyncGPTAssistantManager(get_async_openai_client())
+
+
+def get_async_chat_service(requests_lib=None):
+    return AsyncChatService(db=Database(), gpt_manager=get_async_gpt_manager(), requests_lib=requests_lib)
+
+
+@csrf_exempt
+@idempotent
+async def incoming_message(request, id=None):
+    if request.method == 'POST':
+        data = json.loads(request.body)
+        context = data.get('context')
+        message = data.get('message')
+
+        service = get_async_chat_service()
+
+        missing_fields = service.check_required_fields(context, message)
+        if missing_fields:
+            return JsonResponse({"error": f"Missing fields: {', '.join(missing_fields)}"}, status=400)
+
+        await aenqueue_incoming_message(id, context, message)
+        return JsonResponse({"status": "received"}, status=202)
+    else:
+        return JsonResponse({'error': 'Invalid request method.'}, status=400)
+
+
+@csrf_exempt
+@idempotent
+async def chat_send_message(request):
+    if request.method == 'POST':
+        data = json.loads(request.body)
+        message = data.get('message')
+        user_id = request.headers.get('X-User-Id')
+        if not user_id:
+            return JsonResponse({'error': 'User not identified.'}, status=400)
+
+        service = get_async_chat_service()
+        try:
+            gpt_response = await service.process_message_for_chat(user_id, message)
+        except TurnRefused as e:
+            return JsonResponse({'error': e.message}, status=e.status)
+        with timing('serialize'):
+            return JsonResponse(chat_response_payload(gpt_response))
+    else:
+        return JsonResponse({'error': 'Invalid request method.'}, status=400)
+
+
+@csrf_exempt
+@idempotent
+async def chat_send_message_stream(request):
+    if request.method == 'POST':
+        data = json.loads(request.body)
+        message = data.get('message')
+        user_id = request.headers.get('X-User-Id')
+        if not user_id:
+            return JsonResponse({'error': 'User not identified.'}, status=400)
+
+        service = get_async_chat_service()
+        response = StreamingHttpResponse(
+            sse_events(service.stream_message_for_chat(user_id, message)),
+            content_type='text/event-stream')
+        # Keep proxies from buffering the stream
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'
+        return response
+    else:
+        return JsonResponse({'error': 'Invalid request method.'}, status=400)
+
+
+@csrf_exempt
+@idempotent
+async def chat_login(request):
+    if request.method == 'POST':
+        data = json.loads(request.body)
+        nickname = data.get('nickname')
+        user_id = data.get('user_id')
+        if not nickname or not user_id:
+            return JsonResponse({'status': 'error', 'error': 'Nickname and User ID are required.'})
+        user, _ = await User.objects.aget_or_create(
+            bcfg_id=str(user_id), defaults={'name': nickname})
+        # Assign random activities if not already assigned
+        await sync_to_async(Database().assign_activities)(user)
+        # Initialize assistant and have it start the conversation
+        service = get_async_chat_service()
+        try:
+            assistant_message = await service.process_message_for_chat(user_id)
+        except TurnRefused as e:
+            return JsonResponse({'status': 'error', 'error': e.message}, status=e.status)
+        return JsonResponse({'status': 'success', 'assistant_message': assistant_message})
+    else:
+        return JsonResponse({'status': 'error', 'error': 'Invalid request method.'})
+
+
+@csrf_exempt
+async def restart_session(request):
+    if request.method == 'POST':
+        user_id = request.headers.get('X-User-Id')
+        if not user_id:
+            return JsonResponse({'error': 'User not identified.'}, status=400)
+
+        # Reset assistant state, unless a turn is still writing to it
+        users = User.objects.filter(bcfg_id=str(user_id))
+        restarted = await Assistant.objects.filter(turn_lease_free(), user__in=users).aupdate(**session_reset())
+        if not restarted:
+            if not await users.aexists():
+                return JsonResponse({'error': 'User not found.'}, status=404)
+            if await Assistant.objects.filter(user__in=users).aexists():
+                return JsonResponse({'error': TURN_IN_PROGRESS}, status=409)
+
+        service = get_async_chat_service()
+        try:
+            assistant_message = await service.process_message_for_chat(user_id)
+        except TurnRefused as e:
+            return JsonResponse({'error': e.message}, status=e.status)
+
+        return JsonResponse({'status': 'success', 'assistant_message': assistant_message})
+    else:
+        return JsonResponse({'error': 'Invalid request method.'}, status=400)
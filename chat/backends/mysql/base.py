@@ -0,0 +1,75 @@
+import functools
+import threading
+from django.conf import settings
+from django.db.backends.mysql import base as mysql
+from ..pool import ConnectionPool, PoolTimeout, offload
+
+# MySQL backend for gevent workers: Django's MySQL backend, with connections
+# drawn from a per-process pool (see chat/backends/pool.py) and every blocking
+# driver call offloaded to a native thread.
+
+pools = {}
+pools_lock = threading.Lock()
+
+
+def get_pool(conn_params):
+    key = tuple(conn_params.get(name) for name in ('host', 'port', 'unix_socket', 'database', 'user'))
+    with pools_lock:
+        if key not in pools:
+            pools[key] = ConnectionPool(settings.DB_POOL_SIZE, settings.DB_POOL_TIMEOUT,
+                                        settings.DB_POOL_RECYCLE)
+        return pools[key]
+
+
+class CursorWrapper(mysql.CursorWrapper):
+    # Results are stored client side by execute(), so fetching doesn't block
+    def execute(self, query, args=None):
+        return offload(super().execute, query, args)
+
+    def executemany(self, query, args):
+        return offload(super().executemany, query, args)
+
+
+class DatabaseWrapper(mysql.DatabaseWrapper):
+    pooled = True
+    pool = None
+    reused_connection = False
+
+    def get_new_connection(self, conn_params):
+        self.pool = get_pool(conn_params)
+        try:
+            connection, self.reused_connection = self.pool.acquire(
+                functools.partial(super().get_new_connection, conn_params))
+        except PoolTimeout as e:
+            raise mysql.Database.OperationalError(str(e))
+        return connection
+
+    def init_connection_state(self):
+        # A connection back from the pool keeps its session settings
+        if not self.reused_connection:
+            super().init_connection_state()
+
+    def create_cursor(self, name=None):
+        return CursorWrapper(self.connection.cursor())
+
+    def _set_autocommit(self, autocommit):
+        if self.connection.get_autocommit() != autocommit:
+            offload(super()._set_autocommit, autocommit)
+
+    def _commit(self):
+        return offload(super()._commit)
+
+    def _rollback(self):
+        return offload(super()._rollback)
+
+    def _close(self):
+        if self.connection is None:
+            return
+        reusable = not self.errors_occurred or offload(self.is_usable)
+        if reusable and (self.in_atomic_block or not self.autocommit):
+            # Never hand an open transaction to the next request
+            try:
+                offload(self.connection.rollback)
+            except mysql.Database.Error:
+                reusable = False
+        self.pool.release(self.connection, reusable)
@@ -0,0 +1,97 @@
+import threading
+import time
+from collections import deque
+from django.db import connection
+
+try:
+    from gevent import get_hub
+    from gevent.monkey import is_module_patched
+except ImportError:
+    get_hub = None
+
+# mysqlclient is a C driver: under gunicorn's gevent workers every query would
+# block the whole worker, not just the greenlet that made it. The pooled MySQL
+# backend (chat.backends.mysql) runs driver calls on gevent's native threadpool
+# and shares a bounded set of connections between a worker's greenlets.
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+def cooperative():
+    # True inside a gevent worker, which monkey-patches threading before loading the app
+    return get_hub is not None and is_module_patched('threading')
+
+
+def offload(func, *args):
+    # Run a blocking driver call on a native thread so the hub keeps serving
+    # other greenlets; outside gevent it is simply called
+    if cooperative():
+        return get_hub().threadpool.apply(func, args)
+    return func(*args)
+
+
+def release_connection():
+    # Give a pooled connection back while the request waits on something slow
+    # (OpenAI); the next query checks one out again. Other backends keep theirs.
+    if getattr(connection, 'pooled', False) and connection.connection is not None \
+            and not connection.in_atomic_block:
+        connection.close()
+
+
+class ConnectionPool:
+    # At most `size` open connections per process. Connections idle for longer
+    # than `recycle` seconds are pinged before reuse, since the server may have
+    # dropped them.
+    def __init__(self, size, timeout, recycle, clock=time.monotonic):
+        self.size = size
+        self.timeout = timeout
+        self.recycle = recycle
+        self.clock = clock
+        self.slots = threading.BoundedSemaphore(size)
+        self.idle = deque()
+        self.lock = threading.Lock()
+        if cooperative():
+            # Let every pooled connection run a query at once
+            threadpool = get_hub().threadpool
+            threadpool.maxsize = max(threadpool.maxsize, size)
+
+    def acquire(self, connect):
+        # Returns (connection, reused)
+        if not self.slots.acquire(timeout=self.timeout):
+            raise PoolTimeout(f"No database connection free after {self.timeout}s")
+        try:
+            while True:
+                with self.lock:
+                    if not self.idle:
+                        break
+                    conn, returned_at = self.idle.pop()
+                if self.clock() - returned_at < self.recycle or self.ping(conn):
+                    return conn, True
+                self.discard(conn)
+            return offload(connect), False
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def release(self, conn, reusable=True):
+        if reusable:
+            with self.lock:
+                self.idle.append((conn, self.clock()))
+        else:
+            self.discard(conn)
+        self.slots.release()
+
+    def ping(self, conn):
+        try:
+            offload(conn.ping)
+        except Exception:
+            return False
+        return True
+
+    def discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
@@ -0,0 +1,36 @@
+from django.conf import settings
+from django.core.cache import cache
+
+# Serialized get_conversation pages per user, tagged with the id of the user's
+# latest transcript. save_transcript drops the user's entry; a worker that
+# missed the drop (a per-process cache) still never serves a page whose tag
+# differs from the id looked up for the request.
+
+
+def conversation_key(bcfg_id):
+    return f"conversation:{bcfg_id}"
+
+
+def get_cached_page(bcfg_id, version, params):
+    entry = cache.get(conversation_key(bcfg_id))
+    if entry and entry['version'] == version:
+        return entry['pages'].get(params)
+    return None
+
+
+def cache_page(bcfg_id, version, params, body):
+    key = conversation_key(bcfg_id)
+    entry = cache.get(key)
+    if not entry or entry['version'] != version:
+        entry = {'version': version, 'pages': {}}
+    pages = entry['pages']
+    pages.pop(params, None)
+    pages[params] = body
+    # Keep the most recently built pages; clients only poll a few
+    while len(pages) > settings.CONVERSATION_CACHE_PAGES:
+        del pages[next(iter(pages))]
+    cache.set(key, entry, settings.CONVERSATION_CACHE_TTL)
+
+
+def invalidate_conversation(bcfg_id):
+    cache.delete(conversation_key(bcfg_id))
@@ -0,0 +1,143 @@
+import logging
+import random
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+from django.utils import timezone
+from .metrics import DELIVERY_FAILURES
+from .models import FailedDelivery
+
+# Delivery of assistant replies to the participant platform. One pooled
+# session and one circuit breaker per worker process, so a degraded platform
+# fails fast instead of tying up every worker on slow retries.
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_delivery_session():
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings.DELIVERY_POOL_SIZE)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                _session = session
+    return _session
+
+
+class DeliveryError(Exception):
+    def __init__(self, error, attempts):
+        super().__init__(error)
+        self.attempts = attempts
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold, reset_timeout, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def is_open(self):
+        with self.lock:
+            return self.opened_at is not None and self.clock() - self.opened_at < self.reset_timeout
+
+    def allow_request(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.clock() - self.opened_at >= self.reset_timeout:
+                # Half-open: let one request through to probe the platform
+                self.opened_at = self.clock()
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = self.clock()
+
+
+participant_breaker = CircuitBreaker(settings.DELIVERY_BREAKER_THRESHOLD,
+                                     settings.DELIVERY_BREAKER_RESET_TIMEOUT)
+
+
+class ParticipantDelivery:
+    def __init__(self, session=None, breaker=None, sleep=time.sleep):
+        self.session = session
+        self.breaker = breaker or participant_breaker
+        self.sleep = sleep
+
+    def send(self, user_id, message):
+        session = self.session or get_delivery_session()
+        url = f"{settings.PARTICIPANT_API_URL}/participant/{user_id}/send"
+        for attempt in range(1, settings.DELIVERY_MAX_ATTEMPTS + 1):
+            if not self.breaker.allow_request():
+                DELIVERY_FAILURES.labels('circuit_open').inc()
+                raise DeliveryError("Participant API circuit is open", attempt - 1)
+            retry_after = None
+            try:
+                response = session.post(
+                    url, json={"message": message},
+                    timeout=(settings.DELIVERY_CONNECT_TIMEOUT, settings.DELIVERY_READ_TIMEOUT))
+            except requests.RequestException as e:
+                error = str(e)
+            else:
+                if response.status_code < 400:
+                    self.breaker.record_success()
+                    return response
+                error = f"HTTP {response.status_code}: {response.text[:500]}"
+                if response.status_code not in RETRY_STATUSES:
+                    # The platform rejected this message; retrying won't help
+                    DELIVERY_FAILURES.labels('attempt').inc()
+                    raise DeliveryError(error, attempt)
+                retry_after = response.headers.get('Retry-After')
+            DELIVERY_FAILURES.labels('attempt').inc()
+            self.breaker.record_failure()
+            if attempt < settings.DELIVERY_MAX_ATTEMPTS:
+                self.sleep(self.backoff(attempt, retry_after))
+        raise DeliveryError(error, settings.DELIVERY_MAX_ATTEMPTS)
+
+    def backoff(self, attempt, retry_after=None):
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), settings.DELIVERY_BACKOFF_MAX)
+        delay = min(settings.DELIVERY_BACKOFF * 2 ** (attempt - 1), settings.DELIVERY_BACKOFF_MAX)
+        return random.uniform(0, delay)
+
+    def deliver(self, user_id, message):
+        try:
+            return self.send(user_id, message)
+        except DeliveryError as e:
+            DELIVERY_FAILURES.labels('dead_letter').inc()
+            logging.error(f"Failed to send GPT response to user {user_id} after {e.attempts} attempts: {e}")
+            FailedDelivery.objects.create(
+                bcfg_id=str(user_id), message=message, error=str(e), attempts=e.attempts)
+            return None
+
+    def redeliver(self, failed):
+        # Retry a dead-lettered message; returns True once it has gone through
+        try:
+            self.send(failed.bcfg_id, failed.message)
+        except DeliveryError as e:
+            failed.error = str(e)
+            failed.attempts += e.attempts
+            failed.save(update_fields=['error', 'attempts'])
+            return False
+        failed.delivered_at = timezone.now()
+        failed.save(update_fields=['delivered_at'])
+        return True
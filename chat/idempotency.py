@@ -0,0 +1,207 @@
+import asyncio
+import functools
+import hashlib
+import json
+import time
+from datetime import timedelta
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.http import HttpResponse, JsonResponse
+from django.utils import timezone
+from .backends.pool import release_connection
+from .models import IdempotencyKey
+
+# Mobile clients and the participant webhook retry on timeout. A POST carrying
+# an Idempotency-Key header runs once: retries with the same key get the stored
+# response, or wait for the first request to finish, instead of another GPT run.
+# Only successful responses are kept, so a failed request can be retried. An
+# in-flight key is leased: if the process serving it dies, a retry takes it
+# over once IDEMPOTENCY_LEASE_SECONDS have passed.
+
+# A retry waiting on its original checks again after 0.25s, 0.5s, 1s... up to
+# every POLL_MAX_INTERVAL, so a long wait costs a couple of dozen queries
+POLL_INTERVAL = 0.25
+POLL_MAX_INTERVAL = 5
+
+
+def request_key(request):
+    key = request.headers.get('Idempotency-Key')
+    if request.method != 'POST' or not key:
+        return None
+    scope = f"{request.path}\n{request.headers.get('X-User-Id', '')}\n{key}"
+    return hashlib.sha256(scope.encode()).hexdigest()
+
+
+def claim(key, request_hash):
+    # Returns (True, None) once this request owns the key, else (False, the
+    # existing record), where the record is None if it was just released
+    now = timezone.now()
+    # Until the response is stored, the key lives only as long as its lease
+    locked_until = now + timedelta(seconds=settings.IDEMPOTENCY_LEASE_SECONDS)
+    try:
+        with transaction.atomic():
+            IdempotencyKey.objects.create(
+                key=key, request_hash=request_hash, locked_until=locked_until, expires_at=locked_until)
+        return True, None
+    except IntegrityError:
+        pass
+    record = IdempotencyKey.objects.filter(key=key).first()
+    if record and (record.expires_at < now or abandoned(record, now)):
+        # Expired, or left in flight by a process that died: start over
+        IdempotencyKey.objects.filter(
+            Q(expires_at__lt=now) | Q(status_code__isnull=True, locked_until__lt=now), id=record.id).delete()
+        return claim(key, request_hash)
+    return False, record
+
+
+def abandoned(record, now):
+    return record.status_code is None and record.locked_until is not None and record.locked_until < now
+
+
+def existing_response(record, request_hash):
+    # The response for a retry of a request that already holds the key, or None to keep waiting
+    if record.request_hash != request_hash:
+        return JsonResponse({'error': 'Idempotency-Key was already used for a different request.'},
+                            status=422)
+    if record.status_code is not None:
+        if record.content_type:
+            response = HttpResponse(record.response, status=record.status_code, content_type=record.content_type)
+        else:
+            response = JsonResponse(record.response, status=record.status_code, safe=False)
+        response['Idempotent-Replayed'] = 'true'
+        return response
+    return None
+
+
+def in_flight_response():
+    response = JsonResponse({'error': 'The original request is still being processed.'}, status=409)
+    response['Retry-After'] = str(POLL_MAX_INTERVAL)
+    return response
+
+
+def poll_delays():
+    delay = POLL_INTERVAL
+    while True:
+        yield delay
+        delay = min(delay * 2, POLL_MAX_INTERVAL)
+
+
+def store(key, status_code, body, content_type=''):
+    IdempotencyKey.objects.filter(key=key).update(
+        status_code=status_code, response=body, content_type=content_type, locked_until=None,
+        expires_at=timezone.now() + timedelta(seconds=settings.IDEMPOTENCY_KEY_TTL))
+
+
+def finish(key, response):
+    # Keeps a successful JSON or streamed response for replay; anything else
+    # releases the key so the request can be retried
+    if response.status_code >= 400:
+        forget(key)
+    elif response.streaming:
+        store_stream = astream_and_store if response.is_async else stream_and_store
+        response.streaming_content = store_stream(
+            key, response.streaming_content, response.status_code, response['Content-Type'])
+    elif response.get('Content-Type') == 'application/json':
+        store(key, response.status_code, json.loads(response.content))
+    else:
+        forget(key)
+    return response
+
+
+# A streamed response keeps its key in flight until the last chunk, then is
+# stored whole. One cut short by the client can't be replayed, so its key is
+# released like a failed request's.
+
+def stream_and_store(key, content, status_code, content_type):
+    chunks = []
+    try:
+        for chunk in content:
+            chunks.append(chunk)
+            yield chunk
+    except BaseException:
+        forget(key)
+        raise
+    store(key, status_code, b''.join(chunks).decode(), content_type)
+
+
+async def astream_and_store(key, content, status_code, content_type):
+    chunks = []
+    try:
+        async for chunk in content:
+            chunks.append(chunk)
+            yield chunk
+    except BaseException:
+        await sync_to_async(forget)(key)
+        raise
+    await sync_to_async(store)(key, status_code, b''.join(chunks).decode(), content_type)
+
+
+def forget(key):
+    IdempotencyKey.objects.filter(key=key).delete()
+
+
+def purge_expired_keys():
+    return IdempotencyKey.objects.filter(expires_at__lt=timezone.now()).delete()[0]
+
+
+def idempotent(view):
+    if asyncio.iscoroutinefunction(view):
+        @functools.wraps(view)
+        async def async_wrapper(request, *args, **kwargs):
+            key = request_key(request)
+            if not key:
+                return await view(request, *args, **kwargs)
+            request_hash = hashlib.sha256(request.body).hexdigest()
+            deadline = time.monotonic() + settings.IDEMPOTENCY_WAIT
+            delays = poll_delays()
+            while True:
+                owned, record = await sync_to_async(claim)(key, request_hash)
+                if owned:
+                    break
+                if record:
+                    response = existing_response(record, request_hash)
+                    if response:
+                        return response
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return in_flight_response()
+                    await asyncio.sleep(min(next(delays), remaining))
+            try:
+                response = await view(request, *args, **kwargs)
+            except BaseException:
+                await sync_to_async(forget)(key)
+                raise
+            return await sync_to_async(finish)(key, response)
+        return async_wrapper
+
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        key = request_key(request)
+        if not key:
+            return view(request, *args, **kwargs)
+        request_hash = hashlib.sha256(request.body).hexdigest()
+        deadline = time.monotonic() + settings.IDEMPOTENCY_WAIT
+        delays = poll_delays()
+        while True:
+            owned, record = claim(key, request_hash)
+            if owned:
+                break
+            if record:
+                response = existing_response(record, request_hash)
+                if response:
+                    return response
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return in_flight_response()
+                # Don't hold a pooled DB connection while waiting
+                release_connection()
+                time.sleep(min(next(delays), remaining))
+        try:
+            response = view(request, *args, **kwargs)
+        except BaseException:
+            forget(key)
+            raise
+        return finish(key, response)
+    return wrapper
@@ -0,0 +1,78 @@
+import logging
+import random
+from datetime import timedelta
+from django.conf import settings
+from django.db.models import F, Min
+from django.utils import timezone
+from .models import IncomingJob
+
+# Database-backed queue for the incoming participant webhook. The webhook only
+# stores a job; `manage.py run_incoming_jobs` claims and processes them.
+
+CLAIM_BATCH = 20
+
+
+def enqueue_incoming_message(bcfg_id, context, message):
+    return IncomingJob.objects.create(
+        bcfg_id=str(bcfg_id), context=context, message=message, run_after=timezone.now())
+
+
+async def aenqueue_incoming_message(bcfg_id, context, message):
+    return await IncomingJob.objects.acreate(
+        bcfg_id=str(bcfg_id), context=context, message=message, run_after=timezone.now())
+
+
+def claim_next_job(worker_id):
+    now = timezone.now()
+    # Only each participant's oldest unfinished job is eligible, so their messages run in order
+    heads = (IncomingJob.objects
+             .filter(status__in=[IncomingJob.PENDING, IncomingJob.RUNNING])
+             .values('bcfg_id').annotate(head=Min('id')).values('head'))
+    candidates = list(IncomingJob.objects
+                      .filter(id__in=heads, status=IncomingJob.PENDING, run_after__lte=now)
+                      .order_by('id').values_list('id', flat=True)[:CLAIM_BATCH])
+    for job_id in candidates:
+        # MariaDB 10.5 has no SKIP LOCKED; the conditional update lets exactly one worker win
+        claimed = IncomingJob.objects.filter(id=job_id, status=IncomingJob.PENDING).update(
+            status=IncomingJob.RUNNING, locked_by=worker_id, locked_at=now,
+            attempts=F('attempts') + 1)
+        if claimed:
+            return IncomingJob.objects.get(id=job_id)
+    return None
+
+
+def finish_job(job):
+    IncomingJob.objects.filter(id=job.id, locked_by=job.locked_by).update(
+        status=IncomingJob.DONE, locked_at=None)
+
+
+def fail_job(job, error):
+    if job.attempts >= settings.INCOMING_JOB_MAX_ATTEMPTS:
+        logging.error(f"Giving up on incoming job {job.id} for user {job.bcfg_id}: {error}")
+        status, run_after = IncomingJob.FAILED, job.run_after
+    else:
+        delay = settings.INCOMING_JOB_RETRY_DELAY * 2 ** (job.attempts - 1)
+        status = IncomingJob.PENDING
+        run_after = timezone.now() + timedelta(seconds=random.uniform(delay / 2, delay))
+    IncomingJob.objects.filter(id=job.id, locked_by=job.locked_by).update(
+        status=status, run_after=run_after, locked_by='', locked_at=None, last_error=str(error))
+
+
+def defer_job(job, seconds):
+    # Put the job back without counting the attempt, e.g. while the user's web chat turn runs
+    IncomingJob.objects.filter(id=job.id, locked_by=job.locked_by).update(
+        status=IncomingJob.PENDING, run_after=timezone.now() + timedelta(seconds=seconds),
+        attempts=F('attempts') - 1, locked_by='', locked_at=None)
+
+
+def release_stale_jobs():
+    # Jobs held by a worker that died go back to the queue once their lease runs out
+    cutoff = timezone.now() - timedelta(seconds=settings.INCOMING_JOB_LEASE_SECONDS)
+    return IncomingJob.objects.filter(status=IncomingJob.RUNNING, locked_at__lt=cutoff).update(
+        status=IncomingJob.PENDING, locked_by='', locked_at=None)
+
+
+def purge_finished_jobs():
+    # Done jobs only matter for a while after the fact; failed ones are kept to be looked into
+    cutoff = timezone.now() - timedelta(days=settings.INCOMING_JOB_RETENTION_DAYS)
+    return IncomingJob.objects.filter(status=IncomingJob.DONE, created_at__lt=cutoff).delete()[0]
@@ -0,0 +1,65 @@
+import math
+from collections import defaultdict
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from chat.models import Transcript
+
+# Fields a group is keyed on; session numbers restart for every user
+GROUPS = {
+    'activity': ('activity__content',),
+    'session': ('user__bcfg_id', 'session_number'),
+    'user': ('user__bcfg_id',),
+    'model': ('model',),
+}
+
+
+def percentile(values, fraction):
+    # Nearest rank, over sorted values
+    if not values:
+        return None
+    return values[max(math.ceil(fraction * len(values)) - 1, 0)]
+
+
+def seconds(value):
+    return '-' if value is None else f"{value:.2f}"
+
+
+class Command(BaseCommand):
+    help = "Report OpenAI latency and tokens per reply, grouped by activity, session, user or model"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--by', choices=sorted(GROUPS), default='activity',
+                            help='What to group replies by')
+        parser.add_argument('--days', type=float, default=7,
+                            help='Only count replies from this many days back')
+
+    def handle(self, *args, **options):
+        since = timezone.now() - timedelta(days=options['days'])
+        # Replies saved before their usage was recorded have no model
+        rows = Transcript.objects.filter(created_at__gte=since).exclude(model='').values_list(
+            *GROUPS[options['by']], 'openai_seconds', 'queue_seconds', 'prompt_tokens', 'completion_tokens')
+
+        groups = defaultdict(lambda: {'latency': [], 'queue': [], 'prompt': 0, 'completion': 0, 'replies': 0})
+        for *key, openai_seconds, queue_seconds, prompt_tokens, completion_tokens in rows.iterator():
+            group = groups[' / '.join('(none)' if part is None else str(part) for part in key)]
+            group['replies'] += 1
+            if openai_seconds is not None:
+                group['latency'].append(openai_seconds)
+            if queue_seconds is not None:
+                group['queue'].append(queue_seconds)
+            group['prompt'] += prompt_tokens or 0
+            group['completion'] += completion_tokens or 0
+
+        self.stdout.write(f"{options['by'][:40]:<40} {'replies':>8} {'p50 s':>7} {'p95 s':>7} {'p95 queue':>9} "
+                          f"{'prompt/reply':>12} {'compl/reply':>11} {'tokens':>10}")
+        for key, group in sorted(groups.items(), key=lambda item: -(item[1]['prompt'] + item[1]['completion'])):
+            latency, queue = sorted(group['latency']), sorted(group['queue'])
+            replies = group['replies']
+            self.stdout.write(
+                f"{key[:40]:<40} {replies:>8} {seconds(percentile(latency, 0.5)):>7} "
+                f"{seconds(percentile(latency, 0.95)):>7} {seconds(percentile(queue, 0.95)):>9} "
+                f"{group['prompt'] // replies:>12} {group['completion'] // replies:>11} "
+                f"{group['prompt'] + group['completion']:>10}")
+        if not groups:
+            self.stdout.write("No replies with recorded usage in this period")
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+from chat.delivery import ParticipantDelivery
+from chat.models import FailedDelivery
+
+
+class Command(BaseCommand):
+    help = "Redeliver dead-lettered replies to the participant platform"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=100,
+                            help='Maximum number of dead letters to retry')
+
+    def handle(self, *args, **options):
+        delivery = ParticipantDelivery()
+        pending = FailedDelivery.objects.filter(delivered_at__isnull=True).order_by('id')
+        delivered = failed = 0
+        for dead_letter in pending[:options['limit']]:
+            if delivery.redeliver(dead_letter):
+                delivered += 1
+            else:
+                failed += 1
+                if delivery.breaker.is_open():
+                    self.stdout.write("Participant API is still unavailable, stopping")
+                    break
+        self.stdout.write(f"Delivered {delivered}, still failing {failed}")
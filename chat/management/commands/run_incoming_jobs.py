@@ -0,0 +1,96 @@
+import logging
+import os
+import signal
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from prometheus_client import start_http_server
+from chat.idempotency import purge_expired_keys
+from chat.jobs import claim_next_job, finish_job, fail_job, defer_job, purge_finished_jobs, release_stale_jobs
+from chat.metrics import metrics_registry
+from chat.ratelimit import OpenAIRateLimiter
+from chat.views import TurnInProgress, get_chat_service
+
+
+def work(worker_id, stop, poll_interval=1.0, once=False):
+    service = get_chat_service()
+    try:
+        while not stop.is_set():
+            job = claim_next_job(worker_id)
+            if job is None:
+                if once:
+                    break
+                stop.wait(poll_interval)
+                continue
+            try:
+                service.process_message_for_api(job.context, job.message, job.bcfg_id)
+            except TurnInProgress:
+                defer_job(job, settings.INCOMING_JOB_RETRY_DELAY)
+            except Exception as e:
+                logging.error(f"Incoming job {job.id} for user {job.bcfg_id} failed: {e}")
+                fail_job(job, e)
+            else:
+                finish_job(job)
+    finally:
+        connection.close()
+
+
+def housekeep(stop, interval):
+    # One thread per process, so the cleanup queries don't run in every worker's idle poll
+    try:
+        while True:
+            try:
+                release_stale_jobs()
+                purge_finished_jobs()
+                purge_expired_keys()
+                OpenAIRateLimiter().purge_idle_buckets()
+            except Exception as e:
+                logging.error(f"Incoming job housekeeping failed: {e}")
+            if stop.wait(interval):
+                break
+    finally:
+        connection.close()
+
+
+class Command(BaseCommand):
+    help = "Process participant messages queued by the incoming webhook"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=settings.INCOMING_JOB_CONCURRENCY,
+                            help='Number of jobs processed at the same time')
+        parser.add_argument('--poll-interval', type=float, default=1.0,
+                            help='Seconds to wait before polling an empty queue again')
+        parser.add_argument('--once', action='store_true',
+                            help='Exit once there is no job ready to run')
+        parser.add_argument('--metrics-port', type=int, default=0,
+                            help='Serve Prometheus metrics (OpenAI calls, deliveries) on this port')
+
+    def handle(self, *args, **options):
+        stop = threading.Event()
+        if threading.current_thread() is threading.main_thread():
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                # Let running jobs finish, then exit
+                signal.signal(sig, lambda *_: stop.set())
+
+        if options['metrics_port']:
+            start_http_server(options['metrics_port'], registry=metrics_registry())
+
+        prefix = f"{socket.gethostname()}:{os.getpid()}"
+        concurrency = options['concurrency']
+        self.stdout.write(f"Processing incoming jobs with concurrency {concurrency}")
+        housekeeper = threading.Thread(
+            target=housekeep, args=(stop, settings.INCOMING_JOB_HOUSEKEEPING_INTERVAL), daemon=True)
+        housekeeper.start()
+        try:
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                workers = [pool.submit(work, f"{prefix}:{n}", stop, options['poll_interval'], options['once'])
+                           for n in range(concurrency)]
+                for worker in workers:
+                    worker.result()
+        finally:
+            # --once ends when the queue is empty; stop the housekeeping with it
+            stop.set()
+            housekeeper.join()
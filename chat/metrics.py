@@ -0,0 +1,270 @@
+import json
+import logging
+import os
+import re
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from inspect import iscoroutinefunction
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.urls import Resolver404, resolve
+from django.utils.decorators import sync_and_async_middleware
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess)
+
+# Prometheus metrics for the web workers and the incoming-job worker. When
+# PROMETHEUS_MULTIPROC_DIR is set (gunicorn.conf.py sets it up), every process
+# writes its samples to files there and a scrape adds them up, so /api/metrics/
+# reports the whole server whichever worker answers it. Under uvicorn with
+# several workers, point PROMETHEUS_MULTIPROC_DIR at an empty directory yourself.
+#
+# The same middleware profiles each request: time in queries, OpenAI calls,
+# rate-limit waits, template rendering and JSON serialization goes into a
+# Server-Timing header (visible in browser devtools), and requests slower than
+# SLOW_REQUEST_SECONDS are logged with their queries and OpenAI calls.
+
+# Chat turns wait on OpenAI, so requests run far past prometheus' default buckets
+REQUEST_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+REQUEST_SECONDS = Histogram(
+    'chat_request_seconds', 'Time to serve a request; streamed responses until their last chunk',
+    ['view', 'method', 'status'], buckets=REQUEST_BUCKETS)
+REQUESTS_IN_PROGRESS = Gauge(
+    'chat_requests_in_progress', 'Requests being served', ['view'], multiprocess_mode='livesum')
+REQUEST_DB_QUERIES = Histogram(
+    'chat_request_db_queries', 'Database queries run by a request', ['view'],
+    buckets=(0, 1, 2, 4, 8, 16, 32, 64, 128))
+REQUEST_DB_SECONDS = Histogram(
+    'chat_request_db_seconds', 'Time a request spent in database queries', ['view'],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5))
+OPENAI_SECONDS = Histogram(
+    'chat_openai_request_seconds', 'OpenAI API calls by operation; streams until their first byte',
+    ['operation', 'status'], buckets=REQUEST_BUCKETS)
+RATE_LIMIT_HITS = Counter(
+    'chat_rate_limit_hits', 'Calls held back or refused by a rate limit or token budget', ['reason'])
+DELIVERY_FAILURES = Counter(
+    'chat_delivery_failures', 'Failed deliveries of replies to the participant platform', ['stage'])
+
+# (method, path under /v1, operation); anything else is counted as 'other'
+OPENAI_OPERATIONS = [
+    ('POST', re.compile(r'/threads'), 'create_thread'),
+    ('POST', re.compile(r'/threads/[^/]+/runs'), 'create_run'),
+    ('GET', re.compile(r'/threads/[^/]+/runs/[^/]+'), 'poll_run'),
+    ('GET', re.compile(r'/threads/[^/]+/messages'), 'list_messages'),
+    ('POST', re.compile(r'/chat/completions'), 'completion'),
+    ('POST', re.compile(r'/assistants'), 'create_assistant'),
+    ('DELETE', re.compile(r'/assistants/[^/]+'), 'delete_assistant'),
+]
+STREAMED_OPERATIONS = {'create_run': 'stream_run', 'completion': 'stream_completion'}
+
+
+def openai_operation(request, stream):
+    path = request.url.path.removeprefix('/v1')
+    for method, pattern, operation in OPENAI_OPERATIONS:
+        if request.method == method and pattern.fullmatch(path):
+            return STREAMED_OPERATIONS.get(operation, operation) if stream else operation
+    return 'other'
+
+
+@dataclass
+class RequestProfile:
+    user: str = ''
+    queries: int = 0
+    # (sql, seconds) of the first SLOW_REQUEST_MAX_QUERIES; parameters are left
+    # out, they carry message text
+    query_log: list = field(default_factory=list)
+    # (operation, status, seconds) of every OpenAI call
+    openai_calls: list = field(default_factory=list)
+    # Server-Timing name -> seconds
+    timings: dict = field(default_factory=dict)
+
+    def add(self, name, seconds):
+        self.timings[name] = self.timings.get(name, 0) + seconds
+
+
+# Set for the length of a request; sync_to_async carries it into the DB threads
+current_profile = ContextVar('current_profile', default=None)
+
+
+def add_timing(name, seconds):
+    profile = current_profile.get()
+    if profile is not None:
+        profile.add(name, seconds)
+
+
+@contextmanager
+def timing(name):
+    started_at = time.monotonic()
+    try:
+        yield
+    finally:
+        add_timing(name, time.monotonic() - started_at)
+
+
+def profile_user(bcfg_id):
+    # Names the user in the slow-request record, for requests that don't send X-User-Id
+    profile = current_profile.get()
+    if profile is not None:
+        profile.user = str(bcfg_id)
+
+
+def observe_openai_call(request, stream, seconds, response):
+    # Called by the OpenAI client's HTTP layer for every request, retries and polls included
+    status = str(response.status_code) if response is not None else 'error'
+    operation = openai_operation(request, stream)
+    OPENAI_SECONDS.labels(operation, status).observe(seconds)
+    profile = current_profile.get()
+    if profile is not None:
+        profile.openai_calls.append((operation, status, seconds))
+        profile.add('openai', seconds)
+
+
+def count_queries(execute, sql, params, many, context):
+    profile = current_profile.get()
+    if profile is None:
+        return execute(sql, params, many, context)
+    started_at = time.monotonic()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        seconds = time.monotonic() - started_at
+        profile.queries += 1
+        profile.add('db', seconds)
+        if len(profile.query_log) < settings.SLOW_REQUEST_MAX_QUERIES:
+            profile.query_log.append((sql, seconds))
+
+
+def instrument_connection(sender, connection, **kwargs):
+    # Connections are per thread and reconnect after close, so wrap each one once
+    if count_queries not in connection.execute_wrappers:
+        connection.execute_wrappers.append(count_queries)
+
+
+def instrument_connections():
+    # Every alias, so reads sent to the replica are timed as well as the
+    # primary's; the signal covers connections opened later in other threads
+    for connection in connections.all():
+        instrument_connection(None, connection)
+
+
+connection_created.connect(instrument_connection)
+
+
+def view_label(request):
+    try:
+        return resolve(request.path_info).view_name
+    except Resolver404:
+        return 'unmatched'
+
+
+def server_timing(profile, total):
+    # e.g. "db;dur=12.5, openai;dur=3120.0, total;dur=3200.1", in milliseconds
+    timings = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in sorted(profile.timings.items())]
+    return ', '.join(timings + [f"total;dur={total * 1000:.1f}"])
+
+
+def slow_request_record(timer, status, seconds):
+    profile = timer.profile
+    return {
+        'endpoint': timer.view,
+        'method': timer.method,
+        'path': timer.path,
+        'status': status,
+        'user': profile.user,
+        'seconds': round(seconds, 3),
+        'timings': {name: round(value, 3) for name, value in sorted(profile.timings.items())},
+        'query_count': profile.queries,
+        'queries': [{'sql': sql, 'seconds': round(value, 4)} for sql, value in profile.query_log],
+        'openai_calls': [{'operation': operation, 'status': call_status, 'seconds': round(value, 3)}
+                         for operation, call_status, value in profile.openai_calls],
+    }
+
+
+class RequestTimer:
+    def __init__(self, request):
+        self.view = view_label(request)
+        self.method = request.method
+        self.path = request.path
+        self.profile = RequestProfile(user=request.headers.get('X-User-Id', ''))
+        current_profile.set(self.profile)
+        instrument_connections()
+        REQUESTS_IN_PROGRESS.labels(self.view).inc()
+        self.started_at = time.monotonic()
+
+    def finish(self, status):
+        current_profile.set(None)
+        seconds = time.monotonic() - self.started_at
+        REQUESTS_IN_PROGRESS.labels(self.view).dec()
+        REQUEST_SECONDS.labels(self.view, self.method, str(status)).observe(seconds)
+        REQUEST_DB_QUERIES.labels(self.view).observe(self.profile.queries)
+        REQUEST_DB_SECONDS.labels(self.view).observe(self.profile.timings.get('db', 0))
+        if settings.SLOW_REQUEST_SECONDS and seconds >= settings.SLOW_REQUEST_SECONDS:
+            logging.warning(f"Slow request: {json.dumps(slow_request_record(self, status, seconds))}")
+
+    def follow(self, response):
+        # Headers go out before a streamed body, so a streamed turn's header only
+        # covers the work done before its first chunk
+        if settings.SERVER_TIMING:
+            response['Server-Timing'] = server_timing(self.profile, time.monotonic() - self.started_at)
+        # A streamed chat turn does its work while the body is sent, so it is
+        # timed (and its queries counted) until the last chunk has gone out
+        if not response.streaming:
+            self.finish(response.status_code)
+        elif response.is_async:
+            response.streaming_content = self.astream(response.streaming_content, response.status_code)
+        else:
+            response.streaming_content = self.stream(response.streaming_content, response.status_code)
+        return response
+
+    def stream(self, content, status):
+        current_profile.set(self.profile)
+        try:
+            yield from content
+        finally:
+            self.finish(status)
+
+    async def astream(self, content, status):
+        current_profile.set(self.profile)
+        try:
+            async for chunk in content:
+                yield chunk
+        finally:
+            self.finish(status)
+
+
+@sync_and_async_middleware
+def metrics_middleware(get_response):
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            timer = RequestTimer(request)
+            try:
+                response = await get_response(request)
+            except BaseException:
+                timer.finish(500)
+                raise
+            return timer.follow(response)
+    else:
+        def middleware(request):
+            timer = RequestTimer(request)
+            try:
+                response = get_response(request)
+            except BaseException:
+                timer.finish(500)
+                raise
+            return timer.follow(response)
+    return middleware
+
+
+def metrics_registry():
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    return REGISTRY
+
+
+def export_metrics():
+    return generate_latest(metrics_registry()), CONTENT_TYPE_LATEST
@@ -0,0 +1,26 @@
+# Generated by Django 5.1.5 on 2026-10-18 11:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0006_activity_priority_prompt_num_activities_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SharedAssistant',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('instructions_hash', models.CharField(max_length=64)),
+                ('model', models.CharField(max_length=100)),
+                ('gpt_assistant_id', models.CharField(max_length=100)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('instructions_hash', 'model'), name='unique_shared_assistant_version')],
+            },
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.1.5 on 2026-10-18 11:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0008_incoming_job'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FailedDelivery',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bcfg_id', models.CharField(max_length=100)),
+                ('message', models.TextField()),
+                ('error', models.TextField()),
+                ('attempts', models.IntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('delivered_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.1.5 on 2026-10-18 11:26
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def remove_duplicate_assistants(apps, schema_editor):
+    # Keep each user's oldest assistant, the one restart_session already picked with .first()
+    Assistant = apps.get_model('chat', 'Assistant')
+    duplicated = (Assistant.objects.values('user').annotate(count=Count('id'))
+                  .filter(count__gt=1).values_list('user', flat=True))
+    for user_id in duplicated:
+        keep = Assistant.objects.filter(user_id=user_id).order_by('id').first()
+        Assistant.objects.filter(user_id=user_id).exclude(id=keep.id).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0011_config_version'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='transcript',
+            index=models.Index(fields=['user', 'session_number', 'id'], name='transcript_user_session'),
+        ),
+        migrations.AddIndex(
+            model_name='useractivity',
+            index=models.Index(fields=['user', 'id'], name='user_activity_user_id'),
+        ),
+        migrations.RunPython(remove_duplicate_assistants, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='assistant',
+            constraint=models.UniqueConstraint(fields=('user',), name='unique_assistant_per_user'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.1.5 on 2026-10-18 11:30
+
+from django.db import migrations, models
+
+
+def fill_activity_plans(apps, schema_editor):
+    Assistant = apps.get_model('chat', 'Assistant')
+    UserActivity = apps.get_model('chat', 'UserActivity')
+    plans = {}
+    for user_activity in UserActivity.objects.select_related('activity').order_by('id'):
+        plans.setdefault(user_activity.user_id, []).append(
+            {'id': user_activity.activity_id, 'content': user_activity.activity.content})
+    for assistant in Assistant.objects.filter(user_id__in=plans):
+        assistant.activity_plan = plans[assistant.user_id]
+        assistant.save(update_fields=['activity_plan'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0012_chat_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='assistant',
+            name='activity_plan',
+            field=models.JSONField(blank=True, default=list),
+        ),
+        migrations.RunPython(fill_activity_plans, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.5 on 2026-10-18 11:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0013_assistant_activity_plan'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='assistant',
+            name='turn_lease',
+            field=models.CharField(blank=True, default='', max_length=32),
+        ),
+        migrations.AddField(
+            model_name='assistant',
+            name='turn_lease_expires',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 5.1.5 on 2026-10-18 11:54
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0015_idempotency_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transcript',
+            name='activity',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='chat.activity'),
+        ),
+        migrations.AddField(
+            model_name='transcript',
+            name='completion_tokens',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='transcript',
+            name='model',
+            field=models.CharField(blank=True, default='', max_length=100),
+        ),
+        migrations.AddField(
+            model_name='transcript',
+            name='openai_seconds',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='transcript',
+            name='prompt_tokens',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='transcript',
+            name='queue_seconds',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='transcript',
+            index=models.Index(fields=['user', 'created_at'], name='transcript_user_created'),
+        ),
+    ]
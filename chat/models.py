@@ -16,6 +16,31 @@ class Assistant(models.Model):
     current_activity_index = models.IntegerField(default=0)
     exchange_count = models.IntegerField(default=0, null=True, blank=True)
     session_count = models.IntegerField(default=1)
+    # The user's activities in order, as [{"id": ..., "content": ...}], fixed at login
+    activity_plan = models.JSONField(default=list, blank=True)
+    # Held while a chat turn runs so each user's sends are handled one at a time;
+    # taken and released with conditional updates, never a row lock
+    turn_lease = models.CharField(max_length=32, blank=True, default='')
+    turn_lease_expires = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user'], name='unique_assistant_per_user'),
+        ]
+
+
+class SharedAssistant(models.Model):
+    # One OpenAI assistant per (instructions, model) version, shared by all users
+    instructions_hash = models.CharField(max_length=64)
+    model = models.CharField(max_length=100)
+    gpt_assistant_id = models.CharField(max_length=100)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['instructions_hash', 'model'], name='unique_shared_assistant_version'),
+        ]
 
 
 class Transcript(models.Model):
@@ -24,6 +49,21 @@ class Transcript(models.Model):
     assistant_message = models.TextField(blank=True, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
     session_number = models.IntegerField(default=1)
+    # What the reply cost: the activity it belongs to, the model, its tokens, and
+    # seconds spent waiting on the rate limiter and on OpenAI
+    activity = models.ForeignKey('Activity', null=True, blank=True, on_delete=models.SET_NULL)
+    model = models.CharField(max_length=100, blank=True, default='')
+    prompt_tokens = models.IntegerField(null=True, blank=True)
+    completion_tokens = models.IntegerField(null=True, blank=True)
+    queue_seconds = models.FloatField(null=True, blank=True)
+    openai_seconds = models.FloatField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'session_number', 'id'], name='transcript_user_session'),
+            # Per-user token budgets sum the last day
+            models.Index(fields=['user', 'created_at'], name='transcript_user_created'),
+        ]
 
 
 class Prompt(models.Model):
@@ -41,3 +81,70 @@ class Activity(models.Model):
 class UserActivity(models.Model):
     user = models.ForeignKey(User, on_delete=models.PROTECT)
     activity = models.ForeignKey(Activity, on_delete=models.PROTECT)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'id'], name='user_activity_user_id'),
+        ]
+
+
+class IncomingJob(models.Model):
+    # A participant message accepted by the incoming webhook, waiting for a worker
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [(PENDING, 'Pending'), (RUNNING, 'Running'), (DONE, 'Done'), (FAILED, 'Failed')]
+
+    bcfg_id = models.CharField(max_length=100)
+    context = models.JSONField()
+    message = models.TextField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.IntegerField(default=0)
+    run_after = models.DateTimeField()
+    locked_by = models.CharField(max_length=100, blank=True)
+    locked_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'bcfg_id'], name='incoming_job_status_bcfg_id'),
+        ]
+
+
+class FailedDelivery(models.Model):
+    # Dead letter for replies the participant platform never accepted
+    bcfg_id = models.CharField(max_length=100)
+    message = models.TextField()
+    error = models.TextField()
+    attempts = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    delivered_at = models.DateTimeField(null=True, blank=True)
+
+
+class RateLimitBucket(models.Model):
+    # Shared OpenAI token bucket, see chat/ratelimit.py
+    name = models.CharField(max_length=100, unique=True)
+    tokens = models.FloatField()
+    updated_at = models.FloatField()
+    blocked_until = models.FloatField(default=0)
+
+
+class ConfigVersion(models.Model):
+    # Single row stamped whenever Prompt or Activity changes, see chat/prompt_cache.py
+    version = models.CharField(max_length=32)
+
+
+class IdempotencyKey(models.Model):
+    # A request made with an Idempotency-Key header and, once it succeeded, the
+    # response replayed to retries; see chat/idempotency.py
+    key = models.CharField(max_length=64, unique=True)
+    request_hash = models.CharField(max_length=64)
+    status_code = models.IntegerField(null=True, blank=True)
+    response = models.JSONField(null=True, blank=True)
+    # Set for a streamed response, stored as its body text; empty for JSON
+    content_type = models.CharField(max_length=100, blank=True, default='')
+    # While the request is in flight; a retry takes the key over once it passes
+    locked_until = models.DateTimeField(null=True, blank=True)
+    expires_at = models.DateTimeField(db_index=True)
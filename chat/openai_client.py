@@ -0,0 +1,93 @@
+import asyncio
+import threading
+import time
+import weakref
+import httpx
+from django.conf import settings
+from openai import OpenAI, AsyncOpenAI, DefaultHttpxClient, DefaultAsyncHttpxClient
+from .metrics import observe_openai_call, openai_operation
+
+# One long-lived OpenAI client per worker process, so chat turns reuse pooled
+# keep-alive connections instead of paying a TLS handshake on every message.
+# Clients are built lazily, after gunicorn has forked the worker.
+
+_client = None
+_client_lock = threading.Lock()
+# httpx async pools are tied to the event loop that opened them
+_async_clients = weakref.WeakKeyDictionary()
+
+# Calls made under OpenAIRateLimiter. A 429 on one of these goes straight back
+# to the limiter, which pauses every worker and retries; the SDK's own retries
+# would hit OpenAI again from this worker before the pause takes effect. The
+# SDK still retries other errors, and 429s on calls that can't be replayed
+# from the limiter (polls, listing the reply).
+LIMITED_OPERATIONS = {'create_run', 'stream_run', 'completion', 'stream_completion'}
+
+
+def leave_rate_limits_to_limiter(request, stream, response):
+    if response.status_code == 429 and openai_operation(request, stream) in LIMITED_OPERATIONS:
+        # The SDK obeys this header over its own retry rules
+        response.headers['x-should-retry'] = 'false'
+    return response
+
+
+class MeteredHttpxClient(DefaultHttpxClient):
+    # Times every HTTP call the SDK makes, so create_and_poll shows up as one
+    # create_run and its poll_run requests
+    def send(self, request, *, stream=False, **kwargs):
+        started_at = time.monotonic()
+        response = None
+        try:
+            response = super().send(request, stream=stream, **kwargs)
+            return leave_rate_limits_to_limiter(request, stream, response)
+        finally:
+            observe_openai_call(request, stream, time.monotonic() - started_at, response)
+
+
+class MeteredAsyncHttpxClient(DefaultAsyncHttpxClient):
+    async def send(self, request, *, stream=False, **kwargs):
+        started_at = time.monotonic()
+        response = None
+        try:
+            response = await super().send(request, stream=stream, **kwargs)
+            return leave_rate_limits_to_limiter(request, stream, response)
+        finally:
+            observe_openai_call(request, stream, time.monotonic() - started_at, response)
+
+
+def openai_client_options():
+    return {
+        'api_key': settings.OPENAI_API_KEY,
+        'timeout': httpx.Timeout(settings.OPENAI_TIMEOUT, connect=settings.OPENAI_CONNECT_TIMEOUT),
+        'max_retries': settings.OPENAI_MAX_RETRIES,
+    }
+
+
+def openai_connection_limits():
+    return httpx.Limits(
+        max_connections=settings.OPENAI_MAX_CONNECTIONS,
+        max_keepalive_connections=settings.OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=settings.OPENAI_KEEPALIVE_EXPIRY,
+    )
+
+
+def get_openai_client():
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = OpenAI(
+                    http_client=MeteredHttpxClient(limits=openai_connection_limits()),
+                    **openai_client_options())
+    return _client
+
+
+def get_async_openai_client():
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = AsyncOpenAI(
+            http_client=MeteredAsyncHttpxClient(limits=openai_connection_limits()),
+            **openai_client_options())
+        _async_clients[loop] = client
+    return client
@@ -0,0 +1,57 @@
+import time
+import uuid
+from dataclasses import dataclass
+from django.conf import settings
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from .models import Prompt, Activity, ConfigVersion
+
+# In-process copy of the Prompt and Activity catalogue. Writes stamp a new
+# ConfigVersion; each worker re-reads the stamp at most every
+# CHAT_CONFIG_CHECK_INTERVAL seconds and reloads when it has changed.
+
+
+@dataclass(frozen=True)
+class PromptConfig:
+    version: str
+    prompt: Prompt
+    activities: tuple
+    checked_at: float
+
+
+_config = None
+
+
+def current_version():
+    return ConfigVersion.objects.filter(pk=1).values_list('version', flat=True).first()
+
+
+def get_prompt_config():
+    # Shared between requests: treat the returned prompt and activities as read-only
+    global _config
+    config = _config
+    now = time.monotonic()
+    if config and now - config.checked_at < settings.CHAT_CONFIG_CHECK_INTERVAL:
+        return config
+    version = current_version()
+    if config and config.version == version:
+        config = PromptConfig(config.version, config.prompt, config.activities, now)
+    else:
+        config = PromptConfig(version, Prompt.objects.first(), tuple(Activity.objects.all()), now)
+    _config = config
+    return config
+
+
+def invalidate_prompt_config():
+    global _config
+    ConfigVersion.objects.update_or_create(pk=1, defaults={'version': uuid.uuid4().hex})
+    _config = None
+
+
+@receiver(post_save, sender=Prompt)
+@receiver(post_delete, sender=Prompt)
+@receiver(post_save, sender=Activity)
+@receiver(post_delete, sender=Activity)
+def prompt_config_changed(sender, **kwargs):
+    # Covers prompt_view, the activity views and the admin alike
+    invalidate_prompt_config()
@@ -0,0 +1,147 @@
+import asyncio
+import logging
+import random
+import time
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from .backends.pool import release_connection
+from .metrics import RATE_LIMIT_HITS, timing
+from .models import RateLimitBucket
+
+# Token buckets for the OpenAI account, kept in the database so every gunicorn
+# worker draws from the same budget. Callers that would overdraw a bucket wait
+# until it refills; the per-user bucket stops one chatty user from starving the
+# rest of a class.
+#
+# There is no admission queue: waiters retry after a jittered sleep, so whoever
+# finds capacity first goes next, not whoever asked first. Fairness comes from
+# the per-user bucket (nobody takes more than OPENAI_USER_REQUESTS_PER_MINUTE
+# however many turns they have in flight) plus the jitter that spreads retries
+# out. A shared FIFO would need its own table and another locked round trip on
+# every call, and reserve() already serializes callers on the bucket rows with
+# select_for_update.
+
+REQUESTS_BUCKET = 'requests'
+TOKENS_BUCKET = 'tokens'
+USER_BUCKET_PREFIX = 'user:'
+
+
+class RateLimitTimeout(Exception):
+    pass
+
+
+def retry_after_seconds(error, attempt):
+    # How long the server asked us to back off, else exponential backoff
+    headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+    for header, scale in (('retry-after-ms', 0.001), ('retry-after', 1)):
+        try:
+            return float(headers[header]) * scale
+        except (KeyError, TypeError, ValueError):
+            pass
+    return min(2 ** attempt, 30)
+
+
+class OpenAIRateLimiter:
+    def __init__(self, clock=time.time, sleep=time.sleep):
+        self.clock = clock
+        self.sleep = sleep
+
+    def estimate_tokens(self, message=None):
+        # Runs resend the thread, so budget a typical run and settle the difference afterwards
+        return settings.OPENAI_RUN_TOKEN_ESTIMATE + len(message or '') // 4
+
+    def limits(self, user_key, tokens):
+        # (bucket name, capacity per minute, cost of this call); a capacity of 0 disables the bucket
+        limits = [
+            (REQUESTS_BUCKET, settings.OPENAI_REQUESTS_PER_MINUTE, 1),
+            (TOKENS_BUCKET, settings.OPENAI_TOKENS_PER_MINUTE, tokens),
+            (f'{USER_BUCKET_PREFIX}{user_key}', settings.OPENAI_USER_REQUESTS_PER_MINUTE, 1),
+        ]
+        return [limit for limit in limits if limit[1] > 0]
+
+    def reserve(self, user_key, tokens):
+        # Take capacity from every bucket at once, or return how long to wait for it
+        limits = self.limits(user_key, tokens)
+        if not limits:
+            return 0
+        now = self.clock()
+        names = [name for name, _, _ in limits]
+        with transaction.atomic():
+            buckets = self.lock_buckets(names)
+            if len(buckets) < len(names):
+                # First use of a bucket: create it full
+                RateLimitBucket.objects.bulk_create(
+                    [RateLimitBucket(name=name, tokens=capacity, updated_at=now)
+                     for name, capacity, _ in limits if name not in buckets], ignore_conflicts=True)
+                buckets = self.lock_buckets(names)
+            wait = 0
+            levels = {}
+            for name, capacity, cost in limits:
+                bucket = buckets[name]
+                level = min(capacity, bucket.tokens + (now - bucket.updated_at) * capacity / 60)
+                # A call larger than the whole bucket still goes through once it is full
+                cost = min(cost, capacity)
+                levels[name] = level - cost
+                wait = max(wait, bucket.blocked_until - now, (cost - level) * 60 / capacity)
+            if wait > 0:
+                return wait
+            for name, level in levels.items():
+                buckets[name].tokens = level
+                buckets[name].updated_at = now
+            RateLimitBucket.objects.bulk_update(buckets.values(), ['tokens', 'updated_at'])
+        return 0
+
+    def lock_buckets(self, names):
+        # Lock in name order so concurrent reservations can't deadlock
+        return {bucket.name: bucket for bucket in
+                RateLimitBucket.objects.select_for_update().filter(name__in=names).order_by('name')}
+
+    def acquire(self, user_key, tokens):
+        deadline = self.clock() + settings.OPENAI_RATE_LIMIT_MAX_WAIT
+        while True:
+            wait = self.reserve(user_key, tokens)
+            if not wait:
+                return
+            if self.clock() + wait > deadline:
+                RATE_LIMIT_HITS.labels('timeout').inc()
+                raise RateLimitTimeout(f"OpenAI budget exhausted for another {wait:.1f}s")
+            RATE_LIMIT_HITS.labels('wait').inc()
+            # Jitter spreads out waiters that were all turned away at the same moment
+            release_connection()
+            with timing('ratelimit'):
+                self.sleep(wait * random.uniform(1, 1.2))
+
+    async def aacquire(self, user_key, tokens):
+        deadline = self.clock() + settings.OPENAI_RATE_LIMIT_MAX_WAIT
+        while True:
+            wait = await sync_to_async(self.reserve)(user_key, tokens)
+            if not wait:
+                return
+            if self.clock() + wait > deadline:
+                RATE_LIMIT_HITS.labels('timeout').inc()
+                raise RateLimitTimeout(f"OpenAI budget exhausted for another {wait:.1f}s")
+            RATE_LIMIT_HITS.labels('wait').inc()
+            with timing('ratelimit'):
+                await asyncio.sleep(wait * random.uniform(1, 1.2))
+
+    def settle(self, estimated_tokens, used_tokens):
+        # Charge (or refund) the difference between the estimate and the run's real usage
+        if settings.OPENAI_TOKENS_PER_MINUTE > 0 and used_tokens is not None:
+            RateLimitBucket.objects.filter(name=TOKENS_BUCKET).update(
+                tokens=F('tokens') - (used_tokens - estimated_tokens))
+
+    def purge_idle_buckets(self):
+        # A user's bucket untouched for a minute has refilled, so dropping it
+        # changes nothing: reserve() recreates it full on their next call
+        return RateLimitBucket.objects.filter(
+            name__startswith=USER_BUCKET_PREFIX, updated_at__lt=self.clock() - 60).delete()[0]
+
+    def pause(self, seconds):
+        # OpenAI told us to back off: hold every worker, not just this one
+        until = self.clock() + seconds
+        RATE_LIMIT_HITS.labels('openai').inc()
+        logging.warning(f"OpenAI rate limited us, pausing calls for {seconds:.1f}s")
+        RateLimitBucket.objects.filter(
+            name__in=[REQUESTS_BUCKET, TOKENS_BUCKET], blocked_until__lt=until).update(blocked_until=until)
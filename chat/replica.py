@@ -0,0 +1,87 @@
+import functools
+import math
+import time
+from contextvars import ContextVar
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.utils.decorators import sync_and_async_middleware
+
+# Optional read replica. Views marked @read_only send their reads to the
+# `replica` database alias when settings.DATABASES has one; everything else,
+# including every read inside a chat turn, stays on the primary. A client that
+# has just written (any POST) keeps reading from the primary for
+# REPLICA_STICKY_SECONDS, so replication lag never hides its own writes.
+#
+# Tests run with the replica as a TEST MIRROR of default; to try the routing
+# locally, add a `replica` entry pointing at a second SQLite file or MariaDB.
+
+REPLICA = 'replica'
+STICKY_COOKIE = 'primary_until'
+
+use_replica = ContextVar('use_replica', default=False)
+
+
+def replica_configured():
+    return REPLICA in settings.DATABASES
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if use_replica.get() and replica_configured():
+            return REPLICA
+        return None
+
+    def db_for_write(self, model, **hints):
+        # Also for instances that were loaded from the replica
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # The replica gets its schema through replication
+        return db != REPLICA
+
+
+def recently_wrote(request):
+    try:
+        return float(request.COOKIES.get(STICKY_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+
+def read_only(view):
+    # Serve the view's GET reads from the replica, unless the client wrote recently
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD') or recently_wrote(request):
+            return view(request, *args, **kwargs)
+        token = use_replica.set(True)
+        try:
+            return view(request, *args, **kwargs)
+        finally:
+            use_replica.reset(token)
+    return wrapper
+
+
+def stick_to_primary(request, response):
+    if request.method not in ('GET', 'HEAD', 'OPTIONS') and replica_configured():
+        # The chat page is embedded cross-site, where only SameSite=None cookies
+        # are sent; behind the load balancer is_secure() relies on SECURE_PROXY_SSL_HEADER
+        secure = request.is_secure()
+        response.set_cookie(
+            STICKY_COOKIE, str(time.time() + settings.REPLICA_STICKY_SECONDS),
+            max_age=math.ceil(settings.REPLICA_STICKY_SECONDS), httponly=True,
+            secure=secure, samesite='None' if secure else 'Lax')
+    return response
+
+
+@sync_and_async_middleware
+def sticky_primary_middleware(get_response):
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            return stick_to_primary(request, await get_response(request))
+    else:
+        def middleware(request):
+            return stick_to_primary(request, get_response(request))
+    return middleware
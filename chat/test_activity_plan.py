@@ -0,0 +1,74 @@
+import json
+from django.db import connection
+from django.test import TestCase, Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from .models import User, Assistant, Prompt, Activity, UserActivity
+from .test_helpers import use_chat_service
+from .test_streaming import FakeGPTManager
+from .views import ChatService, Database, PlannedActivity
+
+
+class ActivityPlanTestCase(TestCase):
+    def setUp(self):
+        Prompt.objects.create(persona="Persona", knowledge="Knowledge",
+                              num_activities=2, num_rounds=2)
+        self.activities = [Activity.objects.create(content=content, priority=priority)
+                           for priority, content in enumerate(["First", "Second", "Third"])]
+        self.service = ChatService(db=Database(), gpt_manager=FakeGPTManager(["Reply"] * 10))
+        use_chat_service(self, self.service)
+
+    def login(self):
+        return Client().post(reverse('chat:login'), data=json.dumps({'nickname': 'Ann', 'user_id': '7'}),
+                             content_type='application/json')
+
+    def test_login_stores_plan_with_one_insert(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.login()
+
+        inserts = [q['sql'] for q in queries if q['sql'].startswith('INSERT INTO "chat_useractivity"')]
+        self.assertEqual(len(inserts), 1)
+        assistant = Assistant.objects.get(user__bcfg_id="7")
+        user_activities = list(UserActivity.objects.filter(user=assistant.user).order_by('id'))
+        self.assertEqual([entry['id'] for entry in assistant.activity_plan],
+                         [ua.activity_id for ua in user_activities])
+        self.assertEqual(len(assistant.activity_plan), 2)
+
+    def test_second_login_keeps_plan(self):
+        self.login()
+        plan = Assistant.objects.get(user__bcfg_id="7").activity_plan
+
+        self.login()
+
+        self.assertEqual(Assistant.objects.get(user__bcfg_id="7").activity_plan, plan)
+        self.assertEqual(UserActivity.objects.count(), 2)
+
+    def test_turn_does_not_read_user_activities(self):
+        self.login()
+        client = Client(headers={'X-User-Id': '7'})
+
+        with CaptureQueriesContext(connection) as queries:
+            client.post(reverse('chat:chat_send_message'), data=json.dumps({'message': 'Hello'}),
+                        content_type='application/json')
+
+        self.assertFalse([q for q in queries if 'chat_useractivity' in q['sql']])
+
+    def test_plan_keeps_text_from_login(self):
+        self.login()
+        planned = Assistant.objects.get(user__bcfg_id="7").activity_plan[0]
+        Activity.objects.filter(id=planned['id']).update(content="Edited")
+
+        state = Database().load_chat_state("7")
+
+        self.assertEqual(state.activities[0], PlannedActivity(planned['id'], planned['content']))
+
+    def test_assistant_without_plan_is_filled_from_user_activities(self):
+        user = User.objects.create(bcfg_id="8", name="Bo")
+        for activity in self.activities[:2]:
+            UserActivity.objects.create(user=user, activity=activity)
+        Assistant.objects.create(user=user)
+
+        state = Database().load_chat_state("8")
+
+        self.assertEqual([a.content for a in state.activities], ["First", "Second"])
+        self.assertEqual(len(Assistant.objects.get(user=user).activity_plan), 2)
@@ -0,0 +1,130 @@
+import json
+from django.test import TestCase, AsyncRequestFactory
+from unittest.mock import AsyncMock, MagicMock, patch
+from . import async_views, views
+from .async_views import AsyncChatService, AsyncGPTAssistantManager
+from .models import Assistant, Transcript, IncomingJob
+from .test_helpers import create_user_with_activities
+from .views import ChatReply, Database
+
+
+class FakeAsyncGPTManager:
+    def __init__(self, replies):
+        self.replies = list(replies)
+        self.prompts = []
+
+    async def initialize_assistant(self, assistant, instructions):
+        if not assistant.gpt_thread_id:
+            assistant.gpt_assistant_id = "assistant_id"
+            assistant.gpt_thread_id = "thread_id"
+            await assistant.asave()
+        return assistant
+
+    async def generate_gpt_response(self, assistant, message=None):
+        self.prompts.append(message)
+        return ChatReply(self.replies.pop(0))
+
+    async def stream_gpt_response(self, assistant, message=None):
+        self.prompts.append(message)
+        reply = self.replies.pop(0)
+        for word in reply.split(" "):
+            yield word + " "
+        yield ChatReply(reply + " ")
+
+
+class AsyncChatServiceTestCase(TestCase):
+    def setUp(self):
+        self.user = create_user_with_activities(num_rounds=1)
+        self.factory = AsyncRequestFactory()
+
+    def service(self, replies):
+        self.gpt_manager = FakeAsyncGPTManager(replies)
+        return AsyncChatService(db=Database(), gpt_manager=self.gpt_manager)
+
+    async def test_transition_returns_both_replies(self):
+        service = self.service(["Hi there", "Nice answer", "Next topic"])
+        opener = await service.process_message_for_chat("42")
+        result = await service.process_message_for_chat("42", "Hello")
+
+        self.assertEqual(opener, "Hi there")
+        self.assertEqual(result, {'multiple_responses': True,
+                                  'responses': ["Nice answer", "Next topic"]})
+        self.assertIn("Transition to the next activity: Second activity",
+                      self.gpt_manager.prompts[-1])
+        assistant = await Assistant.objects.aget(user=self.user)
+        self.assertEqual(assistant.current_activity_index, 1)
+        self.assertEqual(await Transcript.objects.filter(user=self.user).acount(), 3)
+
+    async def test_unknown_user_is_reported(self):
+        result = await self.service([]).process_message_for_chat("missing", "Hello")
+        self.assertEqual(result, {'error': 'User not found. Please log in again.'})
+
+    async def test_stream_yields_deltas_then_done(self):
+        service = self.service(["Hi there", "Nice answer", "Next topic"])
+        await service.process_message_for_chat("42")
+
+        events = [event async for event in service.stream_message_for_chat("42", "Hello")]
+
+        self.assertEqual(events[0], ('delta', 0, "Nice "))
+        self.assertEqual(events[-1][2]['responses'], ["Nice answer ", "Next topic "])
+
+    async def test_send_view_returns_chat_payload(self):
+        service = self.service(["Hi there", "Nice answer", "Next topic"])
+        await service.process_message_for_chat("42")
+        request = self.factory.post('/api/chat/send/', data=json.dumps({'message': 'Hello'}),
+                                    content_type='application/json', headers={'X-User-Id': '42'})
+
+        with patch.object(async_views, 'get_async_chat_service', return_value=service):
+            response = await async_views.chat_send_message(request)
+
+        self.assertEqual(json.loads(response.content), {
+            'multiple_responses': True, 'responses': ["Nice answer", "Next topic"]})
+
+    async def test_incoming_message_rejects_missing_fields(self):
+        request = self.factory.post('/api/participant/7/incoming/',
+                                    data=json.dumps({'context': {'name': 'Ann'}, 'message': 'Hi'}),
+                                    content_type='application/json')
+
+        with patch.object(async_views, 'get_async_chat_service', return_value=self.service([])):
+            response = await async_views.incoming_message(request, id=7)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("week_number", json.loads(response.content)['error'])
+
+    async def test_incoming_message_queues_job(self):
+        context = {"school_name": "Acme University", "school_mascot": "wolverine",
+                   "initial_message": "Starting college", "week_number": 4, "name": "Ann"}
+        request = self.factory.post('/api/participant/7/incoming/',
+                                    data=json.dumps({'context': context, 'message': 'Hi'}),
+                                    content_type='application/json')
+
+        with patch.object(async_views, 'get_async_chat_service', return_value=self.service([])):
+            response = await async_views.incoming_message(request, id=7)
+
+        self.assertEqual(response.status_code, 202)
+        job = await IncomingJob.objects.aget(bcfg_id="7")
+        self.assertEqual((job.context, job.message, job.status), (context, "Hi", IncomingJob.PENDING))
+        self.assertFalse(await Transcript.objects.aexists())
+
+
+class AsyncGPTAssistantManagerTestCase(TestCase):
+    def setUp(self):
+        patcher = patch.dict(views.shared_assistant_ids, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.openai_client = MagicMock()
+        self.openai_client.beta.assistants.create = AsyncMock(return_value=MagicMock(id="asst_1"))
+        self.openai_client.beta.threads.create = AsyncMock(return_value=MagicMock(id="thread_1"))
+        self.manager = AsyncGPTAssistantManager(self.openai_client, model="gpt-4o-mini")
+        self.user = create_user_with_activities(num_rounds=1)
+
+    async def test_initialize_saves_only_the_openai_ids(self):
+        assistant = await Assistant.objects.acreate(user=self.user)
+        # A turn elsewhere moves the conversation on while this copy is stale
+        await Assistant.objects.filter(pk=assistant.pk).aupdate(current_activity_index=1, exchange_count=3)
+
+        await self.manager.initialize_assistant(assistant, "Persona")
+
+        saved = await Assistant.objects.aget(pk=assistant.pk)
+        self.assertEqual((saved.gpt_assistant_id, saved.gpt_thread_id), ("asst_1", "thread_1"))
+        self.assertEqual((saved.current_activity_index, saved.exchange_count), (1, 3))
@@ -0,0 +1,88 @@
+from django.test import TestCase, override_settings
+from unittest.mock import MagicMock, patch
+from . import views
+from .models import Transcript
+from .test_helpers import create_user_with_activities
+from .views import ChatService, ChatCompletionsManager, Database, GPTAssistantManager, get_chat_service
+
+
+def completion(text, completion_id="chatcmpl_1"):
+    return MagicMock(id=completion_id, choices=[MagicMock(message=MagicMock(content=text))],
+                     usage=MagicMock(prompt_tokens=100, completion_tokens=10, total_tokens=110))
+
+
+def completion_stream(*texts):
+    # What the SDK yields with stream_options={'include_usage': True}
+    chunks = [MagicMock(id="chatcmpl_1", usage=None, choices=[MagicMock(delta=MagicMock(content=text))])
+              for text in texts]
+    chunks.append(MagicMock(id="chatcmpl_1", choices=[],
+                            usage=MagicMock(prompt_tokens=100, completion_tokens=10, total_tokens=110)))
+    stream = MagicMock()
+    stream.__enter__.return_value = iter(chunks)
+    return stream
+
+
+class ChatCompletionsManagerTestCase(TestCase):
+    def setUp(self):
+        self.user = create_user_with_activities(num_rounds=1)
+        self.openai_client = MagicMock()
+        self.openai_client.chat.completions.create.side_effect = [
+            completion("Opener"), completion("Answer"), completion("Transition")]
+        self.service = ChatService(db=Database(), gpt_manager=ChatCompletionsManager(self.openai_client))
+
+    def sent_messages(self, call=-1):
+        return self.openai_client.chat.completions.create.call_args_list[call].kwargs['messages']
+
+    def test_turn_makes_one_completion_per_reply_over_our_transcripts(self):
+        self.service.process_message_for_chat("42")
+        result = self.service.process_message_for_chat("42", "Hello")
+
+        self.assertEqual(result['responses'], ["Answer", "Transition"])
+        self.assertEqual(self.openai_client.chat.completions.create.call_count, 3)
+        self.assertFalse(self.openai_client.beta.mock_calls)
+        system, *history, admin = self.sent_messages()
+        self.assertIn("Persona", system['content'])
+        self.assertIn("The user's preferred name is: James", system['content'])
+        self.assertEqual([m['role'] for m in history], ["assistant", "user", "assistant"])
+        self.assertEqual(history[0]['content'], "Opener")
+        self.assertTrue(history[1]['content'].startswith("Hello"))
+        self.assertEqual(history[2]['content'], "Answer")
+        self.assertIn("Transition to the next activity", admin['content'])
+
+    @override_settings(TRANSCRIPT_WRITE_BEHIND=True)
+    def test_context_includes_transcripts_still_buffered_by_the_turn(self):
+        self.service.process_message_for_chat("42")
+        self.service.process_message_for_chat("42", "Hello")
+
+        self.assertEqual(self.sent_messages()[-2], {"role": "assistant", "content": "Answer"})
+
+    @override_settings(CHAT_CONTEXT_TOKENS=10)
+    def test_history_is_trimmed_to_the_token_budget_from_the_oldest(self):
+        Transcript.objects.create(user=self.user, user_message="", assistant_message="x" * 40)
+        Transcript.objects.create(user=self.user, user_message="Recent", assistant_message="Reply")
+        manager = ChatCompletionsManager(self.openai_client)
+        assistant = manager.initialize_assistant(Database().get_or_create_assistant(self.user), "Persona")
+
+        messages = manager.completion_messages(assistant, "Now")
+
+        self.assertEqual([m['content'] for m in messages[1:]], ["Recent", "Reply", "Now"])
+
+    def test_streamed_reply_is_one_streaming_completion(self):
+        self.service.process_message_for_chat("42")
+        self.openai_client.chat.completions.create.side_effect = [completion_stream("Hi ", "there")]
+        state = self.service.prepare_chat("42")
+
+        items = list(self.service.gpt_manager.stream_gpt_response(state.assistant, "Hello"))
+        self.service.db.release_turn(state.assistant)
+
+        self.assertEqual(items[:2], ["Hi ", "there"])
+        self.assertEqual((items[2].text, items[2].run_id, items[2].usage.total_tokens),
+                         ("Hi there", "chatcmpl_1", 110))
+        kwargs = self.openai_client.chat.completions.create.call_args.kwargs
+        self.assertEqual((kwargs['stream'], kwargs['stream_options']), (True, {'include_usage': True}))
+
+    def test_backend_is_chosen_in_settings(self):
+        with patch.object(views, 'get_openai_client'):
+            self.assertIs(type(get_chat_service().gpt_manager), GPTAssistantManager)
+            with override_settings(CHAT_BACKEND='completions'):
+                self.assertIs(type(get_chat_service().gpt_manager), ChatCompletionsManager)
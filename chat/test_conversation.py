@@ -0,0 +1,109 @@
+from django.core.cache import cache
+from django.test import TestCase, Client
+from django.urls import reverse
+from .models import User, Transcript
+from .test_helpers import read_from_primary
+from .views import Database
+
+
+class ConversationPagingTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(bcfg_id="42", name="James")
+        self.transcripts = [
+            Transcript.objects.create(user=self.user, user_message=f"Q{n}", assistant_message=f"A{n}",
+                                      session_number=1 if n < 4 else 2)
+            for n in range(6)]
+        self.client = Client(headers={'X-User-Id': '42'})
+        read_from_primary(self)
+
+    def get(self, **params):
+        return self.client.get(reverse('chat:get_conversation'), params).json()
+
+    def contents(self, data):
+        return [message['content'] for message in data['conversation']]
+
+    def test_latest_page_comes_first_in_chronological_order(self):
+        # The conversation's version, then the page
+        with self.assertNumQueries(2):
+            data = self.get(limit=2)
+
+        self.assertEqual(self.contents(data), ["Q4", "A4", "Q5", "A5"])
+        self.assertEqual((data['first_id'], data['last_id'], data['has_more']),
+                         (self.transcripts[4].id, self.transcripts[5].id, True))
+
+    def test_before_id_pages_back(self):
+        data = self.get(before_id=self.transcripts[2].id, limit=5)
+
+        self.assertEqual(self.contents(data), ["Q0", "A0", "Q1", "A1"])
+        self.assertFalse(data['has_more'])
+
+    def test_since_id_returns_only_newer_messages(self):
+        data = self.get(since_id=self.transcripts[3].id)
+
+        self.assertEqual(self.contents(data), ["Q4", "A4", "Q5", "A5"])
+        self.assertEqual(self.get(since_id=self.transcripts[5].id)['conversation'], [])
+
+    def test_filters_by_session(self):
+        data = self.get(session_number=2)
+
+        self.assertEqual(self.contents(data), ["Q4", "A4", "Q5", "A5"])
+
+    def test_invalid_cursor_is_rejected(self):
+        response = self.client.get(reverse('chat:get_conversation'), {'since_id': 'abc'})
+
+        self.assertEqual(response.status_code, 400)
+
+    def test_limit_below_one_is_rejected(self):
+        for limit in (0, -3):
+            response = self.client.get(reverse('chat:get_conversation'), {'limit': limit})
+
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.json(), {'error': 'limit must be at least 1.'})
+
+    def test_unknown_user_gets_empty_conversation(self):
+        data = Client(headers={'X-User-Id': 'nobody'}).get(reverse('chat:get_conversation')).json()
+
+        self.assertEqual(data['conversation'], [])
+
+    def test_repeat_load_is_served_from_cache_and_revalidates_to_304(self):
+        url = reverse('chat:get_conversation')
+        first = self.client.get(url, {'limit': 2})
+
+        with self.assertNumQueries(1):
+            again = self.client.get(url, {'limit': 2})
+        with self.assertNumQueries(1):
+            revalidated = self.client.get(url, {'limit': 2}, headers={'If-None-Match': first['ETag']})
+
+        self.assertEqual(again.content, first.content)
+        self.assertEqual(revalidated.status_code, 304)
+        self.assertEqual(revalidated['ETag'], first['ETag'])
+
+    def test_saved_transcript_changes_etag_and_content(self):
+        url = reverse('chat:get_conversation')
+        first = self.client.get(url, {'limit': 2})
+
+        Database().save_transcript(self.user, "Q6", "A6", 2)
+        response = self.client.get(url, {'limit': 2}, headers={'If-None-Match': first['ETag']})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], first['ETag'])
+        self.assertEqual(self.contents(response.json()), ["Q5", "A5", "Q6", "A6"])
+
+
+class UserInfoTestCase(TestCase):
+    def setUp(self):
+        read_from_primary(self)
+
+    def test_unchanged_user_info_revalidates_to_304(self):
+        User.objects.create(bcfg_id="42", name="James")
+        client = Client(headers={'X-User-Id': '42'})
+        first = client.get(reverse('chat:get_user_info'))
+
+        self.assertEqual(first.json(), {'user_id': '42', 'nickname': 'James'})
+        revalidated = client.get(reverse('chat:get_user_info'), headers={'If-None-Match': first['ETag']})
+        self.assertEqual(revalidated.status_code, 304)
+
+        User.objects.update(name="Jim")
+        self.assertEqual(client.get(reverse('chat:get_user_info'),
+                                    headers={'If-None-Match': first['ETag']}).status_code, 200)
@@ -0,0 +1,122 @@
+import time
+from unittest import skipUnless
+from unittest.mock import MagicMock, patch
+from django.db import connection, transaction
+from django.test import SimpleTestCase, TransactionTestCase
+from .backends import pool
+from .backends.pool import ConnectionPool, PoolTimeout, offload, release_connection
+from .models import User
+
+try:
+    import gevent
+    from gevent.monkey import get_original
+except ImportError:
+    gevent = None
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class ConnectionPoolTestCase(SimpleTestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.pool = ConnectionPool(size=2, timeout=0.01, recycle=300, clock=self.clock)
+
+    def test_released_connection_is_reused(self):
+        first, reused = self.pool.acquire(MagicMock)
+        self.assertFalse(reused)
+        self.pool.release(first)
+
+        again, reused = self.pool.acquire(MagicMock)
+
+        self.assertIs(again, first)
+        self.assertTrue(reused)
+
+    def test_checkout_waits_then_times_out_when_pool_is_exhausted(self):
+        self.pool.acquire(MagicMock)
+        self.pool.acquire(MagicMock)
+
+        with self.assertRaises(PoolTimeout):
+            self.pool.acquire(MagicMock)
+
+    def test_unusable_connection_is_closed_and_frees_its_slot(self):
+        conn, _ = self.pool.acquire(MagicMock)
+        self.pool.acquire(MagicMock)
+
+        self.pool.release(conn, reusable=False)
+
+        conn.close.assert_called_once()
+        replacement, reused = self.pool.acquire(MagicMock)
+        self.assertIsNot(replacement, conn)
+        self.assertFalse(reused)
+
+    def test_long_idle_connection_is_pinged_and_replaced_if_dead(self):
+        conn, _ = self.pool.acquire(MagicMock)
+        conn.ping.side_effect = OSError("server has gone away")
+        self.pool.release(conn)
+        self.clock.now = 301
+
+        replacement, reused = self.pool.acquire(MagicMock)
+
+        conn.close.assert_called_once()
+        self.assertIsNot(replacement, conn)
+        self.assertFalse(reused)
+
+    def test_release_connection_only_closes_pooled_connections_outside_transactions(self):
+        for pooled, in_atomic_block, closed in [(True, False, True), (True, True, False), (False, False, False)]:
+            db = MagicMock(pooled=pooled, in_atomic_block=in_atomic_block)
+            with patch.object(pool, 'connection', db):
+                release_connection()
+            self.assertEqual(db.close.called, closed)
+
+
+@skipUnless(gevent, "gevent is not installed")
+class OffloadTestCase(SimpleTestCase):
+    def test_blocking_calls_leave_the_hub_free(self):
+        blocking_sleep = get_original('time', 'sleep')
+        ticks = []
+
+        def ticker():
+            for _ in range(10):
+                ticks.append(time.monotonic())
+                gevent.sleep(0.01)
+
+        with patch.object(pool, 'cooperative', return_value=True):
+            start = time.monotonic()
+            greenlets = [gevent.spawn(offload, blocking_sleep, 0.1) for _ in range(5)]
+            greenlets.append(gevent.spawn(ticker))
+            gevent.joinall(greenlets, raise_error=True)
+            elapsed = time.monotonic() - start
+
+        # Five 0.1s calls ran side by side, and the ticker kept running meanwhile
+        self.assertLess(elapsed, 0.35)
+        self.assertEqual(len(ticks), 10)
+        self.assertLess(max(b - a for a, b in zip(ticks, ticks[1:])), 0.08)
+
+
+class PooledMySQLBackendTestCase(TransactionTestCase):
+    def setUp(self):
+        if not getattr(connection, 'pooled', False):
+            self.skipTest("the database isn't using chat.backends.mysql")
+
+    def test_closed_connection_goes_back_to_pool(self):
+        connection.ensure_connection()
+        raw = connection.connection
+        connection.close()
+
+        connection.ensure_connection()
+
+        self.assertIs(connection.connection, raw)
+
+    def test_open_transaction_is_rolled_back_before_reuse(self):
+        transaction.set_autocommit(False)
+        User.objects.create(bcfg_id="42", name="James")
+        connection.close()
+
+        self.assertFalse(User.objects.exists())
+        self.assertTrue(connection.get_autocommit())
@@ -0,0 +1,81 @@
+import requests
+from django.test import TestCase, override_settings
+from unittest.mock import MagicMock
+from .delivery import CircuitBreaker, ParticipantDelivery
+from .models import FailedDelivery
+
+
+def response(status_code, text="", headers=None):
+    return MagicMock(status_code=status_code, text=text, headers=headers or {})
+
+
+@override_settings(PARTICIPANT_API_URL="http://participants.test/api", DELIVERY_MAX_ATTEMPTS=3)
+class ParticipantDeliveryTestCase(TestCase):
+    def setUp(self):
+        self.session = MagicMock()
+        self.sleeps = []
+        self.now = 0
+        self.breaker = CircuitBreaker(failure_threshold=3, reset_timeout=30, clock=lambda: self.now)
+        self.delivery = ParticipantDelivery(self.session, self.breaker, sleep=self.sleeps.append)
+
+    def test_retries_server_errors_then_delivers(self):
+        self.session.post.side_effect = [response(503), response(200, "ok")]
+
+        self.assertEqual(self.delivery.deliver("7", "Hello").text, "ok")
+
+        self.assertEqual(self.session.post.call_count, 2)
+        args, kwargs = self.session.post.call_args
+        self.assertEqual(args[0], "http://participants.test/api/participant/7/send")
+        self.assertEqual(kwargs['json'], {"message": "Hello"})
+        self.assertIsNotNone(kwargs['timeout'])
+        self.assertEqual(len(self.sleeps), 1)
+        self.assertEqual(self.breaker.failures, 0)
+
+    def test_retry_after_header_sets_the_delay(self):
+        self.session.post.side_effect = [response(429, headers={'Retry-After': '2'}), response(200)]
+
+        self.delivery.deliver("7", "Hello")
+
+        self.assertEqual(self.sleeps, [2.0])
+
+    def test_rejected_message_is_dead_lettered_without_retry(self):
+        self.session.post.return_value = response(400, "bad payload")
+
+        self.assertIsNone(self.delivery.deliver("7", "Hello"))
+
+        self.session.post.assert_called_once()
+        failed = FailedDelivery.objects.get()
+        self.assertEqual((failed.bcfg_id, failed.message, failed.attempts), ("7", "Hello", 1))
+        self.assertIn("bad payload", failed.error)
+
+    def test_exhausted_retries_are_dead_lettered(self):
+        self.session.post.side_effect = requests.ConnectTimeout("timed out")
+
+        self.assertIsNone(self.delivery.deliver("7", "Hello"))
+
+        self.assertEqual(self.session.post.call_count, 3)
+        self.assertEqual(FailedDelivery.objects.get().attempts, 3)
+
+    def test_open_circuit_skips_the_platform_until_reset(self):
+        self.session.post.side_effect = requests.ConnectionError("refused")
+        self.delivery.deliver("7", "first")
+        self.session.post.reset_mock()
+
+        self.assertIsNone(self.delivery.deliver("8", "second"))
+        self.session.post.assert_not_called()
+        self.assertEqual(FailedDelivery.objects.get(bcfg_id="8").attempts, 0)
+
+        self.now += 30
+        self.session.post.side_effect = None
+        self.session.post.return_value = response(200)
+        self.assertIsNotNone(self.delivery.deliver("9", "third"))
+        self.assertFalse(self.breaker.is_open())
+
+    def test_redeliver_marks_dead_letter_delivered(self):
+        failed = FailedDelivery.objects.create(bcfg_id="7", message="Hello", error="HTTP 503", attempts=3)
+        self.session.post.return_value = response(200)
+
+        self.assertTrue(self.delivery.redeliver(failed))
+
+        failed.refresh_from_db()
+        self.assertIsNotNone(failed.delivered_at)
@@ -0,0 +1,185 @@
+from django.test import TestCase, Client, override_settings
+from django.urls import reverse
+from unittest.mock import MagicMock, patch
+from . import views
+from .models import User, Assistant, SharedAssistant, Transcript
+from .test_helpers import create_user_with_activities, use_chat_service
+from .views import ChatService, Database, GPTAssistantManager
+
+
+class GPTAssistantManagerTestCase(TestCase):
+    def setUp(self):
+        patcher = patch.dict(views.shared_assistant_ids, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.openai_client = MagicMock()
+        self.openai_client.beta.assistants.create.side_effect = lambda **kwargs: MagicMock(
+            id=f"asst_{self.openai_client.beta.assistants.create.call_count}")
+        self.openai_client.beta.threads.create.side_effect = lambda: MagicMock(
+            id=f"thread_{self.openai_client.beta.threads.create.call_count}")
+        self.manager = GPTAssistantManager(self.openai_client, model="gpt-4o-mini")
+        self.db = Database()
+
+    def assistant_for(self, bcfg_id, name="James"):
+        return self.db.get_or_create_assistant(User.objects.create(bcfg_id=bcfg_id, name=name))
+
+    def test_users_share_one_assistant_per_prompt_version(self):
+        first = self.manager.initialize_assistant(self.assistant_for("1"), "Persona")
+        second = self.manager.initialize_assistant(self.assistant_for("2"), "Persona")
+
+        self.openai_client.beta.assistants.create.assert_called_once_with(
+            name="Assistant", instructions="Persona", model="gpt-4o-mini")
+        self.assertEqual(first.gpt_assistant_id, second.gpt_assistant_id)
+        self.assertNotEqual(first.gpt_thread_id, second.gpt_thread_id)
+
+    def test_shared_assistant_is_reused_from_database(self):
+        SharedAssistant.objects.create(
+            instructions_hash=self.manager.shared_assistant_key("Persona")[0],
+            model="gpt-4o-mini", gpt_assistant_id="asst_existing")
+
+        assistant = self.manager.initialize_assistant(self.assistant_for("1"), "Persona")
+
+        self.openai_client.beta.assistants.create.assert_not_called()
+        self.assertEqual(assistant.gpt_assistant_id, "asst_existing")
+
+    def test_prompt_edit_moves_user_to_new_version_and_keeps_thread(self):
+        assistant = self.manager.initialize_assistant(self.assistant_for("1"), "Persona")
+        thread_id = assistant.gpt_thread_id
+
+        assistant = self.manager.initialize_assistant(assistant, "Edited persona")
+
+        self.assertEqual(self.openai_client.beta.assistants.create.call_count, 2)
+        self.assertEqual(Assistant.objects.get(pk=assistant.pk).gpt_assistant_id, "asst_2")
+        self.assertEqual(assistant.gpt_thread_id, thread_id)
+
+    def test_preferred_name_is_sent_as_run_instructions(self):
+        assistant = self.manager.initialize_assistant(self.assistant_for("1", "Ann"), "Persona")
+        assistant = self.db.get_or_create_assistant(assistant.user)
+        self.openai_client.beta.threads.runs.create_and_poll.return_value = MagicMock(
+            status='failed', usage=None)
+
+        self.manager.generate_gpt_response(assistant, "Hello")
+
+        kwargs = self.openai_client.beta.threads.runs.create_and_poll.call_args.kwargs
+        self.assertEqual(kwargs['additional_instructions'], "The user's preferred name is: Ann")
+
+
+class ChatTurnCallCountTestCase(TestCase):
+    # Pins the number of OpenAI round trips per assistant turn
+    def setUp(self):
+        patcher = patch.dict(views.shared_assistant_ids, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        create_user_with_activities(num_rounds=1)
+
+        self.openai_client = MagicMock()
+        self.openai_client.beta.assistants.create.return_value.id = "asst_1"
+        self.openai_client.beta.threads.create.return_value.id = "thread_1"
+        self.openai_client.beta.threads.runs.create_and_poll.return_value = MagicMock(
+            id="run_1", status='completed', usage=None)
+        reply = MagicMock(role="assistant", content=[MagicMock(type='text')])
+        reply.content[0].text.value = "Reply"
+        self.openai_client.beta.threads.messages.list.return_value = MagicMock(data=[reply])
+        self.service = ChatService(db=Database(), gpt_manager=GPTAssistantManager(self.openai_client))
+        self.service.process_message_for_chat("42")
+        self.openai_client.reset_mock()
+
+    def test_transition_turn_makes_one_run_and_one_read_per_reply(self):
+        result = self.service.process_message_for_chat("42", "Hello")
+
+        self.assertEqual(result['responses'], ["Reply", "Reply"])
+        threads = self.openai_client.beta.threads
+        threads.messages.create.assert_not_called()
+        self.assertEqual(threads.runs.create_and_poll.call_count, 2)
+        self.assertEqual(threads.messages.list.call_count, 2)
+        user_message, admin_message = [
+            call.kwargs['additional_messages'][0]['content']
+            for call in threads.runs.create_and_poll.call_args_list]
+        self.assertTrue(user_message.startswith("Hello"))
+        self.assertIn("Transition to the next activity: Second activity", admin_message)
+        self.assertEqual(threads.messages.list.call_args.kwargs,
+                         {'thread_id': "thread_1", 'run_id': "run_1", 'order': 'desc', 'limit': 1})
+
+    def test_reply_carries_run_id_and_usage(self):
+        assistant = Assistant.objects.get(user__bcfg_id="42")
+        usage = MagicMock(total_tokens=120)
+        self.openai_client.beta.threads.runs.create_and_poll.return_value.usage = usage
+
+        reply = self.service.gpt_manager.generate_gpt_response(assistant, "Hello")
+
+        self.assertEqual((reply.text, reply.run_id, reply.usage), ("Reply", "run_1", usage))
+
+
+class SessionThreadTestCase(TestCase):
+    # Each session runs on its own thread, optionally seeded with a summary of the last one
+    def setUp(self):
+        patcher = patch.dict(views.shared_assistant_ids, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        create_user_with_activities(num_rounds=2)
+
+        self.openai_client = MagicMock()
+        self.openai_client.beta.assistants.create.return_value.id = "asst_1"
+        self.openai_client.beta.threads.create.side_effect = lambda **kwargs: MagicMock(
+            id=f"thread_{self.openai_client.beta.threads.create.call_count}")
+        self.openai_client.beta.threads.runs.create_and_poll.return_value = MagicMock(
+            id="run_1", status='completed', usage=MagicMock(prompt_tokens=900, completion_tokens=40, total_tokens=940))
+        reply = MagicMock(role="assistant", content=[MagicMock(type='text')])
+        reply.content[0].text.value = "Reply"
+        self.openai_client.beta.threads.messages.list.return_value = MagicMock(data=[reply])
+        self.openai_client.chat.completions.create.return_value = MagicMock(
+            choices=[MagicMock(message=MagicMock(content="James talked about exams."))],
+            usage=MagicMock(prompt_tokens=30, completion_tokens=10, total_tokens=40))
+        self.service = ChatService(db=Database(), gpt_manager=GPTAssistantManager(self.openai_client))
+        self.service.process_message_for_chat("42")
+        self.service.process_message_for_chat("42", "I have exams")
+        use_chat_service(self, self.service)
+
+    def restart(self):
+        response = Client(headers={'X-User-Id': '42'}).post(reverse('chat:restart_session'))
+        self.assertEqual(response.status_code, 200)
+        return Assistant.objects.get(user__bcfg_id="42")
+
+    def test_restart_moves_the_new_session_to_a_new_thread(self):
+        assistant = self.restart()
+
+        self.assertEqual((assistant.session_count, assistant.gpt_thread_id), (2, "thread_2"))
+        self.assertEqual(self.openai_client.beta.threads.create.call_args.kwargs, {})
+        self.openai_client.chat.completions.create.assert_not_called()
+        run = self.openai_client.beta.threads.runs.create_and_poll.call_args.kwargs
+        self.assertEqual(run['thread_id'], "thread_2")
+        self.assertNotIn('truncation_strategy', run)
+        self.assertTrue(Transcript.objects.filter(session_number=2, assistant_message="Reply").exists())
+
+    @override_settings(CHAT_THREAD_PER_SESSION=False)
+    def test_thread_can_be_kept_across_sessions(self):
+        self.assertEqual(self.restart().gpt_thread_id, "thread_1")
+
+    @override_settings(CHAT_SESSION_SUMMARY=True)
+    def test_new_thread_starts_with_summary_of_previous_session(self):
+        self.restart()
+
+        summary_request = self.openai_client.chat.completions.create.call_args.kwargs
+        self.assertEqual(summary_request['messages'][1]['content'],
+                         "Assistant: Reply\nUser: I have exams\nAssistant: Reply")
+        messages = self.openai_client.beta.threads.create.call_args.kwargs['messages']
+        self.assertIn("James talked about exams.", messages[0]['content'])
+
+    @override_settings(CHAT_SESSION_SUMMARY=True)
+    def test_failed_summary_still_starts_the_session(self):
+        self.openai_client.chat.completions.create.side_effect = RuntimeError("unavailable")
+
+        with self.assertLogs(level='ERROR'):
+            assistant = self.restart()
+
+        self.assertEqual(assistant.gpt_thread_id, "thread_2")
+        self.assertEqual(self.openai_client.beta.threads.create.call_args.kwargs, {})
+
+    @override_settings(OPENAI_TRUNCATION_LAST_MESSAGES=12)
+    def test_runs_use_configured_truncation_and_log_input_tokens(self):
+        with self.assertLogs(level='INFO') as logs:
+            self.service.process_message_for_chat("42", "More")
+
+        run = self.openai_client.beta.threads.runs.create_and_poll.call_args.kwargs
+        self.assertEqual(run['truncation_strategy'], {'type': 'last_messages', 'last_messages': 12})
+        self.assertIn("session 1: 900 input tokens", '\n'.join(logs.output))
@@ -0,0 +1,30 @@
+from unittest.mock import patch
+from . import replica, views
+from .models import User, Prompt, Activity, UserActivity
+
+# Fixtures shared by the chat test cases; no tests of their own
+
+
+def create_user_with_activities(num_rounds=1):
+    # User 42 with two activities to work through, num_rounds turns each
+    Prompt.objects.create(persona="Persona", knowledge="Knowledge",
+                          num_activities=2, num_rounds=num_rounds)
+    user = User.objects.create(bcfg_id="42", name="James")
+    for content in ["First activity", "Second activity"]:
+        UserActivity.objects.create(user=user, activity=Activity.objects.create(content=content))
+    return user
+
+
+def use_chat_service(test_case, service):
+    # The views build their own ChatService; hand them the test's for the length of the test
+    patcher = patch.object(views, 'get_chat_service', return_value=service)
+    patcher.start()
+    test_case.addCleanup(patcher.stop)
+
+
+def read_from_primary(test_case):
+    # Keeps @read_only views on the primary, which sees the test's transaction
+    # even when a replica is configured; the routing itself is in test_replica
+    patcher = patch.object(replica, 'replica_configured', return_value=False)
+    patcher.start()
+    test_case.addCleanup(patcher.stop)
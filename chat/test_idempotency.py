@@ -0,0 +1,189 @@
+import hashlib
+import json
+from datetime import timedelta
+from django.test import TestCase, Client, AsyncRequestFactory, RequestFactory, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from unittest.mock import patch
+from . import async_views, idempotency, views
+from .async_views import AsyncChatService
+from .idempotency import purge_expired_keys, request_key
+from .models import Transcript, IncomingJob, IdempotencyKey
+from .test_async_views import FakeAsyncGPTManager
+from .test_helpers import create_user_with_activities, use_chat_service
+from .test_jobs import CONTEXT
+from .test_streaming import FakeGPTManager
+from .views import ChatService, Database
+
+
+class IdempotencyTestCase(TestCase):
+    def setUp(self):
+        self.user = create_user_with_activities(num_rounds=5)
+        self.gpt_manager = FakeGPTManager(["Opener", "First reply", "Second reply"])
+        self.service = ChatService(db=Database(), gpt_manager=self.gpt_manager)
+        self.service.process_message_for_chat("42")
+        self.client = Client(headers={'X-User-Id': '42'})
+        use_chat_service(self, self.service)
+
+    def send(self, key, message='Hello'):
+        return self.client.post(reverse('chat:chat_send_message'), data=json.dumps({'message': message}),
+                                content_type='application/json', headers={'Idempotency-Key': key})
+
+    def test_retry_replays_stored_response(self):
+        first = self.send('abc')
+        retry = self.send('abc')
+
+        self.assertEqual(retry.status_code, 200)
+        self.assertEqual(retry.json(), first.json())
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(len(self.gpt_manager.prompts), 2)
+        self.assertEqual(Transcript.objects.filter(user_message='Hello').count(), 1)
+
+    def test_new_key_runs_again(self):
+        self.send('abc')
+        response = self.send('def')
+
+        self.assertEqual(response.json(), {'response': 'Second reply'})
+        self.assertEqual(Transcript.objects.filter(user_message='Hello').count(), 2)
+
+    def test_key_reused_for_different_request_is_rejected(self):
+        self.send('abc')
+        self.assertEqual(self.send('abc', message='Something else').status_code, 422)
+
+    def in_flight(self, key, lease=timedelta(minutes=1)):
+        # The record left by an original request that hasn't finished yet
+        request = RequestFactory().post(
+            reverse('chat:chat_send_message'), data=json.dumps({'message': 'Hello'}),
+            content_type='application/json', headers={'X-User-Id': '42', 'Idempotency-Key': key})
+        locked_until = timezone.now() + lease
+        return IdempotencyKey.objects.create(
+            key=request_key(request), request_hash=hashlib.sha256(request.body).hexdigest(),
+            locked_until=locked_until, expires_at=locked_until)
+
+    def test_retry_joins_in_flight_request(self):
+        record = self.in_flight('abc')
+        sleeps = []
+
+        def original_finishes_on_third_check(seconds):
+            sleeps.append(seconds)
+            if len(sleeps) == 3:
+                IdempotencyKey.objects.filter(id=record.id).update(
+                    status_code=200, response={'response': 'From the original'})
+
+        with patch.object(idempotency.time, 'sleep', side_effect=original_finishes_on_third_check):
+            response = self.send('abc')
+
+        self.assertEqual(response.json(), {'response': 'From the original'})
+        self.assertEqual(len(self.gpt_manager.prompts), 1)
+        # Checks back off instead of polling at a fixed rate
+        self.assertEqual(sleeps, [0.25, 0.5, 1])
+
+    @override_settings(IDEMPOTENCY_WAIT=0)
+    def test_retry_gives_up_waiting_for_in_flight_request(self):
+        self.in_flight('abc')
+
+        response = self.send('abc')
+
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response['Retry-After'], str(idempotency.POLL_MAX_INTERVAL))
+        self.assertEqual(len(self.gpt_manager.prompts), 1)
+
+    def test_retry_takes_over_key_abandoned_by_a_dead_process(self):
+        self.in_flight('abc', lease=timedelta(seconds=-1))
+
+        self.assertEqual(self.send('abc').json(), {'response': 'First reply'})
+        self.assertEqual(len(self.gpt_manager.prompts), 2)
+
+    def test_key_is_leased_while_in_flight_and_kept_once_stored(self):
+        def check_lease(*args, **kwargs):
+            record = IdempotencyKey.objects.get()
+            self.assertIsNotNone(record.locked_until)
+            self.assertLess(record.expires_at, timezone.now() + timedelta(hours=1))
+            return views.ChatService.process_message_for_chat(self.service, *args, **kwargs)
+
+        with patch.object(self.service, 'process_message_for_chat', side_effect=check_lease):
+            self.send('abc')
+
+        record = IdempotencyKey.objects.get()
+        self.assertIsNone(record.locked_until)
+        self.assertGreater(record.expires_at, timezone.now() + timedelta(hours=23))
+
+    def stream(self, key):
+        return self.client.post(reverse('chat:chat_send_message_stream'), data=json.dumps({'message': 'Hello'}),
+                                content_type='application/json', headers={'Idempotency-Key': key})
+
+    def test_streamed_retry_replays_the_whole_stream(self):
+        body = b''.join(self.stream('abc').streaming_content)
+        retry = self.stream('abc')
+
+        self.assertEqual(retry.content, body)
+        self.assertEqual(retry['Content-Type'], 'text/event-stream')
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertIn(b'event: done', body)
+        self.assertEqual(len(self.gpt_manager.prompts), 2)
+
+    def test_stream_cut_short_releases_its_key(self):
+        response = self.stream('abc')
+        next(iter(response.streaming_content))
+        response.close()
+
+        self.assertFalse(IdempotencyKey.objects.exists())
+
+    def test_failed_request_can_be_retried(self):
+        self.gpt_manager.replies = []
+        with self.assertRaises(IndexError):
+            self.send('abc')
+
+        self.gpt_manager.replies = ["Reply"]
+        self.assertEqual(self.send('abc').json(), {'response': 'Reply'})
+
+    def test_expired_key_runs_again_and_is_purged(self):
+        self.send('abc')
+        IdempotencyKey.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+
+        self.assertEqual(self.send('abc').json(), {'response': 'Second reply'})
+        IdempotencyKey.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(purge_expired_keys(), 1)
+
+    def test_webhook_retry_queues_one_job(self):
+        for _ in range(2):
+            response = Client().post(reverse('chat:incoming_message', args=[7]),
+                                     data=json.dumps({'context': CONTEXT, 'message': 'Hi'}),
+                                     content_type='application/json', headers={'Idempotency-Key': 'msg-1'})
+            self.assertEqual(response.status_code, 202)
+        self.assertEqual(IncomingJob.objects.count(), 1)
+
+    async def test_async_send_retry_replays_stored_response(self):
+        service = AsyncChatService(db=Database(), gpt_manager=FakeAsyncGPTManager(["Async reply"]))
+        factory = AsyncRequestFactory()
+
+        def request():
+            return factory.post('/api/chat/send/', data=json.dumps({'message': 'Hello'}),
+                                content_type='application/json',
+                                headers={'X-User-Id': '42', 'Idempotency-Key': 'abc'})
+
+        with patch.object(async_views, 'get_async_chat_service', return_value=service):
+            first = await async_views.chat_send_message(request())
+            retry = await async_views.chat_send_message(request())
+
+        self.assertEqual(json.loads(retry.content), json.loads(first.content))
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(await Transcript.objects.filter(user_message='Hello').acount(), 1)
+
+    async def test_async_streamed_retry_replays_the_whole_stream(self):
+        service = AsyncChatService(db=Database(), gpt_manager=FakeAsyncGPTManager(["Async reply"]))
+        factory = AsyncRequestFactory()
+
+        def request():
+            return factory.post('/api/chat/send/stream/', data=json.dumps({'message': 'Hello'}),
+                                content_type='application/json',
+                                headers={'X-User-Id': '42', 'Idempotency-Key': 'abc'})
+
+        with patch.object(async_views, 'get_async_chat_service', return_value=service):
+            first = await async_views.chat_send_message_stream(request())
+            body = b''.join([chunk async for chunk in first.streaming_content])
+            retry = await async_views.chat_send_message_stream(request())
+
+        self.assertIn(b'Async reply', body)
+        self.assertEqual(retry.content, body)
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
@@ -0,0 +1,106 @@
+import json
+import threading
+from datetime import timedelta
+from django.test import TestCase, Client, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from unittest.mock import MagicMock, patch
+from .jobs import (enqueue_incoming_message, claim_next_job, finish_job, fail_job, purge_finished_jobs,
+                   release_stale_jobs)
+from .management.commands import run_incoming_jobs
+from .models import IncomingJob, Transcript
+from .test_streaming import FakeGPTManager
+from .views import ChatService, Database
+
+CONTEXT = {"school_name": "Acme University", "school_mascot": "wolverine",
+           "initial_message": "Starting college", "week_number": 4, "name": "Ann"}
+
+
+class IncomingJobQueueTestCase(TestCase):
+    def test_webhook_queues_job_and_returns_202(self):
+        response = Client().post(reverse('chat:incoming_message', args=[7]),
+                                 data=json.dumps({'context': CONTEXT, 'message': 'Hi'}),
+                                 content_type='application/json')
+
+        self.assertEqual(response.status_code, 202)
+        job = IncomingJob.objects.get()
+        self.assertEqual((job.bcfg_id, job.message, job.status), ("7", "Hi", IncomingJob.PENDING))
+        self.assertFalse(Transcript.objects.exists())
+
+    def test_participant_jobs_are_claimed_one_at_a_time_in_order(self):
+        first = enqueue_incoming_message(1, CONTEXT, "first")
+        second = enqueue_incoming_message(1, CONTEXT, "second")
+        other = enqueue_incoming_message(2, CONTEXT, "other")
+
+        self.assertEqual(claim_next_job("w1").id, first.id)
+        self.assertEqual(claim_next_job("w2").id, other.id)
+        self.assertIsNone(claim_next_job("w3"))
+
+        finish_job(IncomingJob.objects.get(id=first.id))
+        job = claim_next_job("w3")
+        self.assertEqual((job.id, job.locked_by, job.attempts), (second.id, "w3", 1))
+
+    @override_settings(INCOMING_JOB_MAX_ATTEMPTS=2)
+    def test_failed_job_is_retried_later_then_given_up(self):
+        enqueue_incoming_message(1, CONTEXT, "Hi")
+
+        fail_job(claim_next_job("w1"), RuntimeError("boom"))
+        job = IncomingJob.objects.get()
+        self.assertEqual((job.status, job.last_error), (IncomingJob.PENDING, "boom"))
+        self.assertGreater(job.run_after, timezone.now())
+        self.assertIsNone(claim_next_job("w1"))
+
+        IncomingJob.objects.update(run_after=timezone.now())
+        fail_job(claim_next_job("w1"), RuntimeError("boom"))
+        self.assertEqual(IncomingJob.objects.get().status, IncomingJob.FAILED)
+
+    def test_stale_running_job_is_released(self):
+        enqueue_incoming_message(1, CONTEXT, "Hi")
+        claim_next_job("dead-worker")
+        IncomingJob.objects.update(locked_at=timezone.now() - timedelta(hours=1))
+
+        self.assertEqual(release_stale_jobs(), 1)
+        self.assertEqual(claim_next_job("w1").attempts, 2)
+
+    @override_settings(INCOMING_JOB_RETENTION_DAYS=7)
+    def test_done_jobs_are_purged_after_the_retention_window(self):
+        for bcfg_id, message in enumerate(["old", "recent", "failed"]):
+            enqueue_incoming_message(bcfg_id, CONTEXT, message)
+        IncomingJob.objects.update(status=IncomingJob.DONE)
+        IncomingJob.objects.filter(message="failed").update(status=IncomingJob.FAILED)
+        IncomingJob.objects.exclude(message="recent").update(created_at=timezone.now() - timedelta(days=8))
+
+        self.assertEqual(purge_finished_jobs(), 1)
+        self.assertEqual(set(IncomingJob.objects.values_list('message', flat=True)), {"recent", "failed"})
+
+    def test_housekeeping_runs_once_per_pass_until_stopped(self):
+        enqueue_incoming_message(1, CONTEXT, "Hi")
+        claim_next_job("dead-worker")
+        IncomingJob.objects.update(locked_at=timezone.now() - timedelta(hours=1))
+        stop = threading.Event()
+        stop.set()
+
+        # housekeep() closes its connection on exit, which would end the test's transaction
+        with patch.object(run_incoming_jobs.connection, 'close'):
+            run_incoming_jobs.housekeep(stop, interval=60)
+
+        self.assertEqual(IncomingJob.objects.get().status, IncomingJob.PENDING)
+
+    def test_worker_replies_and_marks_job_done(self):
+        requests_lib = MagicMock()
+        requests_lib.post.return_value.status_code = 200
+        service = ChatService(db=Database(), gpt_manager=FakeGPTManager(["Hello Ann"]),
+                              requests_lib=requests_lib)
+        enqueue_incoming_message(7, CONTEXT, "Hi")
+
+        # work() closes its connection on exit, which would end the test's transaction
+        with patch.object(run_incoming_jobs, 'get_chat_service', return_value=service), \
+                patch.object(run_incoming_jobs.connection, 'close'):
+            run_incoming_jobs.work("w1", threading.Event(), once=True)
+
+        self.assertEqual(IncomingJob.objects.get().status, IncomingJob.DONE)
+        transcript = Transcript.objects.select_related('user').get(user__bcfg_id="7")
+        self.assertEqual((transcript.user.name, transcript.user_message, transcript.assistant_message),
+                         ("Ann", "Hi", "Hello Ann"))
+        self.assertEqual(requests_lib.post.call_args.kwargs['json'], {"message": "Hello Ann"})
+
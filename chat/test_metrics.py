@@ -0,0 +1,187 @@
+import json
+import httpx
+import requests
+from django.test import SimpleTestCase, TestCase, AsyncClient, Client, override_settings
+from django.db import connections
+from django.urls import reverse
+from openai import OpenAI
+from prometheus_client import REGISTRY
+from unittest.mock import MagicMock
+from .delivery import CircuitBreaker, ParticipantDelivery
+from .metrics import count_queries, observe_openai_call, openai_operation
+from .openai_client import MeteredHttpxClient
+from .test_helpers import create_user_with_activities, read_from_primary, use_chat_service
+from .test_streaming import FakeGPTManager
+from .views import ChatService, Database
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+class RequestMetricsTestCase(TestCase):
+    def setUp(self):
+        self.user = create_user_with_activities(num_rounds=2)
+        self.service = ChatService(db=Database(), gpt_manager=FakeGPTManager(["Opener", "Streamed"]))
+        self.service.process_message_for_chat("42")
+        use_chat_service(self, self.service)
+        read_from_primary(self)
+        self.client = Client(headers={'X-User-Id': '42'})
+
+    def test_request_latency_and_queries_are_recorded_per_view(self):
+        labels = {'view': 'chat:get_user_info'}
+        before = (sample('chat_request_seconds_count', method='GET', status='200', **labels),
+                  sample('chat_request_db_queries_sum', **labels))
+
+        with self.assertNumQueries(1):
+            self.assertEqual(self.client.get(reverse('chat:get_user_info')).status_code, 200)
+
+        self.assertEqual(sample('chat_request_seconds_count', method='GET', status='200', **labels), before[0] + 1)
+        self.assertEqual(sample('chat_request_db_queries_sum', **labels), before[1] + 1)
+
+    def test_streamed_request_is_in_progress_until_its_last_chunk(self):
+        labels = {'view': 'chat:chat_send_message_stream'}
+        in_progress = sample('chat_requests_in_progress', **labels)
+        count = sample('chat_request_seconds_count', method='POST', status='200', **labels)
+
+        response = self.client.post(reverse('chat:chat_send_message_stream'),
+                                    data=json.dumps({'message': 'Hello'}), content_type='application/json')
+
+        self.assertEqual(sample('chat_requests_in_progress', **labels), in_progress + 1)
+        b''.join(response.streaming_content)
+        self.assertEqual(sample('chat_requests_in_progress', **labels), in_progress)
+        self.assertEqual(sample('chat_request_seconds_count', method='POST', status='200', **labels), count + 1)
+        # The turn's reads and writes happen while the body streams
+        self.assertGreater(sample('chat_request_db_queries_sum', **labels), 0)
+
+    async def test_requests_through_asgi_are_recorded(self):
+        labels = {'view': 'chat:health_check', 'method': 'GET', 'status': '200'}
+        count = sample('chat_request_seconds_count', **labels)
+
+        self.assertEqual((await AsyncClient().get(reverse('chat:health_check'))).status_code, 200)
+
+        self.assertEqual(sample('chat_request_seconds_count', **labels), count + 1)
+        self.assertEqual(sample('chat_requests_in_progress', view='chat:health_check'), 0)
+
+    def test_metrics_endpoint_exposes_the_registry(self):
+        self.client.get(reverse('chat:health_check'))
+
+        response = self.client.get(reverse('chat:metrics'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        self.assertIn(b'chat_request_seconds_count{method="GET",status="200",view="chat:health_check"}',
+                      response.content)
+
+
+class RunningGPTManager(FakeGPTManager):
+    # Reports an OpenAI call the way the client's HTTP layer would
+    def generate_gpt_response(self, assistant, message=None):
+        observe_openai_call(httpx.Request('POST', 'https://api.openai.com/v1/threads/thread_1/runs'),
+                            False, 1.5, httpx.Response(200))
+        return super().generate_gpt_response(assistant, message)
+
+
+class ServerTimingTestCase(TestCase):
+    def setUp(self):
+        create_user_with_activities(num_rounds=2)
+        self.service = ChatService(db=Database(), gpt_manager=RunningGPTManager(["Opener", "Reply"]))
+        self.service.process_message_for_chat("42")
+        use_chat_service(self, self.service)
+        read_from_primary(self)
+        self.client = Client(headers={'X-User-Id': '42'})
+
+    def send(self):
+        return self.client.post(reverse('chat:chat_send_message'), data=json.dumps({'message': 'Hello'}),
+                                content_type='application/json')
+
+    def test_response_breaks_down_where_the_time_went(self):
+        timings = dict(entry.split(';dur=') for entry in self.send()['Server-Timing'].split(', '))
+
+        self.assertEqual(set(timings), {'db', 'openai', 'serialize', 'total'})
+        self.assertEqual(float(timings['openai']), 1500.0)
+
+    def test_conversation_page_is_timed(self):
+        timing = self.client.get(reverse('chat:get_conversation'))['Server-Timing']
+        self.assertRegex(timing, r'^db;dur=[\d.]+, serialize;dur=[\d.]+, total;dur=[\d.]+$')
+
+    def test_queries_on_every_database_are_timed(self):
+        self.client.get(reverse('chat:health_check'))
+
+        for connection in connections.all():
+            self.assertIn(count_queries, connection.execute_wrappers, connection.alias)
+
+    @override_settings(SERVER_TIMING=False)
+    def test_header_can_be_turned_off(self):
+        self.assertNotIn('Server-Timing', self.send())
+
+    @override_settings(SLOW_REQUEST_SECONDS=1e-9)
+    def test_slow_request_is_logged_with_its_queries_and_openai_calls(self):
+        with self.assertLogs(level='WARNING') as logs:
+            self.send()
+
+        line = next(line for line in logs.output if 'Slow request: ' in line)
+        record = json.loads(line.split('Slow request: ', 1)[1])
+        self.assertEqual((record['endpoint'], record['method'], record['status'], record['user']),
+                         ('chat:chat_send_message', 'POST', 200, '42'))
+        self.assertEqual(record['openai_calls'], [{'operation': 'create_run', 'status': '200', 'seconds': 1.5}])
+        self.assertEqual(len(record['queries']), record['query_count'])
+        self.assertTrue(any('chat_transcript' in query['sql'] for query in record['queries']))
+        self.assertNotIn('Hello', line)
+
+    @override_settings(SLOW_REQUEST_SECONDS=60)
+    def test_fast_request_is_not_logged(self):
+        with self.assertNoLogs(level='WARNING'):
+            self.send()
+
+
+class OpenAIMetricsTestCase(SimpleTestCase):
+    def test_operations_are_named_from_the_request(self):
+        for method, path, stream, operation in [
+            ('POST', '/v1/threads', False, 'create_thread'),
+            ('POST', '/v1/threads/thread_1/runs', False, 'create_run'),
+            ('POST', '/v1/threads/thread_1/runs', True, 'stream_run'),
+            ('GET', '/v1/threads/thread_1/runs/run_1', False, 'poll_run'),
+            ('GET', '/v1/threads/thread_1/messages', False, 'list_messages'),
+            ('POST', '/v1/chat/completions', True, 'stream_completion'),
+            ('DELETE', '/v1/assistants/asst_1', False, 'delete_assistant'),
+            ('GET', '/v1/models', False, 'other'),
+        ]:
+            request = httpx.Request(method, f"https://api.openai.com{path}")
+            self.assertEqual(openai_operation(request, stream), operation)
+
+    def test_each_sdk_request_is_timed(self):
+        runs = iter(['queued', 'completed'])
+
+        def handler(request):
+            if request.url.path.endswith('/runs'):
+                return httpx.Response(200, json={'id': 'run_1', 'object': 'thread.run', 'status': 'queued'})
+            return httpx.Response(200, json={'id': 'run_1', 'object': 'thread.run', 'status': next(runs)})
+
+        client = OpenAI(api_key="test-key", http_client=MeteredHttpxClient(transport=httpx.MockTransport(handler)))
+        create = sample('chat_openai_request_seconds_count', operation='create_run', status='200')
+        poll = sample('chat_openai_request_seconds_count', operation='poll_run', status='200')
+
+        run = client.beta.threads.runs.create_and_poll(
+            thread_id='thread_1', assistant_id='asst_1', poll_interval_ms=1)
+
+        self.assertEqual(run.status, 'completed')
+        self.assertEqual(sample('chat_openai_request_seconds_count', operation='create_run', status='200'),
+                         create + 1)
+        self.assertEqual(sample('chat_openai_request_seconds_count', operation='poll_run', status='200'), poll + 2)
+
+
+class DeliveryMetricsTestCase(TestCase):
+    def test_failed_attempts_and_dead_letters_are_counted(self):
+        session = MagicMock()
+        session.post.side_effect = requests.ConnectionError("refused")
+        delivery = ParticipantDelivery(session, CircuitBreaker(failure_threshold=10, reset_timeout=30),
+                                       sleep=lambda seconds: None)
+        attempts = sample('chat_delivery_failures_total', stage='attempt')
+        dead_letters = sample('chat_delivery_failures_total', stage='dead_letter')
+
+        with self.settings(DELIVERY_MAX_ATTEMPTS=2):
+            delivery.deliver("7", "Hello")
+
+        self.assertEqual(sample('chat_delivery_failures_total', stage='attempt'), attempts + 2)
+        self.assertEqual(sample('chat_delivery_failures_total', stage='dead_letter'), dead_letters + 1)
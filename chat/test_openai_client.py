@@ -0,0 +1,52 @@
+import httpx
+from django.test import SimpleTestCase, override_settings
+from openai import OpenAI, RateLimitError
+from unittest.mock import patch
+from . import openai_client
+from .openai_client import MeteredHttpxClient
+from .views import get_chat_service
+
+
+@override_settings(OPENAI_API_KEY="test-key", OPENAI_TIMEOUT=30, OPENAI_CONNECT_TIMEOUT=2,
+                   OPENAI_MAX_RETRIES=4, OPENAI_MAX_CONNECTIONS=10)
+class OpenAIClientTestCase(SimpleTestCase):
+    def setUp(self):
+        patcher = patch.object(openai_client, '_client', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_client_is_shared_across_requests(self):
+        first = get_chat_service().gpt_manager.openai_client
+        second = get_chat_service().gpt_manager.openai_client
+        self.assertIs(first, second)
+
+    def test_client_uses_configured_timeouts_and_retries(self):
+        client = openai_client.get_openai_client()
+        self.assertEqual(client.api_key, "test-key")
+        self.assertEqual(client.max_retries, 4)
+        self.assertEqual(client.timeout.read, 30)
+        self.assertEqual(client.timeout.connect, 2)
+        pool = client._client._transport._pool
+        self.assertEqual(pool._max_connections, 10)
+
+
+class RateLimitRetryTestCase(SimpleTestCase):
+    def setUp(self):
+        self.requests = []
+
+        def handler(request):
+            self.requests.append(request.url.path)
+            return httpx.Response(429, headers={'retry-after-ms': '1'}, json={'error': {'message': 'Slow down'}})
+
+        self.client = OpenAI(api_key="test-key", max_retries=2,
+                             http_client=MeteredHttpxClient(transport=httpx.MockTransport(handler)))
+
+    def test_rate_limited_run_goes_back_to_the_limiter_at_once(self):
+        with self.assertRaises(RateLimitError):
+            self.client.beta.threads.runs.create(thread_id='thread_1', assistant_id='asst_1')
+        self.assertEqual(len(self.requests), 1)
+
+    def test_other_calls_keep_the_sdk_retries(self):
+        with self.assertRaises(RateLimitError):
+            self.client.beta.threads.messages.list(thread_id='thread_1')
+        self.assertEqual(len(self.requests), 3)
@@ -0,0 +1,54 @@
+from django.test import TestCase, Client, override_settings
+from django.urls import reverse
+from unittest.mock import patch
+from . import prompt_cache
+from .models import Prompt, Activity, ConfigVersion
+from .prompt_cache import get_prompt_config
+
+
+class PromptConfigCacheTestCase(TestCase):
+    def setUp(self):
+        Prompt.objects.create(id=1, persona="Persona", knowledge="Knowledge")
+        Activity.objects.create(content="First activity")
+
+    def test_config_is_served_from_memory(self):
+        get_prompt_config()
+
+        with self.assertNumQueries(0):
+            config = get_prompt_config()
+        self.assertEqual(config.prompt.persona, "Persona")
+        self.assertEqual([a.content for a in config.activities], ["First activity"])
+
+    @override_settings(CHAT_CONFIG_CHECK_INTERVAL=0)
+    def test_unchanged_version_costs_one_query(self):
+        get_prompt_config()
+
+        with self.assertNumQueries(1):
+            get_prompt_config()
+
+    def test_prompt_view_edit_is_visible_immediately(self):
+        get_prompt_config()
+
+        Client().post(reverse('chat:prompt'), {'persona': "New persona", 'knowledge': "K",
+                                               'num_activities': 2, 'num_rounds': 3})
+
+        self.assertEqual(get_prompt_config().prompt.persona, "New persona")
+
+    @override_settings(CHAT_CONFIG_CHECK_INTERVAL=0)
+    def test_other_workers_reload_after_version_change(self):
+        stale = get_prompt_config()
+        # Another worker adds an activity: only the shared version stamp changes here
+        with patch.object(prompt_cache, 'invalidate_prompt_config'):
+            Activity.objects.create(content="Second activity")
+        ConfigVersion.objects.update(version="edited-elsewhere")
+        prompt_cache._config = stale
+
+        self.assertEqual(len(get_prompt_config().activities), 2)
+
+    def test_activity_delete_invalidates(self):
+        get_prompt_config()
+        activity = Activity.objects.get()
+
+        Client().post(reverse('chat:activity_delete', args=[activity.pk]))
+
+        self.assertEqual(get_prompt_config().activities, ())
@@ -0,0 +1,91 @@
+import json
+from django.core.cache import cache
+from django.test import TestCase, Client
+from django.urls import reverse
+from .prompt_cache import get_prompt_config
+from .ratelimit import OpenAIRateLimiter
+from .test_helpers import create_user_with_activities, read_from_primary, use_chat_service
+from .test_streaming import FakeGPTManager
+from .views import ChatService, Database
+
+
+# Each GPT call reserves and settles its OpenAI budget; in a test's transaction
+# that is a savepoint, the bucket rows, their update, the release and the settle
+LIMITER_QUERIES = 5
+
+
+class LimitedGPTManager(FakeGPTManager):
+    # Goes through the real rate limiter around each reply, as GPTAssistantManager does
+    def __init__(self, replies):
+        super().__init__(replies)
+        self.limiter = OpenAIRateLimiter()
+
+    def generate_gpt_response(self, assistant, message=None):
+        estimate = self.limiter.estimate_tokens(message)
+        self.limiter.acquire(assistant.user_id, estimate)
+        reply = super().generate_gpt_response(assistant, message)
+        self.limiter.settle(estimate, estimate)
+        return reply
+
+    def stream_gpt_response(self, assistant, message=None):
+        estimate = self.limiter.estimate_tokens(message)
+        self.limiter.acquire(assistant.user_id, estimate)
+        yield from super().stream_gpt_response(assistant, message)
+        self.limiter.settle(estimate, estimate)
+
+
+class EndpointQueryBudgetTestCase(TestCase):
+    # Pins the database round trips of each chat endpoint, including the
+    # rate-limiter bookkeeping of its GPT calls
+    def setUp(self):
+        self.user = create_user_with_activities(num_rounds=2)
+        self.gpt_manager = LimitedGPTManager(["Reply"] * 10)
+        self.service = ChatService(db=Database(), gpt_manager=self.gpt_manager)
+        self.service.process_message_for_chat("42")
+        get_prompt_config()
+        self.client = Client(headers={'X-User-Id': '42'})
+        use_chat_service(self, self.service)
+        read_from_primary(self)
+
+    def send(self, name='chat_send_message'):
+        response = self.client.post(reverse(f'chat:{name}'), data=json.dumps({'message': 'Hello'}),
+                                    content_type='application/json')
+        if response.streaming:
+            b''.join(response.streaming_content)
+        return response
+
+    def test_chat_turn(self):
+        # Take the turn lease, load state (assistant+user with its activity plan),
+        # save transcript, save progress and release the lease, plus the GPT call
+        with self.assertNumQueries(4 + LIMITER_QUERIES):
+            self.send()
+
+    def test_chat_turn_with_activity_transition(self):
+        self.send()
+        # Plus the transition reply's transcript and its GPT call
+        with self.assertNumQueries(5 + 2 * LIMITER_QUERIES):
+            self.send()
+
+    def test_streamed_chat_turn(self):
+        with self.assertNumQueries(4 + LIMITER_QUERIES):
+            self.send('chat_send_message_stream')
+
+    def test_login_of_returning_user(self):
+        # User lookup and assistant with its activity plan, then the opening turn
+        with self.assertNumQueries(6 + LIMITER_QUERIES):
+            self.client.post(reverse('chat:login'), data=json.dumps({'nickname': 'James', 'user_id': '42'}),
+                             content_type='application/json')
+
+    def test_restart_session(self):
+        # One UPDATE resets progress and drops the thread, then the opening turn
+        # saves the session's new thread
+        with self.assertNumQueries(6 + LIMITER_QUERIES):
+            self.client.post(reverse('chat:restart_session'))
+
+    def test_get_conversation(self):
+        # The conversation's version and the page; repeat loads come from the cache
+        cache.clear()
+        with self.assertNumQueries(2):
+            self.client.get(reverse('chat:get_conversation'))
+        with self.assertNumQueries(1):
+            self.client.get(reverse('chat:get_conversation'))
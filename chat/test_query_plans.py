@@ -0,0 +1,70 @@
+import json
+import re
+from django.db import IntegrityError, connection
+from django.db.models import Min
+from django.test import TestCase
+from .models import User, Assistant, Transcript, UserActivity, IncomingJob
+
+
+def full_table_scans(queryset):
+    # Tables the database would read in full to answer the queryset
+    if connection.vendor == 'mysql':
+        plan = json.loads(queryset.explain(format='JSON'))
+        scans = []
+
+        def walk(node):
+            if isinstance(node, dict):
+                if node.get('access_type') == 'ALL':
+                    scans.append(node.get('table_name'))
+                for value in node.values():
+                    walk(value)
+            elif isinstance(node, list):
+                for value in node:
+                    walk(value)
+        walk(plan)
+        return scans
+    # SQLite: "SCAN <table>" without an index is a full scan, "SEARCH" is an index lookup
+    return [match.group(1) for match in re.finditer(r'\bSCAN (\w+)(?! USING)', queryset.explain())]
+
+
+class QueryPlanAssertions:
+    def assertIndexed(self, queryset):
+        scans = full_table_scans(queryset)
+        self.assertEqual(scans, [], f"Full table scan on {', '.join(scans)}:\n{queryset.query}")
+
+
+class HotQueryPlanTestCase(QueryPlanAssertions, TestCase):
+    def setUp(self):
+        self.user = User.objects.create(bcfg_id="42", name="James")
+
+    def test_conversation_pages(self):
+        transcripts = Transcript.objects.filter(user__bcfg_id="42")
+        self.assertIndexed(transcripts.order_by('-id').values_list('id', 'user_message')[:51])
+        self.assertIndexed(transcripts.filter(id__gt=10).order_by('id').values_list('id')[:51])
+        self.assertIndexed(transcripts.filter(session_number=2).order_by('-id').values_list('id')[:51])
+
+    def test_user_activities_in_order(self):
+        self.assertIndexed(UserActivity.objects.filter(user=self.user).order_by('id'))
+
+    def test_assistant_by_user(self):
+        self.assertIndexed(Assistant.objects.select_related('user').filter(user=self.user))
+
+    def test_user_by_bcfg_id(self):
+        self.assertIndexed(User.objects.filter(bcfg_id="42"))
+
+    def test_incoming_job_claim(self):
+        heads = (IncomingJob.objects.filter(status__in=[IncomingJob.PENDING, IncomingJob.RUNNING])
+                 .values('bcfg_id').annotate(head=Min('id')).values('head'))
+        self.assertIndexed(IncomingJob.objects.filter(id__in=heads, status=IncomingJob.PENDING).order_by('id'))
+
+    def test_detects_full_scan(self):
+        self.assertEqual(full_table_scans(Transcript.objects.filter(user_message="Hi")), ['chat_transcript'])
+
+
+class AssistantPerUserTestCase(TestCase):
+    def test_second_assistant_for_user_is_rejected(self):
+        user = User.objects.create(bcfg_id="42", name="James")
+        Assistant.objects.create(user=user)
+
+        with self.assertRaises(IntegrityError):
+            Assistant.objects.create(user=user)
@@ -0,0 +1,83 @@
+import httpx
+from django.test import TestCase, override_settings
+from unittest.mock import MagicMock
+from openai import RateLimitError
+from .models import User, Assistant, RateLimitBucket
+from .ratelimit import OpenAIRateLimiter, RateLimitTimeout
+from .views import GPTAssistantManager
+
+
+def rate_limit_error(retry_after):
+    response = httpx.Response(429, headers={'retry-after': retry_after},
+                              request=httpx.Request('POST', 'https://api.openai.test/v1/runs'))
+    return RateLimitError("Rate limit reached", response=response, body={})
+
+
+@override_settings(OPENAI_REQUESTS_PER_MINUTE=3, OPENAI_TOKENS_PER_MINUTE=6000,
+                   OPENAI_USER_REQUESTS_PER_MINUTE=2, OPENAI_RUN_TOKEN_ESTIMATE=1000,
+                   OPENAI_RATE_LIMIT_MAX_WAIT=30, OPENAI_RATE_LIMIT_RETRIES=2)
+class OpenAIRateLimiterTestCase(TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.sleeps = []
+        self.limiter = OpenAIRateLimiter(clock=lambda: self.now, sleep=self.sleep)
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+    def test_user_share_runs_out_before_the_global_budget(self):
+        self.assertEqual(self.limiter.reserve(1, 1000), 0)
+        self.assertEqual(self.limiter.reserve(1, 1000), 0)
+        self.assertAlmostEqual(self.limiter.reserve(1, 1000), 30)
+        self.assertEqual(self.limiter.reserve(2, 1000), 0)
+        # The account-wide request budget is now spent for everyone
+        self.assertAlmostEqual(self.limiter.reserve(3, 1000), 20)
+
+    def test_token_budget_refills_over_time(self):
+        self.assertEqual(self.limiter.reserve(1, 5000), 0)
+        self.assertAlmostEqual(self.limiter.reserve(2, 2000), 10)
+
+        self.now += 10
+        self.assertEqual(self.limiter.reserve(2, 2000), 0)
+
+    def test_settle_charges_real_usage(self):
+        self.limiter.reserve(1, 1000)
+        self.limiter.settle(1000, 5500)
+
+        self.assertEqual(RateLimitBucket.objects.get(name='tokens').tokens, 500)
+
+    def test_idle_user_buckets_are_purged(self):
+        self.limiter.reserve(1, 1000)
+        self.now += 30
+        self.limiter.reserve(2, 1000)
+        self.now += 31
+
+        self.assertEqual(self.limiter.purge_idle_buckets(), 1)
+        self.assertEqual(sorted(RateLimitBucket.objects.values_list('name', flat=True)),
+                         ['requests', 'tokens', 'user:2'])
+
+    def test_acquire_waits_then_gives_up_past_max_wait(self):
+        self.limiter.reserve(1, 6000)
+
+        self.limiter.acquire(2, 3000)
+        self.assertEqual(len(self.sleeps), 1)
+        with self.assertRaises(RateLimitTimeout):
+            self.limiter.acquire(3, 6000)
+
+    def test_rate_limited_run_pauses_every_caller_and_is_retried(self):
+        user = User.objects.create(bcfg_id="42", name="James")
+        assistant = Assistant.objects.create(user=user, gpt_assistant_id="asst_1", gpt_thread_id="thread_1")
+        openai_client = MagicMock()
+        reply = MagicMock(role="assistant", content=[MagicMock(type='text')])
+        reply.content[0].text.value = "Reply"
+        openai_client.beta.threads.messages.list.return_value = MagicMock(data=[reply])
+        openai_client.beta.threads.runs.create_and_poll.side_effect = [
+            rate_limit_error('7'), MagicMock(id="run_1", status='completed', usage=None)]
+        manager = GPTAssistantManager(openai_client, limiter=self.limiter)
+
+        self.assertEqual(manager.generate_gpt_response(assistant, "Hello").text, "Reply")
+
+        self.assertEqual(openai_client.beta.threads.runs.create_and_poll.call_count, 2)
+        self.assertGreaterEqual(sum(self.sleeps), 7)
+        self.assertEqual(RateLimitBucket.objects.get(name='requests').blocked_until, 1007)
@@ -0,0 +1,92 @@
+import time
+from django.core.cache import cache
+from django.db import connections
+from django.http import HttpResponse
+from django.test import SimpleTestCase, TransactionTestCase, Client, RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from unittest.mock import patch
+from . import replica
+from .models import User, Transcript
+from .replica import ReplicaRouter, STICKY_COOKIE, read_only, sticky_primary_middleware
+
+
+class ReplicaRoutingTestCase(SimpleTestCase):
+    def setUp(self):
+        patcher = patch.object(replica, 'replica_configured', return_value=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.factory = RequestFactory()
+
+        @read_only
+        def view(request):
+            router = ReplicaRouter()
+            return HttpResponse(f"{router.db_for_read(User) or 'default'} {router.db_for_write(User)}")
+        self.view = view
+
+    def test_get_reads_from_replica_and_writes_go_to_primary(self):
+        self.assertEqual(self.view(self.factory.get('/')).content, b'replica default')
+
+    def test_post_reads_from_primary(self):
+        self.assertEqual(self.view(self.factory.post('/')).content, b'default default')
+
+    def test_recent_writer_reads_from_primary_until_window_ends(self):
+        request = self.factory.get('/')
+        request.COOKIES[STICKY_COOKIE] = str(time.time() + 5)
+        self.assertEqual(self.view(request).content, b'default default')
+
+        request.COOKIES[STICKY_COOKIE] = str(time.time() - 1)
+        self.assertEqual(self.view(request).content, b'replica default')
+
+    def test_reads_outside_read_only_views_use_primary(self):
+        self.view(self.factory.get('/'))
+        self.assertIsNone(ReplicaRouter().db_for_read(User))
+
+    def test_write_sets_sticky_cookie(self):
+        middleware = sticky_primary_middleware(lambda request: HttpResponse())
+
+        self.assertNotIn(STICKY_COOKIE, middleware(self.factory.get('/')).cookies)
+        cookie = middleware(self.factory.post('/')).cookies[STICKY_COOKIE]
+        self.assertGreater(float(cookie.value), time.time())
+
+    @override_settings(SECURE_PROXY_SSL_HEADER=('HTTP_X_FORWARDED_PROTO', 'https'))
+    def test_sticky_cookie_reaches_the_iframe_behind_the_load_balancer(self):
+        middleware = sticky_primary_middleware(lambda request: HttpResponse())
+
+        cookie = middleware(self.factory.post('/', headers={'X-Forwarded-Proto': 'https'})).cookies[STICKY_COOKIE]
+
+        self.assertEqual((cookie['samesite'], cookie['secure']), ('None', True))
+
+
+class ReplicaDatabaseTestCase(TransactionTestCase):
+    # Needs committed data: a test mirror doesn't see a TestCase's transaction
+    databases = '__all__'
+
+    def setUp(self):
+        if not replica.replica_configured():
+            self.skipTest("no replica database configured")
+        # Transcript ids restart between tests, so a cached page could look current
+        cache.clear()
+        user = User.objects.create(bcfg_id="42", name="James")
+        Transcript.objects.create(user=user, user_message="Q", assistant_message="A")
+        self.client = Client(headers={'X-User-Id': '42'})
+
+    def get_conversation(self):
+        with CaptureQueriesContext(connections['default']) as primary, \
+                CaptureQueriesContext(connections['replica']) as replica_queries:
+            response = self.client.get(reverse('chat:get_conversation'))
+        self.assertEqual(len(response.json()['conversation']), 2)
+        return len(primary), len(replica_queries)
+
+    def test_conversation_is_read_from_replica_except_right_after_a_write(self):
+        # The version lookup and the page
+        self.assertEqual(self.get_conversation(), (0, 2))
+
+        self.client.post(reverse('chat:activity_add'), {'content': 'New activity'})
+
+        # The version lookup, now on the primary; the page itself is cached
+        self.assertEqual(self.get_conversation(), (1, 0))
+
+    def test_replica_reads_show_in_server_timing(self):
+        timing = self.client.get(reverse('chat:get_conversation'))['Server-Timing']
+        self.assertTrue(timing.startswith('db;dur='), timing)
@@ -0,0 +1,105 @@
+import json
+from django.test import TestCase, Client
+from django.urls import reverse
+from unittest.mock import patch
+from .models import Assistant, Transcript, Prompt
+from .test_helpers import create_user_with_activities
+from .views import ChatService, ChatReply, Database, IncompleteResponseError
+
+
+class FakeGPTManager:
+    def __init__(self, replies):
+        self.replies = list(replies)
+        self.prompts = []
+
+    def initialize_assistant(self, assistant, instructions):
+        if not assistant.gpt_thread_id:
+            assistant.gpt_assistant_id = "assistant_id"
+            assistant.gpt_thread_id = "thread_id"
+            assistant.save()
+        return assistant
+
+    def generate_gpt_response(self, assistant, message=None):
+        self.prompts.append(message)
+        return ChatReply(self.replies.pop(0))
+
+    def stream_gpt_response(self, assistant, message=None):
+        self.prompts.append(message)
+        reply = self.replies.pop(0)
+        for word in reply.split(" "):
+            if word == "<fail>":
+                raise IncompleteResponseError("There was an error processing your message.")
+            yield word + " "
+        yield ChatReply(reply + " ")
+
+
+class StreamingChatTestCase(TestCase):
+    def setUp(self):
+        self.user = create_user_with_activities(num_rounds=1)
+
+    def test_stream_yields_deltas_for_each_reply(self):
+        gpt_manager = FakeGPTManager(
+            ["Hi there", "Nice answer", "Next topic"])
+        service = ChatService(db=Database(), gpt_manager=gpt_manager)
+        service.process_message_for_chat("42")
+
+        events = list(service.stream_message_for_chat("42", "Hello"))
+
+        deltas = [(index, text) for event, index, text in events if event == 'delta']
+        self.assertEqual({index for index, _ in deltas}, {0, 1})
+        self.assertEqual(''.join(text for index, text in deltas if index == 1),
+                         "Next topic ")
+        self.assertEqual(events[-1][0], 'done')
+        self.assertEqual(events[-1][2]['responses'],
+                         ["Nice answer ", "Next topic "])
+        self.assertIn("Transition to the next activity: Second activity",
+                      gpt_manager.prompts[-1])
+
+    def test_stream_endpoint_emits_server_sent_events(self):
+        gpt_manager = FakeGPTManager(["Hi there", "Nice answer", "Next topic"])
+        ChatService(db=Database(), gpt_manager=gpt_manager).process_message_for_chat("42")
+
+        with patch('chat.views.GPTAssistantManager', return_value=gpt_manager):
+            response = Client().post(
+                reverse('chat:chat_send_message_stream'),
+                data=json.dumps({'message': 'Hello'}),
+                content_type='application/json',
+                HTTP_X_USER_ID='42')
+            body = b''.join(response.streaming_content).decode()
+
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        self.assertIn('event: delta\ndata: {"index": 0, "text": "Nice "}', body)
+        done = body.split('event: done\ndata: ')[1].strip()
+        self.assertEqual(json.loads(done), {
+            'multiple_responses': True,
+            'responses': ["Nice answer ", "Next topic "]})
+
+    def test_closing_stream_early_still_records_turn(self):
+        gpt_manager = FakeGPTManager(["Hi there", "Nice answer", "Next topic"])
+        service = ChatService(db=Database(), gpt_manager=gpt_manager)
+        service.process_message_for_chat("42")
+
+        events = service.stream_message_for_chat("42", "Hello")
+        self.assertEqual(next(events), ('delta', 0, "Nice "))
+        events.close()
+
+        transcripts = Transcript.objects.filter(user=self.user).order_by('id')
+        self.assertEqual([t.assistant_message for t in transcripts],
+                         ["Hi there", "Nice answer ", "Next topic"])
+        self.assertTrue(transcripts[1].user_message.startswith("Hello"))
+        assistant = Assistant.objects.get(user=self.user)
+        self.assertEqual(assistant.current_activity_index, 1)
+        self.assertEqual(assistant.exchange_count, 0)
+
+    def test_reply_failing_mid_stream_is_reported_as_error(self):
+        gpt_manager = FakeGPTManager(["Hi there", "Nice <fail>"])
+        service = ChatService(db=Database(), gpt_manager=gpt_manager)
+        Prompt.objects.update(num_rounds=2)
+        service.process_message_for_chat("42")
+
+        events = list(service.stream_message_for_chat("42", "Hello"))
+
+        self.assertIn(('error', 0, "There was an error processing your message."), events)
+        self.assertEqual(events[-1], ('done', None, "There was an error processing your message."))
+        self.assertEqual(Transcript.objects.filter(user=self.user).last().assistant_message,
+                         "There was an error processing your message.")
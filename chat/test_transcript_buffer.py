@@ -0,0 +1,48 @@
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
+from . import transcript_buffer
+from .models import Transcript
+from .test_helpers import create_user_with_activities
+from .test_streaming import FakeGPTManager
+from .transcript_buffer import flush_all_transcripts
+from .views import ChatService, Database
+
+
+@override_settings(TRANSCRIPT_WRITE_BEHIND=True)
+class TranscriptWriteBehindTestCase(TestCase):
+    def setUp(self):
+        self.addCleanup(transcript_buffer._pending.clear)
+        self.user = create_user_with_activities(num_rounds=1)
+        self.gpt_manager = FakeGPTManager(["Opener", "Answer", "Transition"])
+        self.service = ChatService(db=Database(), gpt_manager=self.gpt_manager)
+        self.service.process_message_for_chat("42")
+
+    def transcript_inserts(self, queries):
+        return [q for q in queries if q['sql'].startswith('INSERT INTO "chat_transcript"')]
+
+    def test_turn_transcripts_are_written_in_one_insert_before_it_returns(self):
+        with CaptureQueriesContext(connection) as queries:
+            result = self.service.process_message_for_chat("42", "Hello")
+
+        self.assertEqual(result['responses'], ["Answer", "Transition"])
+        self.assertEqual(len(self.transcript_inserts(queries)), 1)
+        self.assertEqual(list(Transcript.objects.order_by('id').values_list('assistant_message', flat=True)),
+                         ["Opener", "Answer", "Transition"])
+
+    def test_turn_that_fails_part_way_still_writes_what_it_buffered(self):
+        self.gpt_manager.replies = ["Answer"]
+
+        with self.assertRaises(IndexError):
+            self.service.process_message_for_chat("42", "Hello")
+
+        self.assertTrue(Transcript.objects.filter(assistant_message="Answer").exists())
+
+    def test_buffer_is_flushed_on_shutdown(self):
+        Database().save_transcript(self.user, "Pending", "Reply", session_number=1)
+        self.assertFalse(Transcript.objects.filter(user_message="Pending").exists())
+
+        flush_all_transcripts()
+
+        self.assertTrue(Transcript.objects.filter(user_message="Pending").exists())
+        self.assertEqual(transcript_buffer._pending, {})
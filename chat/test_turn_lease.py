@@ -0,0 +1,177 @@
+import json
+import random
+import threading
+import time
+from datetime import timedelta
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, Client
+from django.urls import reverse
+from django.utils import timezone
+from unittest.mock import patch
+from .async_views import AsyncChatService
+from .jobs import enqueue_incoming_message
+from .management.commands import run_incoming_jobs
+from .models import Assistant, Transcript, IncomingJob
+from .test_async_views import FakeAsyncGPTManager
+from .test_helpers import create_user_with_activities, use_chat_service
+from .test_streaming import FakeGPTManager
+from .views import ChatService, ChatReply, Database, TurnInProgress, TURN_IN_PROGRESS
+
+
+class TurnLeaseTestCase(TestCase):
+    def setUp(self):
+        self.user = create_user_with_activities(num_rounds=2)
+        self.gpt_manager = FakeGPTManager(["Hi there"] * 5)
+        self.service = ChatService(db=Database(), gpt_manager=self.gpt_manager)
+        self.service.process_message_for_chat("42")
+        self.client = Client(headers={'X-User-Id': '42'})
+        use_chat_service(self, self.service)
+
+    def start_turn(self, message="Hello"):
+        # A turn suspended while its GPT call is in flight; kept referenced so
+        # garbage collection doesn't close it and release the lease
+        self.turn = self.service.chat_turn(self.service.prepare_chat("42"), message)
+        next(self.turn)
+        return self.turn
+
+    def send(self, name='chat_send_message'):
+        return self.client.post(reverse(f'chat:{name}'), data=json.dumps({'message': 'Hello'}),
+                                content_type='application/json')
+
+    def test_send_during_turn_is_rejected_without_a_run(self):
+        turn = self.start_turn()
+        prompts = len(self.gpt_manager.prompts)
+
+        response = self.send()
+
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json(), {'error': TURN_IN_PROGRESS})
+        self.assertEqual(len(self.gpt_manager.prompts), prompts)
+
+        with self.assertRaises(StopIteration):
+            turn.send(ChatReply("First answer"))
+        self.assertEqual(self.send().status_code, 200)
+        self.assertEqual(Assistant.objects.get(user=self.user).exchange_count, 0)
+
+    def test_streamed_send_during_turn_is_rejected(self):
+        self.start_turn()
+
+        events = list(self.service.stream_message_for_chat("42", "Hello"))
+
+        self.assertEqual(events, [('error', None, TURN_IN_PROGRESS)])
+
+    def test_restart_during_turn_leaves_state_alone(self):
+        turn = self.start_turn()
+
+        response = self.client.post(reverse('chat:restart_session'))
+
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(Assistant.objects.get(user=self.user).session_count, 1)
+        with self.assertRaises(StopIteration):
+            turn.send(ChatReply("First answer"))
+        self.assertEqual(Assistant.objects.get(user=self.user).exchange_count, 1)
+
+    def test_failed_gpt_call_releases_lease(self):
+        self.gpt_manager.replies = []
+
+        with self.assertRaises(IndexError):
+            self.service.process_message_for_chat("42", "Hello")
+
+        self.assertEqual(Assistant.objects.get(user=self.user).turn_lease, '')
+
+    def test_expired_lease_is_taken_over_and_stale_turn_is_not_saved(self):
+        db = Database()
+        stale = db.begin_turn("42")
+        Assistant.objects.update(turn_lease_expires=timezone.now() - timedelta(seconds=1))
+        current = db.begin_turn("42")
+
+        stale.assistant.exchange_count = 1
+        with self.assertLogs(level='WARNING'):
+            db.save_turn(stale.assistant)
+
+        assistant = Assistant.objects.get(user=self.user)
+        self.assertEqual((assistant.exchange_count, assistant.turn_lease), (0, current.assistant.turn_lease))
+
+    def test_worker_defers_job_while_web_turn_runs(self):
+        self.start_turn()
+        enqueue_incoming_message(42, {"name": "James"}, "Hi")
+
+        with patch.object(run_incoming_jobs, 'get_chat_service', return_value=self.service), \
+                patch.object(run_incoming_jobs.connection, 'close'):
+            run_incoming_jobs.work("w1", threading.Event(), once=True)
+
+        job = IncomingJob.objects.get()
+        self.assertEqual((job.status, job.attempts), (IncomingJob.PENDING, 0))
+        self.assertGreater(job.run_after, timezone.now())
+
+    async def test_async_send_during_turn_is_rejected(self):
+        service = AsyncChatService(db=Database(), gpt_manager=FakeAsyncGPTManager(["Reply"]))
+        await Assistant.objects.aupdate(
+            turn_lease="other", turn_lease_expires=timezone.now() + timedelta(minutes=1))
+
+        with self.assertRaises(TurnInProgress):
+            await service.process_message_for_chat("42", "Hello")
+        self.assertEqual(await Transcript.objects.acount(), 1)
+
+
+class SlowGPTManager(FakeGPTManager):
+    # Records how many runs overlap on the user's thread
+    def __init__(self):
+        super().__init__([])
+        self.lock = threading.Lock()
+        self.running = 0
+        self.max_running = 0
+
+    def generate_gpt_response(self, assistant, message=None):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(0.02)
+        with self.lock:
+            self.running -= 1
+        return ChatReply("Reply")
+
+
+class ConcurrentSendStressTestCase(TransactionTestCase):
+    # Runs against the real database: an in-memory SQLite test database can't
+    # take writes from several threads at once
+    def setUp(self):
+        if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+            self.skipTest("needs a database that accepts concurrent connections")
+        self.user = create_user_with_activities(num_rounds=1000)
+        self.gpt_manager = SlowGPTManager()
+        self.service = ChatService(db=Database(), gpt_manager=self.gpt_manager)
+        self.service.process_message_for_chat("42")
+
+    def test_parallel_sends_never_overlap_or_lose_progress(self):
+        threads, sends_per_thread = 8, 5
+        barrier = threading.Barrier(threads)
+        results = []
+
+        def sender():
+            try:
+                barrier.wait()
+                for _ in range(sends_per_thread):
+                    try:
+                        self.service.process_message_for_chat("42", "Hello")
+                        results.append('sent')
+                    except TurnInProgress:
+                        results.append('rejected')
+                    time.sleep(random.uniform(0, 0.01))
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=sender) for _ in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        sent = results.count('sent')
+        self.assertEqual(len(results), threads * sends_per_thread)
+        self.assertGreater(sent, 0)
+        self.assertGreater(results.count('rejected'), 0)
+        self.assertEqual(self.gpt_manager.max_running, 1)
+        assistant = Assistant.objects.get(user=self.user)
+        self.assertEqual((assistant.exchange_count, assistant.turn_lease), (sent, ''))
+        self.assertEqual(Transcript.objects.filter(user=self.user).exclude(user_message='').count(), sent)
@@ -0,0 +1,106 @@
+import json
+from io import StringIO
+from types import SimpleNamespace
+from django.core.management import call_command
+from django.test import TestCase, Client, override_settings
+from django.urls import reverse
+from unittest.mock import MagicMock
+from .models import User, Transcript
+from .test_helpers import create_user_with_activities, use_chat_service
+from .test_streaming import FakeGPTManager
+from .views import ChatReply, ChatService, Database, GPTAssistantManager, TOKEN_BUDGET_EXCEEDED
+
+
+def usage(prompt_tokens, completion_tokens):
+    return SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                           total_tokens=prompt_tokens + completion_tokens)
+
+
+class MeteredGPTManager(FakeGPTManager):
+    def generate_gpt_response(self, assistant, message=None):
+        reply = super().generate_gpt_response(assistant, message)
+        return ChatReply(reply.text, "run_1", usage(100, 20), "gpt-4o-mini", 0.5, 2.0)
+
+
+class UsageAccountingTestCase(TestCase):
+    def setUp(self):
+        self.user = create_user_with_activities(num_rounds=1)
+        self.gpt_manager = MeteredGPTManager(["Opener", "Answer", "Transition", "Last answer", "Goodbye"])
+        self.service = ChatService(db=Database(), gpt_manager=self.gpt_manager)
+        self.service.process_message_for_chat("42")
+        use_chat_service(self, self.service)
+
+    def test_transcripts_record_usage_timing_and_activity(self):
+        self.service.process_message_for_chat("42", "Hello")
+
+        rows = list(Transcript.objects.order_by('id').values_list(
+            'assistant_message', 'activity__content', 'model', 'prompt_tokens', 'completion_tokens',
+            'queue_seconds', 'openai_seconds'))
+        self.assertEqual(rows, [
+            ("Opener", "First activity", "gpt-4o-mini", 100, 20, 0.5, 2.0),
+            ("Answer", "First activity", "gpt-4o-mini", 100, 20, 0.5, 2.0),
+            ("Transition", "Second activity", "gpt-4o-mini", 100, 20, 0.5, 2.0),
+        ])
+
+    @override_settings(CHAT_USER_DAILY_TOKENS=100)
+    def test_turn_is_refused_once_daily_tokens_are_used(self):
+        response = Client(headers={'X-User-Id': '42'}).post(
+            reverse('chat:chat_send_message'), data=json.dumps({'message': 'Hello'}),
+            content_type='application/json')
+
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.json(), {'error': TOKEN_BUDGET_EXCEEDED})
+        self.assertEqual(len(self.gpt_manager.prompts), 1)
+        self.assertEqual(list(self.service.stream_message_for_chat("42", "Hello")),
+                         [('error', None, TOKEN_BUDGET_EXCEEDED)])
+        self.assertEqual(Database().load_chat_state("42").assistant.turn_lease, '')
+
+    @override_settings(CHAT_USER_DAILY_TOKENS=1000)
+    def test_turn_runs_within_budget(self):
+        self.assertEqual(self.service.process_message_for_chat("42", "Hello")['responses'],
+                         ["Answer", "Transition"])
+
+    def test_report_groups_latency_and_tokens(self):
+        self.service.process_message_for_chat("42", "Hello")
+        out = StringIO()
+
+        call_command('chat_usage_report', '--by', 'activity', stdout=out)
+
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[1].split(), ["First", "activity", "2", "2.00", "2.00", "0.50", "100", "20", "240"])
+        self.assertEqual(lines[2].split(), ["Second", "activity", "1", "2.00", "2.00", "0.50", "100", "20", "120"])
+
+    def test_session_conclusion_is_tagged_with_the_last_activity(self):
+        self.service.process_message_for_chat("42", "Hello")
+        self.service.process_message_for_chat("42", "Bye")
+
+        self.assertEqual(Transcript.objects.latest('id').activity.content, "Second activity")
+
+    def test_report_keeps_each_users_sessions_apart(self):
+        self.service.process_message_for_chat("42", "Hello")
+        other = User.objects.create(bcfg_id="7", name="Ann")
+        Transcript.objects.create(user=other, user_message="", assistant_message="Hi", session_number=1,
+                                  model="gpt-4o-mini", prompt_tokens=50, completion_tokens=10,
+                                  queue_seconds=0.1, openai_seconds=1.0)
+        out = StringIO()
+
+        call_command('chat_usage_report', '--by', 'session', stdout=out)
+
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[1].split(), ["42", "/", "1", "3", "2.00", "2.00", "0.50", "100", "20", "360"])
+        self.assertEqual(lines[2].split(), ["7", "/", "1", "1", "1.00", "1.00", "0.10", "50", "10", "60"])
+
+
+class ReplyTimingTestCase(TestCase):
+    def test_reply_is_stamped_with_model_and_timings(self):
+        user = create_user_with_activities(num_rounds=1)
+        assistant = Database().get_or_create_assistant(user)
+        openai_client = MagicMock()
+        openai_client.beta.threads.runs.create_and_poll.return_value = MagicMock(
+            id="run_1", status='failed', usage=None)
+
+        reply = GPTAssistantManager(openai_client, model="gpt-4o-mini").generate_gpt_response(assistant, "Hi")
+
+        self.assertEqual(reply.model, "gpt-4o-mini")
+        self.assertGreaterEqual(reply.queue_seconds, 0)
+        self.assertGreaterEqual(reply.openai_seconds, 0)
@@ -0,0 +1,68 @@
+import atexit
+import logging
+import threading
+from contextlib import contextmanager
+from django.db import transaction
+from .conversation_cache import invalidate_conversation
+from .models import Transcript
+
+# Write-behind for transcripts (TRANSCRIPT_WRITE_BEHIND). A chat turn saves up
+# to three transcripts; buffered per user, they go out as one bulk INSERT in
+# the same transaction as the turn's progress, so the turn costs one commit.
+# Every turn ends in Database.save_turn or release_turn, which flush before the
+# turn's result reaches the caller; anything a stopping process still holds is
+# flushed at exit.
+
+_pending = {}
+_lock = threading.Lock()
+
+
+def buffer_transcript(transcript):
+    with _lock:
+        _pending.setdefault(transcript.user_id, []).append(transcript)
+
+
+def pending_transcripts(user_id):
+    with _lock:
+        return list(_pending.get(user_id, []))
+
+
+def take_transcripts(user_id):
+    with _lock:
+        return _pending.pop(user_id, [])
+
+
+def restore_transcripts(user_id, transcripts):
+    with _lock:
+        _pending[user_id] = transcripts + _pending.get(user_id, [])
+
+
+@contextmanager
+def flushing_transcripts(user_id):
+    # Writes the user's buffered transcripts in one transaction with the block's writes
+    transcripts = take_transcripts(user_id)
+    if not transcripts:
+        yield
+        return
+    try:
+        with transaction.atomic():
+            Transcript.objects.bulk_create(transcripts)
+            yield
+    except Exception:
+        restore_transcripts(user_id, transcripts)
+        raise
+    invalidate_conversation(transcripts[0].user.bcfg_id)
+
+
+def flush_all_transcripts():
+    with _lock:
+        user_ids = list(_pending)
+    for user_id in user_ids:
+        try:
+            with flushing_transcripts(user_id):
+                pass
+        except Exception as e:
+            logging.error(f"Failed to flush buffered transcripts for user {user_id}: {e}")
+
+
+atexit.register(flush_all_transcripts)
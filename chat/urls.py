@@ -1,21 +1,31 @@
+from django.conf import settings
 from django.urls import path
 from . import views
 
+# Serve the LLM-bound endpoints from their async versions when running under ASGI
+if settings.CHAT_ASYNC_VIEWS:
+    from . import async_views as chat_views
+else:
+    chat_views = views
+
 app_name = 'chat'
 
 urlpatterns = [
     path('participant/<int:id>/incoming/',
-         views.incoming_message, name='incoming_message'),
+         chat_views.incoming_message, name='incoming_message'),
     path('chat/', views.chat_page_view, name='chat_page'),
-    path('chat/login/', views.chat_login, name='login'),
+    path('chat/login/', chat_views.chat_login, name='login'),
     path('chat/user_info/', views.get_user_info, name='get_user_info'),
-    path('chat/send/', views.chat_send_message, name='chat_send_message'),
+    path('chat/send/', chat_views.chat_send_message, name='chat_send_message'),
+    path('chat/send/stream/', chat_views.chat_send_message_stream,
+         name='chat_send_message_stream'),
     path('chat/get_conversation/', views.get_conversation, name='get_conversation'),
     path('prompt/', views.prompt_view, name='prompt'),
     path('activities/add/', views.activity_add, name='activity_add'),
     path('activities/<int:pk>/edit/', views.activity_edit, name='activity_edit'),
     path('activities/<int:pk>/delete/',
          views.activity_delete, name='activity_delete'),
-    path('chat/restart_session/', views.restart_session, name='restart_session'),
+    path('chat/restart_session/', chat_views.restart_session, name='restart_session'),
     path('health/', views.health_check, name='health_check'),
+    path('metrics/', views.metrics_view, name='metrics'),
 ]
@@ -1,17 +1,37 @@
+import hashlib
 import random
+import time
+import uuid
+from dataclasses import dataclass, replace
+from datetime import timedelta
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F, Q, Sum
+from django.utils import timezone
 from django.shortcuts import render, redirect, get_object_or_404
-from django.http import JsonResponse, HttpResponseNotAllowed
+from django.http import HttpResponse, JsonResponse, HttpResponseNotAllowed, StreamingHttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import quote_etag
 from .models import Prompt, Activity, UserActivity
 from django.views.decorators.clickjacking import xframe_options_exempt
 from django.http import JsonResponse
 from django.shortcuts import render
 from django.views.decorators.csrf import csrf_exempt
-from .models import User, Assistant, Transcript
+from .models import User, Assistant, Transcript, SharedAssistant
 import json
 import logging
-import os
-import requests
-from openai import OpenAI, RateLimitError
+from openai import NOT_GIVEN, RateLimitError
+from .openai_client import get_openai_client
+from .idempotency import idempotent
+from .jobs import enqueue_incoming_message
+from .backends.pool import release_connection
+from .delivery import ParticipantDelivery
+from .ratelimit import OpenAIRateLimiter, RateLimitTimeout, retry_after_seconds
+from .conversation_cache import get_cached_page, cache_page, invalidate_conversation
+from .prompt_cache import get_prompt_config
+from .transcript_buffer import buffer_transcript, flushing_transcripts, pending_transcripts
+from .replica import read_only
+from .metrics import RATE_LIMIT_HITS, export_metrics, profile_user, timing
 
 logging.basicConfig(level=logging.INFO)
 
@@ -20,6 +40,18 @@ def health_check(request):
     return JsonResponse({"status": "ok"})
 
 
+def metrics_view(request):
+    # Prometheus scrape, summed over every worker process
+    body, content_type = export_metrics()
+    return HttpResponse(body, content_type=content_type)
+
+
+CONVERSATION_PAGE_SIZE = 50
+CONVERSATION_MAX_PAGE_SIZE = 200
+# Transcripts ChatCompletionsManager reads before trimming to its token budget
+CHAT_CONTEXT_MAX_TRANSCRIPTS = 100
+
+
 class Database:
     def get_user_by_bcfg_id(self, bcfg_id):
         try:
@@ -38,87 +70,576 @@ class Database:
             return self.create_user(bcfg_id, name)
 
     def get_or_create_assistant(self, user):
-        assistant, _ = Assistant.objects.get_or_create(user=user)
+        # The user is loaded alongside so run-level instructions can use their name
+        assistant, _ = Assistant.objects.select_related(
+            'user').get_or_create(user=user)
         return assistant
 
+    def load_chat_state(self, bcfg_id):
+        # Everything a chat turn reads in one query: the assistant, carrying the
+        # user's activity plan, joined to its user
+        assistant = Assistant.objects.select_related('user').filter(user__bcfg_id=str(bcfg_id)).first()
+        if assistant:
+            user = assistant.user
+        else:
+            user = self.get_user_by_bcfg_id(bcfg_id)
+            if not user:
+                return None
+            assistant = self.get_or_create_assistant(user)
+        return ChatState(user, assistant, self.get_activity_plan(assistant))
+
+    def begin_turn(self, bcfg_id):
+        # Take the user's turn lease, then load the state it protects. The lease
+        # is taken with a conditional UPDATE rather than a row lock, so nothing
+        # stays locked while GPT runs; a second send is turned away instead.
+        users = User.objects.filter(bcfg_id=str(bcfg_id))
+        token = self.take_turn_lease(Assistant.objects.filter(user__in=users))
+        state = self.load_chat_state(bcfg_id)
+        if not state:
+            return None
+        if not token and not state.assistant.turn_lease:
+            # The assistant was only just created, or a turn ended in between
+            token = self.take_turn_lease(Assistant.objects.filter(id=state.assistant.id))
+            if token:
+                state = self.load_chat_state(bcfg_id)
+        if not token:
+            raise TurnInProgress(bcfg_id)
+        state.assistant.turn_lease = token
+        return state
+
+    def acquire_turn(self, assistant):
+        token = self.take_turn_lease(Assistant.objects.filter(id=assistant.id))
+        if not token:
+            raise TurnInProgress(assistant.user.bcfg_id)
+        assistant.turn_lease = token
+
+    def take_turn_lease(self, assistants):
+        # Returns the lease token, or None if another turn holds an unexpired lease
+        now = timezone.now()
+        token = uuid.uuid4().hex
+        taken = assistants.filter(turn_lease_free(now)).update(
+            turn_lease=token, turn_lease_expires=now + timedelta(seconds=settings.CHAT_TURN_LEASE_SECONDS))
+        return token if taken else None
+
+    def save_turn(self, assistant):
+        # Write the turn's progress and release the lease in one compare-and-swap:
+        # a turn that outlived its lease must not overwrite the turn that took over.
+        # Buffered transcripts are committed along with it.
+        with flushing_transcripts(assistant.user_id):
+            saved = Assistant.objects.filter(id=assistant.id, turn_lease=assistant.turn_lease).update(
+                current_activity_index=assistant.current_activity_index,
+                exchange_count=assistant.exchange_count, turn_lease='', turn_lease_expires=None)
+        if not saved:
+            logging.warning(f"Chat turn for assistant {assistant.id} outlived its lease; progress not saved")
+        assistant.turn_lease = ''
+
+    def release_turn(self, assistant):
+        # Also writes what a turn that ended early had buffered
+        with flushing_transcripts(assistant.user_id):
+            if assistant.turn_lease:
+                Assistant.objects.filter(id=assistant.id, turn_lease=assistant.turn_lease).update(
+                    turn_lease='', turn_lease_expires=None)
+                assistant.turn_lease = ''
+
+    def get_activity_plan(self, assistant):
+        # Assistants from before the plan existed are filled in from UserActivity once
+        if not assistant.activity_plan:
+            user_activities = UserActivity.objects.filter(
+                user_id=assistant.user_id).select_related('activity').order_by('id')
+            self.save_activity_plan(assistant, [ua.activity for ua in user_activities])
+        return tuple(PlannedActivity(**entry) for entry in assistant.activity_plan)
+
+    def save_activity_plan(self, assistant, activities):
+        assistant.activity_plan = [{'id': activity.id, 'content': activity.content}
+                                   for activity in activities]
+        if assistant.activity_plan:
+            assistant.save(update_fields=['activity_plan'])
+
+    def assign_activities(self, user):
+        # Pick the user's activities on first login: one bulk insert for the
+        # record, plus the ordered plan that chat turns read from the assistant
+        assistant = self.get_or_create_assistant(user)
+        if self.get_activity_plan(assistant):
+            return
+        config = get_prompt_config()
+        prompt = config.prompt or Prompt.objects.create()
+        activities = pick_activities(prompt, list(config.activities))
+        UserActivity.objects.bulk_create(
+            [UserActivity(user=user, activity=activity) for activity in activities])
+        self.save_activity_plan(assistant, activities)
+
     def save_assistant(self, assistant):
         assistant.save()
 
-    def save_transcript(self, user, user_message, assistant_message, session_number):
-        Transcript.objects.create(
-            user=user, user_message=user_message, assistant_message=assistant_message, session_number=session_number)
-
-    def get_transcripts_for_user(self, user):
-        return Transcript.objects.filter(user=user).order_by('created_at')
+    def save_transcript(self, user, user_message, assistant_message, session_number, reply=None, activity=None):
+        transcript = Transcript(
+            user=user, user_message=user_message, assistant_message=assistant_message, session_number=session_number,
+            activity_id=activity.id if activity else None, **reply_usage(reply))
+        if settings.TRANSCRIPT_WRITE_BEHIND:
+            # Written when the turn saves or releases, see transcript_buffer
+            buffer_transcript(transcript)
+            return
+        transcript.save()
+        invalidate_conversation(user.bcfg_id)
+
+    def check_token_budget(self, user):
+        if not settings.CHAT_USER_DAILY_TOKENS:
+            return
+        used = Transcript.objects.filter(user=user, created_at__gte=timezone.now() - timedelta(days=1)).aggregate(
+            tokens=Sum(F('prompt_tokens') + F('completion_tokens')))['tokens'] or 0
+        if used >= settings.CHAT_USER_DAILY_TOKENS:
+            RATE_LIMIT_HITS.labels('daily_tokens').inc()
+            raise TokenBudgetExceeded(user.bcfg_id)
+
+    def get_latest_transcript_id(self, bcfg_id):
+        # Grows with every saved transcript, so it versions the user's conversation
+        return Transcript.objects.filter(user__bcfg_id=str(bcfg_id)).order_by(
+            '-id').values_list('id', flat=True).first()
+
+    def get_transcript_page(self, bcfg_id, since_id=None, before_id=None, session_number=None,
+                            limit=CONVERSATION_PAGE_SIZE):
+        # One page of (id, user_message, assistant_message) in chronological order,
+        # plus whether more rows lie beyond it in the direction being paged
+        transcripts = Transcript.objects.filter(user__bcfg_id=str(bcfg_id))
+        if session_number is not None:
+            transcripts = transcripts.filter(session_number=session_number)
+        if since_id is not None:
+            transcripts = transcripts.filter(id__gt=since_id).order_by('id')
+        else:
+            if before_id is not None:
+                transcripts = transcripts.filter(id__lt=before_id)
+            transcripts = transcripts.order_by('-id')
+        rows = list(transcripts.values_list('id', 'user_message', 'assistant_message')[:limit + 1])
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if since_id is None:
+            rows.reverse()
+        return rows, has_more
 
     def get_prompt_instructions(self, user):
-        prompt = Prompt.objects.first()
+        prompt = get_prompt_config().prompt
         instructions = ""
         if prompt:
             instructions += f"Persona:\n{prompt.persona}\n\nKnowledge:\n{prompt.knowledge}\n\n"
         return instructions
 
 
+@dataclass(frozen=True)
+class ChatReply:
+    # One assistant reply: its text plus the run that produced it, its token usage,
+    # the model, and seconds spent waiting on the rate limiter and on OpenAI
+    text: str
+    run_id: str = None
+    usage: object = None
+    model: str = None
+    queue_seconds: float = None
+    openai_seconds: float = None
+
+
+@dataclass(frozen=True)
+class PlannedActivity:
+    id: int
+    content: str
+
+
+@dataclass(frozen=True)
+class ChatState:
+    # What one chat turn works from; the assistant row is the only part it updates
+    user: User
+    assistant: Assistant
+    activities: tuple
+
+
+def activity_at(activities, index):
+    return activities[index] if 0 <= index < len(activities) else None
+
+
+def reply_usage(reply):
+    # Transcript fields recording what a reply cost
+    if reply is None:
+        return {}
+    usage = reply.usage
+    return {
+        'model': reply.model or '',
+        'prompt_tokens': usage.prompt_tokens if usage else None,
+        'completion_tokens': usage.completion_tokens if usage else None,
+        'queue_seconds': reply.queue_seconds,
+        'openai_seconds': reply.openai_seconds,
+    }
+
+
+def turn_lease_free(now=None):
+    return Q(turn_lease='') | Q(turn_lease_expires__lt=now or timezone.now())
+
+
+def message_text(message):
+    return ''.join(
+        block.text.value for block in message.content if block.type == 'text')
+
+
+class IncompleteResponseError(Exception):
+    # Raised by stream_gpt_response when a run fails after part of the reply
+    # was streamed; response is the text to record in place of the reply
+    def __init__(self, response):
+        super().__init__(response)
+        self.response = response
+
+
+BUSY_RESPONSE = "We're experiencing high traffic. Please try again in a moment."
+TURN_IN_PROGRESS = "Still replying to your last message. Please wait for it before sending another."
+TOKEN_BUDGET_EXCEEDED = "You've reached today's chat limit. Please come back tomorrow."
+
+
+class TurnRefused(Exception):
+    # A chat turn that can't start; views answer with `message` and `status`
+    message = None
+    status = 409
+
+
+class TurnInProgress(TurnRefused):
+    # Raised when the user already has a chat turn running
+    message = TURN_IN_PROGRESS
+
+
+class TokenBudgetExceeded(TurnRefused):
+    # Raised when the user's replies used CHAT_USER_DAILY_TOKENS in the last day
+    message = TOKEN_BUDGET_EXCEEDED
+    status = 429
+
+
+# OpenAI assistant ids by (instructions hash, model), filled from SharedAssistant
+shared_assistant_ids = {}
+SESSION_SUMMARY_INSTRUCTIONS = (
+    "Summarize this chat between a student and an assistant in at most five short sentences: "
+    "what the student shared, how they felt, and anything to follow up on. Write in the third person.")
+
+
+def carry_over_message(summary):
+    return {"role": "user",
+            "content": f"Admin message: Summary of the user's previous session, for context: {summary} "
+                       "The user is not aware of this message."}
+
+
+def session_reset():
+    # Assistant fields restart_session updates to begin a new session
+    reset = {'current_activity_index': 0, 'exchange_count': 0, 'session_count': F('session_count') + 1}
+    if settings.CHAT_THREAD_PER_SESSION:
+        # The next turn creates a new thread, see GPTAssistantManager.create_thread
+        reset['gpt_thread_id'] = ''
+    return reset
+
+
 class GPTAssistantManager:
-    def __init__(self, openai_client):
+    def __init__(self, openai_client, model=None, limiter=None):
         self.openai_client = openai_client
+        self.model = model or settings.OPENAI_MODEL
+        self.limiter = limiter or OpenAIRateLimiter()
 
     def initialize_assistant(self, assistant, instructions):
-        if not assistant.gpt_assistant_id or not assistant.gpt_thread_id:
-            assistant.gpt_assistant_id, assistant.gpt_thread_id = self.setup_assistant_and_thread(
-                instructions)
-            assistant.save()
+        # Point the user at the shared assistant for the current instructions and
+        # give them their own thread; a prompt edit moves everyone to the new version
+        gpt_assistant_id = self.get_shared_assistant_id(instructions)
+        if assistant.gpt_assistant_id != gpt_assistant_id or not assistant.gpt_thread_id:
+            assistant.gpt_assistant_id = gpt_assistant_id
+            if not assistant.gpt_thread_id:
+                assistant.gpt_thread_id = self.create_thread(assistant)
+            assistant.save(update_fields=['gpt_assistant_id', 'gpt_thread_id'])
         return assistant
 
-    def setup_assistant_and_thread(self, instructions):
-        assistant = self.openai_client.beta.assistants.create(
+    def create_thread(self, assistant):
+        # Each session gets a new thread (restart_session clears the old one), so
+        # runs stop re-reading earlier sessions
+        summary = self.summarize_previous_session(assistant)
+        if summary:
+            return self.openai_client.beta.threads.create(messages=[carry_over_message(summary)]).id
+        return self.openai_client.beta.threads.create().id
+
+    def summary_request(self, assistant):
+        # Completion condensing the previous session, or None when off or there is nothing to carry
+        if not settings.CHAT_SESSION_SUMMARY or assistant.session_count <= 1:
+            return None
+        rows = Transcript.objects.filter(
+            user_id=assistant.user_id, session_number=assistant.session_count - 1).order_by(
+            'id').values_list('user_message', 'assistant_message')
+        lines = []
+        for user_message, assistant_message in rows:
+            if user_message.strip():
+                lines.append(f"User: {user_message}")
+            if (assistant_message or '').strip():
+                lines.append(f"Assistant: {assistant_message}")
+        if not lines:
+            return None
+        return {
+            'model': self.model,
+            'max_tokens': settings.CHAT_SESSION_SUMMARY_TOKENS,
+            'messages': [{"role": "system", "content": SESSION_SUMMARY_INSTRUCTIONS},
+                         {"role": "user", "content": '\n'.join(lines)}],
+        }
+
+    def summary_estimate(self, request):
+        return len(request['messages'][1]['content']) // 4 + request['max_tokens']
+
+    def summarize_previous_session(self, assistant):
+        # The new session starts without a summary if this fails
+        request = self.summary_request(assistant)
+        if not request:
+            return None
+        estimate = self.summary_estimate(request)
+        try:
+            self.limiter.acquire(assistant.user_id, estimate)
+            completion = self.openai_client.chat.completions.create(**request)
+        except Exception as e:
+            logging.error(f"Could not summarize the last session of user {assistant.user_id}: {e}")
+            return None
+        self.record_usage(assistant, estimate, completion.usage, 'session summary')
+        return completion.choices[0].message.content
+
+    def shared_assistant_key(self, instructions):
+        return hashlib.sha256(instructions.encode()).hexdigest(), self.model
+
+    def get_shared_assistant_id(self, instructions):
+        key = self.shared_assistant_key(instructions)
+        if key not in shared_assistant_ids:
+            instructions_hash, model = key
+            shared = SharedAssistant.objects.filter(
+                instructions_hash=instructions_hash, model=model).first()
+            if not shared:
+                shared = self.create_shared_assistant(instructions)
+            shared_assistant_ids[key] = shared.gpt_assistant_id
+        return shared_assistant_ids[key]
+
+    def create_shared_assistant(self, instructions):
+        instructions_hash, model = self.shared_assistant_key(instructions)
+        gpt_assistant = self.openai_client.beta.assistants.create(
             name="Assistant",
             instructions=instructions,
-            model="gpt-4o-mini",
+            model=model,
         )
-        thread = self.openai_client.beta.threads.create()
-        return assistant.id, thread.id
+        try:
+            with transaction.atomic():
+                return SharedAssistant.objects.create(
+                    instructions_hash=instructions_hash, model=model,
+                    gpt_assistant_id=gpt_assistant.id)
+        except IntegrityError:
+            # Another worker created this version first; use theirs
+            self.openai_client.beta.assistants.delete(gpt_assistant.id)
+            return SharedAssistant.objects.get(instructions_hash=instructions_hash, model=model)
+
+    def run_messages(self, message):
+        # The user's (or admin) message is added as part of run creation,
+        # saving a separate messages.create round trip
+        if message:
+            return [{"role": "user", "content": message}]
+        return NOT_GIVEN
+
+    def run_instructions(self, assistant):
+        # Per-user details go on the run, so the assistant itself can be shared
+        return f"The user's preferred name is: {assistant.user.name}"
+
+    def run_params(self, assistant, message):
+        params = {
+            'thread_id': assistant.gpt_thread_id,
+            'assistant_id': assistant.gpt_assistant_id,
+            'additional_instructions': self.run_instructions(assistant),
+            'additional_messages': self.run_messages(message),
+        }
+        if settings.OPENAI_TRUNCATION_LAST_MESSAGES:
+            params['truncation_strategy'] = {
+                'type': 'last_messages', 'last_messages': settings.OPENAI_TRUNCATION_LAST_MESSAGES}
+        return params
+
+    def timed(self, reply, queued_at, started_at):
+        # Stamps a reply with the model and its time in the rate limiter and at OpenAI
+        return replace(reply, model=self.model, queue_seconds=started_at - queued_at,
+                       openai_seconds=time.monotonic() - started_at)
+
+    def record_usage(self, assistant, estimate, usage, call='run'):
+        # Settles the rate-limit estimate and logs input tokens, which grow with the context a run re-reads
+        if usage:
+            self.limiter.settle(estimate, usage.total_tokens)
+            logging.info(f"OpenAI {call} for user {assistant.user_id}, session {assistant.session_count}: "
+                         f"{usage.prompt_tokens} input tokens, {usage.completion_tokens} output tokens")
 
     def generate_gpt_response(self, assistant, message=None):
-        try:
-            if message:
-                self.openai_client.beta.threads.messages.create(
-                    thread_id=assistant.gpt_thread_id, role="user", content=message
-                )
-            run = self.openai_client.beta.threads.runs.create_and_poll(
-                thread_id=assistant.gpt_thread_id, assistant_id=assistant.gpt_assistant_id
-            )
-            if run.status == 'completed':
-                messages = list(self.openai_client.beta.threads.messages.list(
-                    thread_id=assistant.gpt_thread_id))
-                assistant_messages = [
-                    msg for msg in messages if msg.role == "assistant"]
-                if assistant_messages:
-                    content_blocks = assistant_messages[0].content
-                    text = ''.join(
-                        block.text.value for block in content_blocks if block.type == 'text')
-                    return text
-                else:
-                    logging.error("No assistant messages found in the thread.")
-                    return "There was an error processing your message."
+        estimate = self.limiter.estimate_tokens(message)
+        queued_at = time.monotonic()
+        for attempt in range(settings.OPENAI_RATE_LIMIT_RETRIES + 1):
+            try:
+                self.limiter.acquire(assistant.user_id, estimate)
+                started_at = time.monotonic()
+                return self.timed(self.run_gpt_response(assistant, message, estimate), queued_at, started_at)
+            except RateLimitError as e:
+                if attempt == settings.OPENAI_RATE_LIMIT_RETRIES:
+                    return ChatReply(self.rate_limit_response(e))
+                self.limiter.pause(retry_after_seconds(e, attempt))
+            except RateLimitTimeout as e:
+                logging.error(f"OpenAI call for user {assistant.user_id} not scheduled: {e}")
+                return ChatReply(BUSY_RESPONSE)
+
+    def run_gpt_response(self, assistant, message, estimate):
+        # Don't hold a pooled DB connection for the length of the run
+        release_connection()
+        run = self.openai_client.beta.threads.runs.create_and_poll(**self.run_params(assistant, message))
+        self.record_usage(assistant, estimate, run.usage)
+        if run.status == 'completed':
+            # Only the newest message this run produced, in a single page
+            page = self.openai_client.beta.threads.messages.list(
+                thread_id=assistant.gpt_thread_id, run_id=run.id, order='desc', limit=1)
+            assistant_messages = [
+                msg for msg in page.data if msg.role == "assistant"]
+            if assistant_messages:
+                return ChatReply(message_text(assistant_messages[0]), run.id, run.usage)
             else:
-                logging.error(f"Run failed with status: {run.status}")
-                return "There was an error processing your message."
-        except RateLimitError as e:
-            # Extract wait time and log error
-            retry_after = e.error.get('error', {}).get(
-                'message', '').split("after")[-1].strip()
-            logging.error(f"RateLimitError: {e} - Retry after {retry_after}")
+                logging.error("No assistant messages found in the thread.")
+                return ChatReply("There was an error processing your message.", run.id)
+        else:
+            logging.error(f"Run failed with status: {run.status}")
+            return ChatReply("There was an error processing your message.", run.id)
+
+    def stream_gpt_response(self, assistant, message=None):
+        # Same exchange as generate_gpt_response, but yields text deltas as the
+        # run produces them, followed by the complete ChatReply
+        estimate = self.limiter.estimate_tokens(message)
+        chunks = []
+        queued_at = time.monotonic()
+        for attempt in range(settings.OPENAI_RATE_LIMIT_RETRIES + 1):
+            try:
+                self.limiter.acquire(assistant.user_id, estimate)
+                started_at = time.monotonic()
+                release_connection()
+                with self.openai_client.beta.threads.runs.stream(**self.run_params(assistant, message)) as stream:
+                    for text in stream.text_deltas:
+                        chunks.append(text)
+                        yield text
+                    run = stream.get_final_run()
+                break
+            except RateLimitError as e:
+                # Once text has gone out the run can't be replayed
+                if chunks or attempt == settings.OPENAI_RATE_LIMIT_RETRIES:
+                    response = self.rate_limit_response(e)
+                    if chunks:
+                        raise IncompleteResponseError(response)
+                    yield ChatReply(response)
+                    return
+                self.limiter.pause(retry_after_seconds(e, attempt))
+            except RateLimitTimeout as e:
+                logging.error(f"OpenAI call for user {assistant.user_id} not scheduled: {e}")
+                yield ChatReply(BUSY_RESPONSE)
+                return
+        self.record_usage(assistant, estimate, run.usage)
+        if run.status != 'completed':
+            logging.error(f"Run failed with status: {run.status}")
+            response = "There was an error processing your message."
+            if chunks:
+                raise IncompleteResponseError(response)
+            yield self.timed(ChatReply(response, run.id), queued_at, started_at)
+        else:
+            yield self.timed(ChatReply(''.join(chunks), run.id, run.usage), queued_at, started_at)
+
+    def rate_limit_response(self, e):
+        # Extract wait time and log error
+        retry_after = e.error.get('error', {}).get(
+            'message', '').split("after")[-1].strip()
+        logging.error(f"RateLimitError: {e} - Retry after {retry_after}")
+
+        # Notify the user
+        return f"We're experiencing high traffic. Please wait {retry_after} before trying again."
+
+
+class ChatCompletionsManager(GPTAssistantManager):
+    # Same interface as GPTAssistantManager, on Chat Completions: each reply is one
+    # completion over context we build from our own transcripts, so there are no
+    # OpenAI threads, runs or polling. Selected with CHAT_BACKEND = 'completions'.
+    def initialize_assistant(self, assistant, instructions):
+        # Nothing to create on OpenAI's side; the turn's replies are built on these instructions
+        assistant.chat_instructions = instructions
+        return assistant
 
-            # Notify the user
-            return f"We're experiencing high traffic. Please wait {retry_after} before trying again."
+    def completion_messages(self, assistant, message):
+        # The instructions, then as many of the session's latest exchanges as fit
+        # in CHAT_CONTEXT_TOKENS, then the new message. Transcripts this turn has
+        # only buffered so far (TRANSCRIPT_WRITE_BEHIND) count as saved.
+        transcripts = Transcript.objects.filter(user_id=assistant.user_id)
+        pending = pending_transcripts(assistant.user_id)
+        if settings.CHAT_THREAD_PER_SESSION:
+            transcripts = transcripts.filter(session_number=assistant.session_count)
+            pending = [t for t in pending if t.session_number == assistant.session_count]
+        rows = transcripts.order_by('-id').values_list(
+            'user_message', 'assistant_message')[:CHAT_CONTEXT_MAX_TRANSCRIPTS]
+        exchanges = [(t.user_message, t.assistant_message) for t in reversed(pending)] + list(rows)
+
+        history = []
+        budget = settings.CHAT_CONTEXT_TOKENS
+        for user_message, assistant_message in exchanges:
+            exchange = []
+            if user_message.strip():
+                exchange.append({"role": "user", "content": user_message})
+            if (assistant_message or '').strip():
+                exchange.append({"role": "assistant", "content": assistant_message})
+            cost = sum(len(m['content']) // 4 for m in exchange)
+            if cost > budget:
+                break
+            budget -= cost
+            history[:0] = exchange
+
+        system = f"{assistant.chat_instructions}\n\n{self.run_instructions(assistant)}"
+        messages = [{"role": "system", "content": system}] + history
+        if message:
+            messages.append({"role": "user", "content": message})
+        return messages
+
+    def run_gpt_response(self, assistant, message, estimate):
+        messages = self.completion_messages(assistant, message)
+        release_connection()
+        completion = self.openai_client.chat.completions.create(model=self.model, messages=messages)
+        self.record_usage(assistant, estimate, completion.usage, 'completion')
+        return ChatReply(completion.choices[0].message.content or '', completion.id, completion.usage)
+
+    def stream_gpt_response(self, assistant, message=None):
+        estimate = self.limiter.estimate_tokens(message)
+        messages = self.completion_messages(assistant, message)
+        chunks = []
+        queued_at = time.monotonic()
+        for attempt in range(settings.OPENAI_RATE_LIMIT_RETRIES + 1):
+            try:
+                self.limiter.acquire(assistant.user_id, estimate)
+                started_at = time.monotonic()
+                release_connection()
+                completion_id = usage = None
+                with self.openai_client.chat.completions.create(
+                        model=self.model, messages=messages, stream=True,
+                        stream_options={'include_usage': True}) as stream:
+                    for chunk in stream:
+                        completion_id, usage = chunk.id, chunk.usage or usage
+                        text = chunk.choices[0].delta.content if chunk.choices else None
+                        if text:
+                            chunks.append(text)
+                            yield text
+                break
+            except RateLimitError as e:
+                if chunks or attempt == settings.OPENAI_RATE_LIMIT_RETRIES:
+                    response = self.rate_limit_response(e)
+                    if chunks:
+                        raise IncompleteResponseError(response)
+                    yield ChatReply(response)
+                    return
+                self.limiter.pause(retry_after_seconds(e, attempt))
+            except RateLimitTimeout as e:
+                logging.error(f"OpenAI call for user {assistant.user_id} not scheduled: {e}")
+                yield ChatReply(BUSY_RESPONSE)
+                return
+        self.record_usage(assistant, estimate, usage, 'completion')
+        yield self.timed(ChatReply(''.join(chunks), completion_id, usage), queued_at, started_at)
+
+
+USER_NOT_FOUND = {'error': 'User not found. Please log in again.'}
 
 
 class ChatService:
     def __init__(self, db, gpt_manager, requests_lib=None):
         self.db = db
         self.gpt_manager = gpt_manager
-        self.requests_lib = requests_lib
+        self.delivery = ParticipantDelivery(session=requests_lib)
 
     def check_required_fields(self, context, message):
         required_fields = ["school_name", "school_mascot",
@@ -132,28 +653,129 @@ class ChatService:
     def process_message_for_api(self, context, message, bcfg_id):
         user = self.db.get_or_create_user(bcfg_id, context['name'])
         assistant = self.db.get_or_create_assistant(user)
-        instructions = "you are a helpful assistant"
-        assistant = self.gpt_manager.initialize_assistant(
-            assistant, instructions)
-        gpt_response = self.gpt_manager.generate_gpt_response(
-            assistant, message)
-        self.db.save_transcript(
-            user, message, gpt_response, session_number=assistant.session_count)
+        # The web chat may be running a turn on the same thread
+        self.db.acquire_turn(assistant)
+        try:
+            self.db.check_token_budget(user)
+            instructions = "you are a helpful assistant"
+            assistant = self.gpt_manager.initialize_assistant(
+                assistant, instructions)
+            reply = self.gpt_manager.generate_gpt_response(assistant, message)
+            gpt_response = reply.text
+            self.db.save_transcript(
+                user, message, gpt_response, session_number=assistant.session_count, reply=reply)
+        finally:
+            self.db.release_turn(assistant)
         self.send_message_to_participant(user.bcfg_id, gpt_response)
 
     def process_message_for_chat(self, user_id, message=None):
-        user = self.db.get_user_by_bcfg_id(user_id)
-        if not user:
-            return {'error': 'User not found. Please log in again.'}
+        state = self.prepare_chat(user_id)
+        if not state:
+            return USER_NOT_FOUND
+        return self.complete_turn(self.chat_turn(state, message))
+
+    def prepare_chat(self, user_id):
+        # Start the user's turn and make sure their assistant and thread exist;
+        # raises TurnInProgress if another turn is still running, or
+        # TokenBudgetExceeded if the user has used up their daily tokens
+        profile_user(user_id)
+        state = self.db.begin_turn(user_id)
+        if not state:
+            return None
+        try:
+            self.db.check_token_budget(state.user)
+            instructions = self.chat_instructions(state.user)
+            self.gpt_manager.initialize_assistant(state.assistant, instructions)
+        except Exception:
+            self.db.release_turn(state.assistant)
+            raise
+        return state
+
+    def complete_turn(self, turn, reply=None):
+        # Drive a chat_turn to the end with blocking GPT calls
+        try:
+            assistant, prompt_message = turn.send(reply)
+            while True:
+                reply = self.gpt_manager.generate_gpt_response(
+                    assistant, prompt_message)
+                assistant, prompt_message = turn.send(reply)
+        except StopIteration as stop:
+            return stop.value
+        finally:
+            # Releases the turn lease if a GPT call failed
+            turn.close()
+
+    def stream_message_for_chat(self, user_id, message=None):
+        # Yields ('delta', index, text) while each reply is generated, ('error', index, text)
+        # when a reply fails part way through, then ('done', None, result)
+        try:
+            state = self.prepare_chat(user_id)
+        except TurnRefused as e:
+            yield 'error', None, e.message
+            return
+        if not state:
+            yield 'done', None, USER_NOT_FOUND
+            return
+        turn = self.chat_turn(state, message)
+        index = 0
+        try:
+            assistant, prompt_message = next(turn)
+            while True:
+                chunks = []
+                reply = None
+                items = self.gpt_manager.stream_gpt_response(assistant, prompt_message)
+                try:
+                    try:
+                        for item in items:
+                            if isinstance(item, ChatReply):
+                                reply = item
+                                if not chunks and reply.text:
+                                    # Nothing streamed (e.g. an error message); send it whole
+                                    yield 'delta', index, reply.text
+                            else:
+                                chunks.append(item)
+                                yield 'delta', index, item
+                    except IncompleteResponseError as e:
+                        reply = ChatReply(e.response)
+                        yield 'error', index, reply.text
+                except GeneratorExit:
+                    # The client went away mid-turn: let the run finish and record the turn anyway
+                    if reply is None:
+                        reply = self.drain_reply(chunks, items)
+                    self.complete_turn(turn, reply)
+                    raise
+                index += 1
+                assistant, prompt_message = turn.send(reply)
+        except StopIteration as stop:
+            yield 'done', None, stop.value
+        finally:
+            turn.close()
+
+    def drain_reply(self, chunks, items):
+        try:
+            for item in items:
+                if isinstance(item, ChatReply):
+                    return item
+                chunks.append(item)
+        except IncompleteResponseError as e:
+            return ChatReply(e.response)
+        return ChatReply(''.join(chunks))
+
+    def chat_turn(self, state, message=None):
+        # Conversation state machine shared by the blocking, streaming and async
+        # paths, for a user whose assistant is already initialized. Every GPT
+        # reply it needs is requested by yielding (assistant, message); the
+        # caller sends the reply text back in and receives the final result as
+        # the generator's return value. The turn lease taken by prepare_chat is
+        # released however the turn ends.
+        try:
+            return (yield from self.advance_conversation(state, message))
+        finally:
+            self.db.release_turn(state.assistant)
 
-        assistant = self.db.get_or_create_assistant(user)
-        prompt = Prompt.objects.first()
-        if not prompt:
-            prompt = Prompt.objects.create()
-        instructions = self.db.get_prompt_instructions(user)
-        instructions += f"\nThe user's preferred name is: {user.name}\n"
-        assistant = self.gpt_manager.initialize_assistant(
-            assistant, instructions)
+    def advance_conversation(self, state, message=None):
+        user, assistant, activities = state.user, state.assistant, state.activities
+        prompt = get_prompt_config().prompt or Prompt.objects.create()
 
         # Initialize conversation state if not set
         if assistant.current_activity_index is None:
@@ -161,8 +783,6 @@ class ChatService:
         if assistant.exchange_count is None:
             assistant.exchange_count = 0
 
-        activities = UserActivity.objects.filter(user=user).order_by('id')
-
         # Check if session has ended
         if assistant.exchange_count == -1:
             return "The session has already ended."
@@ -170,41 +790,37 @@ class ChatService:
         # Assistant initiates the conversation
         if assistant.exchange_count == 0 and not message:
             if assistant.current_activity_index < len(activities):
-                current_activity = activities[assistant.current_activity_index].activity
+                current_activity = activities[assistant.current_activity_index]
 
                 # Create a special user message to GPT
                 admin_prompt = f"Admin message: Start a conversation on the activity: {current_activity.content}. The user is not aware of this message."
 
-                # Send this as a user message to GPT
-                self.gpt_manager.openai_client.beta.threads.messages.create(
-                    thread_id=assistant.gpt_thread_id,
-                    role="user",
-                    content=admin_prompt
-                )
-
-                # Now get GPT's response
-                gpt_response = self.gpt_manager.generate_gpt_response(
-                    assistant)
+                # Send this as a user message to GPT and get its response
+                reply = yield assistant, admin_prompt
+                gpt_response = reply.text
 
                 # Save the assistant's response
                 self.db.save_transcript(
-                    user, "", gpt_response, session_number=assistant.session_count)
+                    user, "", gpt_response, session_number=assistant.session_count,
+                    reply=reply, activity=current_activity)
 
-                assistant.save()
+                self.db.save_turn(assistant)
                 return gpt_response
             else:
                 return "No activities to start."
 
         # User sends a message
         if message is not None:
+            current_activity = activity_at(activities, assistant.current_activity_index)
             assistant.exchange_count += 1  # Increment after assistant responds
             if assistant.exchange_count == prompt.num_rounds:
                 message += " [admin message: this is the last message, do not ask question, just respond]"
             # Generate assistant's response
-            gpt_response_2_user = self.gpt_manager.generate_gpt_response(
-                assistant, message)
+            reply = yield assistant, message
+            gpt_response_2_user = reply.text
             self.db.save_transcript(
-                user, message, gpt_response_2_user, session_number=assistant.session_count)
+                user, message, gpt_response_2_user, session_number=assistant.session_count,
+                reply=reply, activity=current_activity)
             if assistant.exchange_count >= prompt.num_rounds:
                 # Move to next activity after exchanges
                 assistant.current_activity_index += 1
@@ -212,25 +828,19 @@ class ChatService:
 
                 if assistant.current_activity_index < len(activities):
                     # Create a special user message to GPT
-                    next_activity = activities[assistant.current_activity_index].activity
+                    next_activity = activities[assistant.current_activity_index]
                     admin_prompt = f"Admin message: Transition to the next activity: {next_activity.content}. The user is not aware of this message."
 
-                    # Send this as a user message to GPT
-                    self.gpt_manager.openai_client.beta.threads.messages.create(
-                        thread_id=assistant.gpt_thread_id,
-                        role="user",
-                        content=admin_prompt
-                    )
-
-                    # Now get GPT's response
-                    gpt_response_transition = self.gpt_manager.generate_gpt_response(
-                        assistant)
+                    # Send this as a user message to GPT and get its response
+                    reply = yield assistant, admin_prompt
+                    gpt_response_transition = reply.text
 
                     # Save the assistant's response
                     self.db.save_transcript(
-                        user, "", gpt_response_transition, session_number=assistant.session_count)
+                        user, "", gpt_response_transition, session_number=assistant.session_count,
+                        reply=reply, activity=next_activity)
                     assistant.exchange_count = 0
-                    assistant.save()
+                    self.db.save_turn(assistant)
                     # return gpt_response_2_user + '\n\n' + gpt_response_transition
                     return {
                         'multiple_responses': True,
@@ -240,45 +850,39 @@ class ChatService:
                     # End of session
                     admin_prompt = """Admin message: End the session. The user is not aware of this message. Conclude with: Thank you for sharing your thoughts and feelings today! Remember, reflecting on your experiences can be a valuable part of your growth. Now, please first click "Logout" at the start of the chat interface. Then click the button at the bottom right of the page to return to the survey and answer a few questions about your experiences chatting with me. Take care!"""
 
-                    # Send this as a user message to GPT
-                    self.gpt_manager.openai_client.beta.threads.messages.create(
-                        thread_id=assistant.gpt_thread_id,
-                        role="user",
-                        content=admin_prompt
-                    )
-
-                    # Now get GPT's response
-                    gpt_response_conclude = self.gpt_manager.generate_gpt_response(
-                        assistant)
+                    # Send this as a user message to GPT and get its response
+                    reply = yield assistant, admin_prompt
+                    gpt_response_conclude = reply.text
 
                     # Save the assistant's response
                     self.db.save_transcript(
-                        user, "", gpt_response_conclude, session_number=assistant.session_count)
+                        user, "", gpt_response_conclude, session_number=assistant.session_count,
+                        reply=reply, activity=current_activity)
                     assistant.exchange_count = -1  # Mark session as ended
-                    assistant.save()
+                    self.db.save_turn(assistant)
                     # return gpt_response_2_user + '\n\n' + gpt_response_conclude
                     return {
                         'multiple_responses': True,
                         'responses': [gpt_response_2_user, gpt_response_conclude]
                     }
-                    # assistant.save()
+                    # self.db.save_turn(assistant)
                     # return gpt_response_2_user
 
-            assistant.save()
+            self.db.save_turn(assistant)
             return gpt_response_2_user
 
         return "No message provided."
 
+    def chat_instructions(self, user):
+        # Shared by every user; the preferred name is added per run
+        return self.db.get_prompt_instructions(user)
+
     def send_message_to_participant(self, user_id, gpt_response):
-        url = f"http://external-api.com/ai/api/participant/{user_id}/send"
-        payload = {"message": gpt_response}
-        try:
-            response = self.requests_lib.post(url, json=payload)
+        # Retries, circuit breaking and dead-lettering live in ParticipantDelivery
+        response = self.delivery.deliver(user_id, gpt_response)
+        if response is not None:
             self.log_message_receipt(
                 user_id, response.status_code, response.text)
-        except Exception as e:
-            logging.error(
-                f"Failed to send GPT response to user {user_id}: {e}")
 
     def log_message_receipt(self, user_id, status_code, response_text):
         if status_code == 200:
@@ -288,6 +892,17 @@ class ChatService:
                 f"Failed to send GPT response to user {user_id}: {response_text}")
 
 
+def get_gpt_manager():
+    # ChatService works the same with either backend, see CHAT_BACKEND
+    if settings.CHAT_BACKEND == 'completions':
+        return ChatCompletionsManager(get_openai_client())
+    return GPTAssistantManager(get_openai_client())
+
+
+def get_chat_service(requests_lib=None):
+    return ChatService(db=Database(), gpt_manager=get_gpt_manager(), requests_lib=requests_lib)
+
+
 @csrf_exempt
 def prompt_view(request):
     prompt, _ = Prompt.objects.get_or_create(id=1)
@@ -302,7 +917,8 @@ def prompt_view(request):
         prompt.save()
         return redirect('chat:prompt')
     context = {'prompt': prompt, 'activities': activities}
-    return render(request, 'chat/prompt.html', context)
+    with timing('render'):
+        return render(request, 'chat/prompt.html', context)
 
 
 @csrf_exempt
@@ -327,7 +943,8 @@ def activity_edit(request, pk):
         activity.save()
         return redirect('chat:prompt')
     context = {'activity': activity}
-    return render(request, 'chat/activity_edit.html', context)
+    with timing('render'):
+        return render(request, 'chat/activity_edit.html', context)
 
 
 @csrf_exempt
@@ -341,34 +958,34 @@ def activity_delete(request, pk):
 
 
 @csrf_exempt
+@idempotent
 def incoming_message(request, id=None):
     if request.method == 'POST':
         data = json.loads(request.body)
         context = data.get('context')
         message = data.get('message')
 
-        db = Database()
-        gpt_manager = GPTAssistantManager(
-            OpenAI(api_key=os.getenv("OPENAI_API_KEY", "")))
-        service = ChatService(
-            db=db, gpt_manager=gpt_manager, requests_lib=requests)
+        service = get_chat_service()
 
         missing_fields = service.check_required_fields(context, message)
         if missing_fields:
             return JsonResponse({"error": f"Missing fields: {', '.join(missing_fields)}"}, status=400)
 
-        service.process_message_for_api(context, message, id)
-        return JsonResponse({"status": "received"}, status=200)
+        # Reply out of band so the upstream webhook isn't held open for the GPT run
+        enqueue_incoming_message(id, context, message)
+        return JsonResponse({"status": "received"}, status=202)
     else:
         return JsonResponse({'error': 'Invalid request method.'}, status=400)
 
 
 @xframe_options_exempt
 def chat_page_view(request):
-    return render(request, 'chat/chat_interface.html')
+    with timing('render'):
+        return render(request, 'chat/chat_interface.html')
 
 
 @csrf_exempt
+@idempotent
 def chat_send_message(request):
     if request.method == 'POST':
         data = json.loads(request.body)
@@ -377,49 +994,131 @@ def chat_send_message(request):
         if not user_id:
             return JsonResponse({'error': 'User not identified.'}, status=400)
 
-        db = Database()
-        gpt_manager = GPTAssistantManager(
-            OpenAI(api_key=os.getenv("OPENAI_API_KEY", ""))
-        )
-        service = ChatService(db=db, gpt_manager=gpt_manager)
+        service = get_chat_service()
 
-        gpt_response = service.process_message_for_chat(user_id, message)
-        # return JsonResponse({'response': gpt_response})
-        if isinstance(gpt_response, dict) and gpt_response.get('multiple_responses'):
-            return JsonResponse({'multiple_responses': True, 'responses': gpt_response['responses']})
-        else:
-            return JsonResponse({'response': gpt_response})
+        try:
+            gpt_response = service.process_message_for_chat(user_id, message)
+        except TurnRefused as e:
+            return JsonResponse({'error': e.message}, status=e.status)
+        with timing('serialize'):
+            return JsonResponse(chat_response_payload(gpt_response))
+    else:
+        return JsonResponse({'error': 'Invalid request method.'}, status=400)
+
+
+@csrf_exempt
+@idempotent
+def chat_send_message_stream(request):
+    if request.method == 'POST':
+        data = json.loads(request.body)
+        message = data.get('message')
+        user_id = request.headers.get('X-User-Id')
+        if not user_id:
+            return JsonResponse({'error': 'User not identified.'}, status=400)
+
+        service = get_chat_service()
+
+        response = StreamingHttpResponse(
+            sse_events(service.stream_message_for_chat(user_id, message)),
+            content_type='text/event-stream')
+        # Keep proxies from buffering the stream
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'
+        return response
     else:
         return JsonResponse({'error': 'Invalid request method.'}, status=400)
 
 
+def chat_response_payload(gpt_response):
+    if isinstance(gpt_response, dict) and gpt_response.get('multiple_responses'):
+        return {'multiple_responses': True, 'responses': gpt_response['responses']}
+    else:
+        return {'response': gpt_response}
+
+
+def format_sse(event, data):
+    with timing('serialize'):
+        return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def sse_events(turn_events):
+    # 'delta' events carry text as it is generated, keyed by reply index;
+    # 'done' carries the same payload chat_send_message would have returned
+    try:
+        for event, index, payload in turn_events:
+            if event == 'delta':
+                yield format_sse('delta', {'index': index, 'text': payload})
+            elif event == 'error':
+                yield format_sse('error', {'index': index, 'error': payload})
+            else:
+                yield format_sse('done', chat_response_payload(payload))
+    except Exception as e:
+        logging.error(f"Error streaming chat response: {e}")
+        yield format_sse('error', {'error': 'There was an error processing your message.'})
+    finally:
+        # Closing the turn early still finishes and persists it
+        turn_events.close()
+
+
+@read_only
 def get_conversation(request):
+    # Newest page first by default; `before_id` pages back through older
+    # transcripts and `since_id` returns only what came after the client's last one
     if request.method == 'GET':
         chat_user_id = request.headers.get('X-User-Id')
         if not chat_user_id:
             return JsonResponse({'conversation': []})
 
+        try:
+            since_id = optional_int(request.GET.get('since_id'))
+            before_id = optional_int(request.GET.get('before_id'))
+            session_number = optional_int(request.GET.get('session_number'))
+            limit = optional_int(request.GET.get('limit'))
+        except ValueError:
+            return JsonResponse({'error': 'since_id, before_id, session_number and limit must be integers.'},
+                                status=400)
+        if limit is not None and limit < 1:
+            return JsonResponse({'error': 'limit must be at least 1.'}, status=400)
+        limit = min(limit or CONVERSATION_PAGE_SIZE, CONVERSATION_MAX_PAGE_SIZE)
+
         db = Database()
         try:
-            user = db.get_user_by_bcfg_id(chat_user_id)
-            if not user:
-                return JsonResponse({'conversation': []})
-            transcripts = db.get_transcripts_for_user(user)
-            conversation = []
-
-            for transcript in transcripts:
-                if transcript.user_message.strip():
-                    conversation.append({
-                        'content': transcript.user_message,
-                        'sender': 'user'
-                    })
-                if transcript.assistant_message.strip():
-                    conversation.append({
-                        'content': transcript.assistant_message,
-                        'sender': 'bot'
+            # One indexed lookup decides between a 304, a cached page and a rebuild
+            version = db.get_latest_transcript_id(chat_user_id)
+            etag = make_etag(chat_user_id, version)
+            not_modified = get_conditional_response(request, etag=etag)
+            if not_modified is not None:
+                return revalidated(not_modified, etag)
+
+            params = (since_id, before_id, session_number, limit)
+            body = get_cached_page(chat_user_id, version, params)
+            if body is None:
+                rows, has_more = db.get_transcript_page(
+                    chat_user_id, since_id=since_id, before_id=before_id,
+                    session_number=session_number, limit=limit)
+                conversation = []
+
+                for transcript_id, user_message, assistant_message in rows:
+                    if user_message.strip():
+                        conversation.append({
+                            'content': user_message,
+                            'sender': 'user'
+                        })
+                    if (assistant_message or '').strip():
+                        conversation.append({
+                            'content': assistant_message,
+                            'sender': 'bot'
+                        })
+
+                with timing('serialize'):
+                    body = json.dumps({
+                        'conversation': conversation,
+                        'first_id': rows[0][0] if rows else None,
+                        'last_id': rows[-1][0] if rows else None,
+                        'has_more': has_more,
                     })
-
-            return JsonResponse({'conversation': conversation})
+                cache_page(chat_user_id, version, params, body)
+            return revalidated(HttpResponse(body, content_type='application/json'), etag)
         except Exception as e:
             logging.error(f"Error fetching conversation: {e}")
             return JsonResponse({'conversation': []})
@@ -427,7 +1126,31 @@ def get_conversation(request):
         return JsonResponse({'error': 'Invalid request method.'}, status=400)
 
 
+def optional_int(value):
+    return int(value) if value not in (None, '') else None
+
+
+def make_etag(*parts):
+    return quote_etag(hashlib.sha256(':'.join(map(str, parts)).encode()).hexdigest()[:32])
+
+
+def revalidated(response, etag):
+    # Clients keep their own copy per user and check it on every poll
+    response['ETag'] = etag
+    patch_cache_control(response, private=True, no_cache=True)
+    patch_vary_headers(response, ['X-User-Id'])
+    return response
+
+
+def pick_activities(prompt, activities):
+    num_activities = min(prompt.num_activities, len(activities))
+    random_activities = random.sample(activities, num_activities)
+    random_activities.sort(key=lambda a: a.priority)
+    return random_activities
+
+
 @csrf_exempt
+@idempotent
 def chat_login(request):
     if request.method == 'POST':
         data = json.loads(request.body)
@@ -437,24 +1160,15 @@ def chat_login(request):
             return JsonResponse({'status': 'error', 'error': 'Nickname and User ID are required.'})
         db = Database()
         user = db.get_or_create_user(user_id, nickname)
-        # Assign 3 random activities if not already assigned
-        if not UserActivity.objects.filter(user=user).exists():
-            prompt = Prompt.objects.first()
-            if not prompt:
-                prompt = Prompt.objects.create()
-            activities = list(Activity.objects.all())
-            num_activities = min(prompt.num_activities, len(activities))
-            random_activities = random.sample(activities, num_activities)
-            random_activities.sort(key=lambda a: a.priority)
-            for activity in random_activities:
-                UserActivity.objects.create(user=user, activity=activity)
+        # Assign random activities if not already assigned
+        db.assign_activities(user)
         # Initialize assistant and have it start the conversation
-        gpt_manager = GPTAssistantManager(
-            OpenAI(api_key=os.getenv("OPENAI_API_KEY", ""))
-        )
-        service = ChatService(db=db, gpt_manager=gpt_manager)
-        assistant_message = service.process_message_for_chat(
-            user_id)  # Assistant starts the conversation
+        service = get_chat_service()
+        try:
+            assistant_message = service.process_message_for_chat(
+                user_id)  # Assistant starts the conversation
+        except TurnRefused as e:
+            return JsonResponse({'status': 'error', 'error': e.message}, status=e.status)
         # Prepare the response
         response = JsonResponse(
             {'status': 'success', 'assistant_message': assistant_message})
@@ -464,6 +1178,7 @@ def chat_login(request):
 
 
 @csrf_exempt
+@read_only
 def get_user_info(request):
     if request.method == 'GET':
         user_id = request.headers.get('X-User-Id')
@@ -473,7 +1188,11 @@ def get_user_info(request):
         user = db.get_user_by_bcfg_id(user_id)
         if not user:
             return JsonResponse({'error': 'User not found'}, status=404)
-        return JsonResponse({'user_id': user.bcfg_id, 'nickname': user.name})
+        etag = make_etag(user.bcfg_id, user.name)
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            response = JsonResponse({'user_id': user.bcfg_id, 'nickname': user.name})
+        return revalidated(response, etag)
     else:
         return JsonResponse({'error': 'Invalid request method.'}, status=400)
 
@@ -485,26 +1204,22 @@ def restart_session(request):
         if not user_id:
             return JsonResponse({'error': 'User not identified.'}, status=400)
 
-        db = Database()
-        user = db.get_user_by_bcfg_id(user_id)
-        if not user:
-            return JsonResponse({'error': 'User not found.'}, status=404)
-
-        # Reset assistant state
-        assistant = Assistant.objects.filter(user=user).first()
-        if assistant:
-            assistant.current_activity_index = 0
-            assistant.exchange_count = 0
-            assistant.session_count += 1
-            assistant.save()
+        # Reset assistant state, unless a turn is still writing to it
+        users = User.objects.filter(bcfg_id=str(user_id))
+        restarted = Assistant.objects.filter(turn_lease_free(), user__in=users).update(**session_reset())
+        if not restarted:
+            if not users.exists():
+                return JsonResponse({'error': 'User not found.'}, status=404)
+            if Assistant.objects.filter(user__in=users).exists():
+                return JsonResponse({'error': TURN_IN_PROGRESS}, status=409)
 
         # Re-initialize the session similar to login
-        gpt_manager = GPTAssistantManager(
-            OpenAI(api_key=os.getenv("OPENAI_API_KEY", ""))
-        )
-        service = ChatService(db=db, gpt_manager=gpt_manager)
-        assistant_message = service.process_message_for_chat(
-            user_id)  # Start fresh
+        service = get_chat_service()
+        try:
+            assistant_message = service.process_message_for_chat(
+                user_id)  # Start fresh
+        except TurnRefused as e:
+            return JsonResponse({'error': e.message}, status=e.status)
 
         return JsonResponse({'status': 'success', 'assistant_message': assistant_message})
 
@@ -0,0 +1,21 @@
+import os
+import shutil
+
+# gunicorn loads this file from the working directory. Workers write their
+# Prometheus samples under PROMETHEUS_MULTIPROC_DIR so /api/metrics/ can add
+# them up across processes (see chat/metrics.py); it must be set before the
+# workers import prometheus_client.
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', '/tmp/prometheus_multiproc')
+
+
+def on_starting(server):
+    # Samples left by a previous run would be counted again
+    path = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+
+
+def child_exit(server, worker):
+    # Drops the dead worker's in-progress gauges; its counters and histograms are kept
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)